@@ -16,6 +16,13 @@ MYSQL_CONFIG = {
     'charset': 'utf8mb4'
 }
 
+# MySQL connection pool shared by every connector in a process
+POOL_CONFIG = {
+    'min_size': int(os.getenv('MYSQL_POOL_MIN', 1)),
+    'max_size': int(os.getenv('MYSQL_POOL_MAX', 10)),
+    'max_idle_seconds': 300,  # idle connections above min_size are closed after this
+    'checkout_timeout': 30  # seconds to wait for a free connection
+}
 
 # Flask Generator Configuration
 FLASK_CONFIG = {
@@ -24,9 +31,65 @@ FLASK_CONFIG = {
     'debug': True
 }
 
+# Product catalog: one JSON file shared by the generator and the ETL
+CATALOG_CONFIG = {
+    'products_file': os.getenv('PRODUCT_CATALOG_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'products.json')),
+    'refresh_interval_seconds': 30  # how often to check the file for changes
+}
+
 # ETL Configuration
 ETL_CONFIG = {
-    'batch_size': 1000,
-    'sleep_interval': 5  # seconds between ETL runs
+    'batch_size': 1000,  # rows per extracted batch; the starting size when adaptive batching is on
+    'adaptive_batching': os.getenv('ETL_ADAPTIVE_BATCHING', 'true').lower() == 'true',  # resize batches and the poll interval to the load
+    'min_batch_size': 100,
+    'max_batch_size': 20000,
+    'target_batch_seconds': 2.0,  # processing time per batch the adaptive sizes aim for
+    'max_memory_mb': 1024,  # adaptive batches halve while the process is above this (0: no limit)
+    'load_chunk_size': 500,  # rows per multi-row INSERT when loading fact batches
+    'customer_cache_size': 50000,  # max natural keys held per dimension key cache
+    'product_cache_size': 10000,
+    'location_cache_size': 50000,
+    'customer_attribute_cache_size': 50000,  # staged customer attributes held for enrichment
+    'customer_attribute_cache_seconds': 300,  # cached attributes are looked up again after this, picking up staged updates
+    'warm_dimension_caches': True,  # preload dimension keys from the warehouse at startup
+    'customer_history': os.getenv('ETL_CUSTOMER_HISTORY', 'false').lower() == 'true',  # archive superseded customer versions to dim_customer_history
+    'pipeline_mode': os.getenv('ETL_PIPELINE_MODE', 'sequential'),  # 'sequential' or 'staged'
+    'transform_workers': 2,  # staged mode: threads per stage
+    'load_workers': 2,
+    'stage_queue_size': 4,  # staged mode: batches buffered between stages
+    'partition_count': int(os.getenv('ETL_PARTITIONS', 1)),  # >1: hash partitions per staging table, claimed by workers through leases
+    'worker_id': os.getenv('ETL_WORKER_ID'),  # defaults to hostname:pid
+    'lease_seconds': 60,  # a partition lease not renewed within this is free to claim
+    'extract_settle_seconds': 1,  # rows are extracted once their created_at second ended at least this long ago, so none can still arrive in it
+    'streaming_extract': os.getenv('ETL_STREAMING_EXTRACT', 'false').lower() == 'true',  # one server-side cursor per source instead of keyset pages
+    'cart_timeout_minutes': 30,  # a cart with no clicks for this long is abandoned
+    'max_open_carts': 100000,  # open carts kept by the sessionizer before the least active is closed
+    'dead_letter_max_fraction': 0.5,  # a batch with more failing rows than this fails whole instead of dead-lettering them
+    'staging_retention_days': int(os.getenv('ETL_STAGING_RETENTION_DAYS', 7)),  # loaded staging partitions are kept this many days, the furthest back a backfill or replay can reach
+    'staging_retention_mode': os.getenv('ETL_STAGING_RETENTION_MODE', 'archive'),  # 'archive' (gzipped CSV, then drop) or 'drop'
+    'staging_archive_dir': os.getenv('ETL_STAGING_ARCHIVE_DIR', 'staging_archive'),
+    'staging_partitions_ahead_days': 3,  # daily staging partitions created in advance
+    'staging_retention_interval_seconds': 3600,  # how often the pipeline runs partition maintenance
+    'dead_letter_file': os.getenv('ETL_DEAD_LETTER_FILE', 'dead_letters/dead_letters.jsonl'),  # used when etl_dead_letter can't be written
+    'scheduler': os.getenv('ETL_SCHEDULER', 'micro_batch'),  # 'micro_batch' (run when rows are pending) or 'interval' (fixed sleep)
+    'scheduler_trigger_rows': 500,  # micro_batch: pending rows that start a run at once
+    'scheduler_max_latency_seconds': 0.5,  # micro_batch: longest a notified row waits for a run
+    'scheduler_housekeeping_seconds': 60,  # micro_batch: idle cart expiry, lease renewal and staging retention while no rows arrive
+    'sleep_interval': 5,  # seconds between ETL runs; the starting interval when adaptive batching is on
+    'min_sleep_interval': 1,
+    'max_sleep_interval': 60
 }
 
+# Staging write notifications from the generator to the ETL scheduler (UDP)
+NOTIFY_CONFIG = {
+    'enabled': os.getenv('ETL_NOTIFY_ENABLED', 'true').lower() == 'true',
+    'host': os.getenv('ETL_NOTIFY_HOST', '127.0.0.1'),
+    'port': int(os.getenv('ETL_NOTIFY_PORT', 5999))
+}
+
+# Metrics Configuration
+METRICS_CONFIG = {
+    'enabled': os.getenv('ETL_METRICS_ENABLED', 'true').lower() == 'true',
+    'prometheus_file': os.getenv('ETL_METRICS_FILE', 'metrics/etl_metrics.prom'),  # rewritten after each run
+    'http_port': int(os.getenv('ETL_METRICS_PORT', 0)) or None  # serve /metrics when set
+}
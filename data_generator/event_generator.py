@@ -7,26 +7,15 @@ import random
 import uuid
 from datetime import datetime, timedelta
 import logging
+import threading
+from utils.product_catalog import get_catalog
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 fake = Faker()
 
-# Sample data pools
-PRODUCTS = [
-    {"id": "PROD001", "name": "Wireless Headphones", "category": "Electronics", "subcategory": "Audio", "brand": "TechSound", "price": 99.99},
-    {"id": "PROD002", "name": "Smartphone Case", "category": "Electronics", "subcategory": "Accessories", "brand": "ProtectPlus", "price": 24.99},
-    {"id": "PROD003", "name": "Laptop Stand", "category": "Electronics", "subcategory": "Accessories", "brand": "ErgoDesk", "price": 49.99},
-    {"id": "PROD004", "name": "Running Shoes", "category": "Fashion", "subcategory": "Footwear", "brand": "SportMax", "price": 79.99},
-    {"id": "PROD005", "name": "Yoga Mat", "category": "Sports", "subcategory": "Fitness", "brand": "FlexFit", "price": 29.99},
-    {"id": "PROD006", "name": "Coffee Maker", "category": "Home", "subcategory": "Appliances", "brand": "BrewMaster", "price": 89.99},
-    {"id": "PROD007", "name": "Desk Lamp", "category": "Home", "subcategory": "Furniture", "brand": "BrightLight", "price": 34.99},
-    {"id": "PROD008", "name": "Backpack", "category": "Fashion", "subcategory": "Bags", "brand": "TravelPro", "price": 59.99},
-    {"id": "PROD009", "name": "Wireless Mouse", "category": "Electronics", "subcategory": "Computer", "brand": "ClickTech", "price": 19.99},
-    {"id": "PROD010", "name": "Water Bottle", "category": "Sports", "subcategory": "Accessories", "brand": "Hydrate", "price": 14.99},
-]
-
+# Sample data pools (products come from the shared product catalog)
 CLICK_TYPES = ['view', 'add_to_cart', 'remove_from_cart', 'checkout']
 EVENT_TYPES = ['login', 'logout', 'signup', 'profile_update', 'password_reset']
 ORDER_STATUSES = ['pending', 'confirmed', 'shipped', 'delivered', 'cancelled']
@@ -41,6 +30,9 @@ class EventGenerator:
     def __init__(self):
         self.customers = {}  # Store customer data
         self.sessions = {}  # Store session data
+        self.catalog = get_catalog()
+        self.new_customers = []  # Customers not yet marked staged by mark_customers_staged
+        self.lock = threading.Lock()
     
     def generate_customer_id(self):
         """Generate or retrieve customer ID"""
@@ -57,8 +49,35 @@ class EventGenerator:
                 'gender': random.choice(['Male', 'Female', 'Other']),
                 'registration_date': fake.date_between(start_date='-2y', end_date='today')
             }
+            with self.lock:
+                self.new_customers.append(customer_id)
             return customer_id
     
+    def new_customer_rows(self):
+        """Customers created but not yet staged, as staging_customers rows
+
+        They stay pending until mark_customers_staged, so a failed insert is retried on the next call.
+        """
+        with self.lock:
+            customer_ids = list(self.new_customers)
+        return [
+            {
+                'customer_id': customer_id,
+                'customer_name': self.customers[customer_id]['name'],
+                'email': self.customers[customer_id]['email'],
+                'age': self.customers[customer_id]['age'],
+                'gender': self.customers[customer_id]['gender'],
+                'registration_date': self.customers[customer_id]['registration_date'].strftime('%Y-%m-%d')
+            }
+            for customer_id in customer_ids
+        ]
+    
+    def mark_customers_staged(self, customer_ids):
+        """Drop customers whose staging_customers rows have committed from the pending list"""
+        staged = set(customer_ids)
+        with self.lock:
+            self.new_customers = [customer_id for customer_id in self.new_customers if customer_id not in staged]
+    
     def generate_session_id(self):
         """Generate session ID"""
         return f"SESSION{random.randint(100000, 999999)}"
@@ -67,9 +86,9 @@ class EventGenerator:
         """Generate an order event"""
         order_id = f"ORD{random.randint(100000, 999999)}"
         customer_id = self.generate_customer_id()
-        product = random.choice(PRODUCTS)
+        product = random.choice(self.catalog.all())
         quantity = random.randint(1, 5)
-        unit_price = product['price']
+        unit_price = product.price
         total_amount = unit_price * quantity
         
         # Calculate delivery date (1-7 days after order)
@@ -80,7 +99,7 @@ class EventGenerator:
         order = {
             'order_id': order_id,
             'customer_id': customer_id,
-            'product_id': product['id'],
+            'product_id': product.product_id,
             'order_date': order_date.strftime('%Y-%m-%d %H:%M:%S'),
             'order_status': random.choice(ORDER_STATUSES),
             'quantity': quantity,
@@ -101,14 +120,14 @@ class EventGenerator:
         """Generate a click/view event"""
         click_id = f"CLICK{random.randint(100000, 999999)}"
         customer_id = self.generate_customer_id() if random.random() < 0.8 else None
-        product = random.choice(PRODUCTS)
+        product = random.choice(self.catalog.all())
         click_type = random.choice(CLICK_TYPES)
         session_id = self.generate_session_id()
         
         click = {
             'click_id': click_id,
             'customer_id': customer_id,
-            'product_id': product['id'],
+            'product_id': product.product_id,
             'click_type': click_type,
             'click_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'session_id': session_id,
@@ -146,7 +165,7 @@ class EventGenerator:
     def generate_cart_abandonment(self):
         """Generate cart abandonment data"""
         customer_id = self.generate_customer_id()
-        product = random.choice(PRODUCTS)
+        product = random.choice(self.catalog.all())
         session_id = self.generate_session_id()
         
         add_to_cart_time = datetime.now() - timedelta(minutes=random.randint(5, 60))
@@ -156,11 +175,11 @@ class EventGenerator:
         abandonment = {
             'session_id': session_id,
             'customer_id': customer_id,
-            'product_id': product['id'],
+            'product_id': product.product_id,
             'add_to_cart_time': add_to_cart_time.strftime('%Y-%m-%d %H:%M:%S'),
             'abandonment_time': abandonment_time.strftime('%Y-%m-%d %H:%M:%S'),
             'time_to_abandonment_minutes': time_to_abandonment,
-            'cart_value': float(product['price'] * random.randint(1, 3)),
+            'cart_value': float(product.price * random.randint(1, 3)),
             'items_count': random.randint(1, 3),
             'device_type': random.choice(DEVICE_TYPES),
             'browser': random.choice(BROWSERS)
@@ -8,24 +8,56 @@ import threading
 import time
 from data_generator.event_generator import EventGenerator
 from utils.database_connector import MySQLConnector
+from utils.staging_notify import notify_staged
 import json
 
 app = Flask(__name__)
 CORS(app)
 
 generator = EventGenerator()
-mysql_connector = MySQLConnector()
 
 # Global flag for streaming
 streaming_active = False
 stream_thread = None
 
 
+def insert_new_customers_mysql():
+    """Stage the attributes of customers the generator created since the last call"""
+    customers = generator.new_customer_rows()
+    if not customers:
+        return
+    try:
+        query = """
+        INSERT INTO staging_customers 
+        (customer_id, customer_name, email, age, gender, registration_date)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            customer_name = VALUES(customer_name),
+            email = VALUES(email),
+            age = VALUES(age),
+            gender = VALUES(gender),
+            registration_date = VALUES(registration_date)
+        """
+        params_list = [
+            (
+                customer['customer_id'], customer['customer_name'], customer['email'],
+                customer['age'], customer['gender'], customer['registration_date']
+            )
+            for customer in customers
+        ]
+        with MySQLConnector() as mysql:
+            mysql.execute_many(query, params_list)
+        generator.mark_customers_staged([customer['customer_id'] for customer in customers])
+    except Exception as e:
+        # Still pending in the generator, so the next call stages them again
+        print(f"Failed to insert customers: {e}")
+
+
 def insert_order_mysql(order):
     """Insert order into MySQL staging table"""
+    # Customers are staged before the rows that reference them
+    insert_new_customers_mysql()
     try:
-        if not mysql_connector.connection:
-            mysql_connector.connect()
         query = """
         INSERT INTO staging_orders 
         (order_id, customer_id, product_id, order_date, order_status, quantity, 
@@ -40,16 +72,19 @@ def insert_order_mysql(order):
             order['city'], order['state'], order['country'],
             order['postal_code'], order['delivery_date'], order['payment_method']
         )
-        mysql_connector.execute_query(query, params)
+        # Each call borrows a pooled connection, so the stream thread and
+        # request handlers never share one
+        with MySQLConnector() as mysql:
+            mysql.execute_query(query, params)
+        notify_staged('staging_orders')
     except Exception as e:
         print(f"Failed to insert order: {e}")
 
 
 def insert_click_mysql(click):
     """Insert click into MySQL staging table"""
+    insert_new_customers_mysql()
     try:
-        if not mysql_connector.connection:
-            mysql_connector.connect()
         query = """
         INSERT INTO staging_clicks 
         (click_id, customer_id, product_id, click_type, click_timestamp, 
@@ -61,16 +96,17 @@ def insert_click_mysql(click):
             click['click_type'], click['click_timestamp'], click['session_id'],
             click['device_type'], click['browser'], click['ip_address']
         )
-        mysql_connector.execute_query(query, params)
+        with MySQLConnector() as mysql:
+            mysql.execute_query(query, params)
+        notify_staged('staging_clicks')
     except Exception as e:
         print(f"Failed to insert click: {e}")
 
 
 def insert_event_mysql(event):
     """Insert customer event into MySQL staging table"""
+    insert_new_customers_mysql()
     try:
-        if not mysql_connector.connection:
-            mysql_connector.connect()
         query = """
         INSERT INTO staging_customer_events 
         (event_id, customer_id, event_type, event_timestamp, event_data, session_id)
@@ -81,7 +117,9 @@ def insert_event_mysql(event):
             event['event_id'], event['customer_id'], event['event_type'],
             event['event_timestamp'], event_data_str, event['session_id']
         )
-        mysql_connector.execute_query(query, params)
+        with MySQLConnector() as mysql:
+            mysql.execute_query(query, params)
+        notify_staged('staging_customer_events')
     except Exception as e:
         print(f"Failed to insert event: {e}")
 
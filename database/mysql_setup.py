@@ -3,8 +3,9 @@ MySQL Database Setup Script
 """
 import pymysql
 from config.config import MYSQL_CONFIG
+from utils.date_dimension import DATE_DIM_START, DATE_DIM_END, iter_date_rows
+from etl.retention import StagingRetention
 import os
-from datetime import datetime, timedelta
 import re
 
 
@@ -12,9 +13,6 @@ def populate_date_dimension(connection):
     """Populate date dimension table"""
     try:
         print("Populating date dimension...")
-        start_date = datetime(2020, 1, 1)
-        end_date = datetime(2030, 12, 31)
-        current_date = start_date
         
         insert_query = """
         INSERT INTO dim_date 
@@ -24,40 +22,19 @@ def populate_date_dimension(connection):
         ON DUPLICATE KEY UPDATE full_date = VALUES(full_date)
         """
         
-        month_names = ['', 'January', 'February', 'March', 'April', 'May', 'June',
-                      'July', 'August', 'September', 'October', 'November', 'December']
-        day_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        
         batch = []
         batch_size = 1000
         
         with connection.cursor() as cursor:
-            while current_date <= end_date:
-                date_key = int(current_date.strftime('%Y%m%d'))
-                year = current_date.year
-                quarter = (current_date.month - 1) // 3 + 1
-                month = current_date.month
-                month_name = month_names[month]
-                
-                # Calculate week number (ISO week)
-                week = current_date.isocalendar()[1]
-                day_of_month = current_date.day
-                day_of_week = current_date.weekday() + 1  # 1=Monday, 7=Sunday
-                day_name = day_names[current_date.weekday()]
-                is_weekend = day_of_week in [6, 7]  # Saturday or Sunday
-                
-                batch.append((
-                    date_key, current_date.date(), year, quarter, month, month_name,
-                    week, day_of_month, day_of_week, day_name, is_weekend, False
-                ))
+            # Same calendar the ETL uses to resolve date keys without queries
+            for row in iter_date_rows(DATE_DIM_START, DATE_DIM_END):
+                batch.append(row)
                 
                 if len(batch) >= batch_size:
                     cursor.executemany(insert_query, batch)
                     connection.commit()
                     print(f"Inserted {len(batch)} date records...")
                     batch = []
-                
-                current_date += timedelta(days=1)
             
             if batch:
                 cursor.executemany(insert_query, batch)
@@ -97,6 +74,12 @@ def execute_sql_file(connection, file_path):
     while i < len(content):
         char = content[i]
         
+        # Skip -- comments, so a ';' or quote inside one can't end or open anything
+        if not in_string and content.startswith('--', i):
+            end = content.find('\n', i)
+            i = len(content) if end == -1 else end
+            continue
+        
         # Track string literals
         if char in ("'", '"') and (i == 0 or content[i-1] != '\\'):
             if not in_string:
@@ -219,6 +202,9 @@ def setup_database():
                 connection.commit()
         
         populate_date_dimension(connection)
+        
+        print("Creating staging partitions...")
+        StagingRetention().prepare()
         print("Database setup completed!")
         connection.close()
         
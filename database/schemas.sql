@@ -4,6 +4,13 @@
 -- Drop existing tables if they exist (for fresh setup)
 DROP TABLE IF EXISTS fact_sales;
 DROP TABLE IF EXISTS fact_cart_abandonment;
+DROP TABLE IF EXISTS fact_customer_events;
+DROP TABLE IF EXISTS agg_customer_activity;
+DROP TABLE IF EXISTS agg_daily_sales;
+DROP TABLE IF EXISTS agg_daily_abandonment;
+DROP TABLE IF EXISTS agg_daily_delivery;
+DROP TABLE IF EXISTS customer_lifetime;
+DROP TABLE IF EXISTS dim_customer_history;
 DROP TABLE IF EXISTS dim_customer;
 DROP TABLE IF EXISTS dim_product;
 DROP TABLE IF EXISTS dim_date;
@@ -11,14 +18,24 @@ DROP TABLE IF EXISTS dim_location;
 DROP TABLE IF EXISTS staging_orders;
 DROP TABLE IF EXISTS staging_clicks;
 DROP TABLE IF EXISTS staging_customer_events;
+DROP TABLE IF EXISTS staging_customers;
+DROP TABLE IF EXISTS etl_checkpoints;
+DROP TABLE IF EXISTS etl_cart_sessions;
+DROP TABLE IF EXISTS etl_leases;
+DROP TABLE IF EXISTS etl_workers;
+DROP TABLE IF EXISTS etl_backfill_progress;
+DROP TABLE IF EXISTS etl_dead_letter;
 
 -- ============================================
 -- STAGING TABLES (Raw data ingestion)
 -- ============================================
+-- Orders, clicks and events are range-partitioned by day of created_at.
+-- etl/retention.py adds the daily partitions ahead of time (splitting them off
+-- p_future while it is empty) and archives and drops the loaded old ones.
 
 -- Staging table for orders
 CREATE TABLE staging_orders (
-    order_id VARCHAR(50) PRIMARY KEY,
+    order_id VARCHAR(50) NOT NULL,
     customer_id VARCHAR(50) NOT NULL,
     product_id VARCHAR(50) NOT NULL,
     order_date DATETIME NOT NULL,
@@ -33,15 +50,20 @@ CREATE TABLE staging_orders (
     postal_code VARCHAR(20),
     delivery_date DATETIME,
     payment_method VARCHAR(50),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (order_id, created_at), -- partitioned tables need the partition column in every unique key, so Extractor.drop_duplicate_ids keeps ids unique
+    INDEX idx_created_at_order_id (created_at, order_id), -- keyset extraction
     INDEX idx_order_date (order_date),
     INDEX idx_customer_id (customer_id),
     INDEX idx_product_id (product_id)
+)
+PARTITION BY RANGE (UNIX_TIMESTAMP(created_at)) (
+    PARTITION p_future VALUES LESS THAN MAXVALUE
 );
 
 -- Staging table for clicks/views
 CREATE TABLE staging_clicks (
-    click_id VARCHAR(50) PRIMARY KEY,
+    click_id VARCHAR(50) NOT NULL,
     customer_id VARCHAR(50),
     product_id VARCHAR(50) NOT NULL,
     click_type VARCHAR(20) NOT NULL, -- 'view', 'add_to_cart', 'remove_from_cart', 'checkout'
@@ -50,25 +72,47 @@ CREATE TABLE staging_clicks (
     device_type VARCHAR(20),
     browser VARCHAR(50),
     ip_address VARCHAR(45),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (click_id, created_at),
+    INDEX idx_created_at_click_id (created_at, click_id), -- keyset extraction
     INDEX idx_click_timestamp (click_timestamp),
     INDEX idx_customer_id (customer_id),
     INDEX idx_product_id (product_id),
     INDEX idx_click_type (click_type)
+)
+PARTITION BY RANGE (UNIX_TIMESTAMP(created_at)) (
+    PARTITION p_future VALUES LESS THAN MAXVALUE
 );
 
 -- Staging table for customer events
 CREATE TABLE staging_customer_events (
-    event_id VARCHAR(50) PRIMARY KEY,
+    event_id VARCHAR(50) NOT NULL,
     customer_id VARCHAR(50) NOT NULL,
     event_type VARCHAR(50) NOT NULL, -- 'login', 'logout', 'signup', 'profile_update', etc.
     event_timestamp DATETIME NOT NULL,
     event_data JSON,
     session_id VARCHAR(50),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (event_id, created_at),
+    INDEX idx_created_at_event_id (created_at, event_id), -- keyset extraction
     INDEX idx_event_timestamp (event_timestamp),
     INDEX idx_customer_id (customer_id),
     INDEX idx_event_type (event_type)
+)
+PARTITION BY RANGE (UNIX_TIMESTAMP(created_at)) (
+    PARTITION p_future VALUES LESS THAN MAXVALUE
+);
+
+-- Staging table for customer attributes, written when a customer is first seen
+CREATE TABLE staging_customers (
+    customer_id VARCHAR(50) PRIMARY KEY,
+    customer_name VARCHAR(200),
+    email VARCHAR(255),
+    age INT,
+    gender VARCHAR(20),
+    registration_date DATE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
 );
 
 -- ============================================
@@ -86,11 +130,30 @@ CREATE TABLE dim_customer (
     registration_date DATE,
     customer_segment VARCHAR(50),
     is_active BOOLEAN DEFAULT TRUE,
+    row_hash CHAR(32), -- Hash of the attributes, so unchanged rows are not rewritten
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     INDEX idx_customer_id (customer_id)
 );
 
+-- Superseded customer versions (written when ETL_CUSTOMER_HISTORY is enabled)
+CREATE TABLE dim_customer_history (
+    history_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    customer_key INT NOT NULL,
+    customer_id VARCHAR(50) NOT NULL,
+    customer_name VARCHAR(200),
+    email VARCHAR(255),
+    age INT,
+    gender VARCHAR(20),
+    registration_date DATE,
+    customer_segment VARCHAR(50),
+    row_hash CHAR(32),
+    valid_from TIMESTAMP NULL,
+    valid_to TIMESTAMP NULL,
+    FOREIGN KEY (customer_key) REFERENCES dim_customer(customer_key),
+    INDEX idx_customer_key_valid_to (customer_key, valid_to)
+);
+
 -- Dimension: Product
 CREATE TABLE dim_product (
     product_key INT AUTO_INCREMENT PRIMARY KEY,
@@ -102,6 +165,7 @@ CREATE TABLE dim_product (
     price DECIMAL(10, 2),
     stock_quantity INT,
     is_active BOOLEAN DEFAULT TRUE,
+    row_hash CHAR(32), -- Hash of the attributes, so unchanged rows are not rewritten
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     INDEX idx_product_id (product_id),
@@ -168,7 +232,8 @@ CREATE TABLE fact_sales (
     INDEX idx_order_date (order_date),
     INDEX idx_date_key (date_key),
     INDEX idx_customer_key (customer_key),
-    INDEX idx_product_key (product_key)
+    INDEX idx_product_key (product_key),
+    INDEX idx_order_id (order_id) -- backfill replace/gap checks
 );
 
 -- Fact: Cart Abandonment
@@ -181,9 +246,9 @@ CREATE TABLE fact_cart_abandonment (
     add_to_cart_time DATETIME NOT NULL,
     checkout_attempt_time DATETIME,
     abandonment_time DATETIME NOT NULL,
-    time_to_abandonment_minutes INT, -- Calculated time
-    cart_value DECIMAL(10, 2),
-    items_count INT,
+    time_to_abandonment_minutes INT, -- From add to cart until the last click of the session
+    cart_value DECIMAL(10, 2), -- Value of this product line in the cart
+    items_count INT, -- Items in the whole abandoned cart
     device_type VARCHAR(20),
     browser VARCHAR(50),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -194,6 +259,182 @@ CREATE TABLE fact_cart_abandonment (
     INDEX idx_abandonment_time (abandonment_time)
 );
 
+-- Fact: Customer Events
+CREATE TABLE fact_customer_events (
+    customer_event_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    date_key INT NOT NULL,
+    customer_key INT NOT NULL,
+    event_id VARCHAR(50) NOT NULL,
+    event_type VARCHAR(50) NOT NULL, -- 'login', 'logout', 'signup', 'profile_update', etc.
+    event_timestamp DATETIME NOT NULL,
+    session_id VARCHAR(50),
+    event_source VARCHAR(50), -- event_data.source (signups)
+    field_updated VARCHAR(50), -- event_data.field_updated (profile updates)
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (date_key) REFERENCES dim_date(date_key),
+    FOREIGN KEY (customer_key) REFERENCES dim_customer(customer_key),
+    INDEX idx_date_key (date_key),
+    INDEX idx_customer_key (customer_key),
+    INDEX idx_event_type (event_type),
+    INDEX idx_event_id (event_id) -- backfill replace/gap checks
+);
+
+-- ============================================
+-- AGGREGATE TABLES (maintained incrementally by the ETL)
+-- ============================================
+
+-- Per-customer activity counters, incremented with each loaded event batch
+CREATE TABLE agg_customer_activity (
+    customer_key INT PRIMARY KEY,
+    login_count INT NOT NULL DEFAULT 0,
+    signup_count INT NOT NULL DEFAULT 0,
+    last_login_at DATETIME,
+    last_event_at DATETIME NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (customer_key) REFERENCES dim_customer(customer_key)
+);
+
+-- Daily sales per product, incremented with each loaded order batch
+CREATE TABLE agg_daily_sales (
+    date_key INT NOT NULL,
+    product_key INT NOT NULL,
+    order_count INT NOT NULL DEFAULT 0,
+    total_quantity INT NOT NULL DEFAULT 0,
+    total_sales DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    unique_customers INT NOT NULL DEFAULT 0, -- distinct customers buying the product that day, estimated from customers_sketch
+    customers_sketch BLOB, -- HyperLogLog of customer keys, merged across days and products for coarser unique counts
+    orders_sketch BLOB, -- HyperLogLog of order ids
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (date_key, product_key),
+    FOREIGN KEY (date_key) REFERENCES dim_date(date_key),
+    FOREIGN KEY (product_key) REFERENCES dim_product(product_key)
+);
+
+-- Daily cart abandonment per product and device, incremented with each loaded click batch
+CREATE TABLE agg_daily_abandonment (
+    date_key INT NOT NULL,
+    product_key INT NOT NULL,
+    device_type VARCHAR(20) NOT NULL, -- '' when unknown
+    browser VARCHAR(50) NOT NULL, -- '' when unknown
+    abandonment_count INT NOT NULL DEFAULT 0,
+    total_abandoned_value DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    abandonment_minutes_sum BIGINT NOT NULL DEFAULT 0, -- sum and count of non-null values, for averages
+    abandonment_minutes_count INT NOT NULL DEFAULT 0,
+    items_count_sum BIGINT NOT NULL DEFAULT 0,
+    items_count_count INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (date_key, product_key, device_type, browser),
+    FOREIGN KEY (date_key) REFERENCES dim_date(date_key),
+    FOREIGN KEY (product_key) REFERENCES dim_product(product_key)
+);
+
+-- Daily delivery times per location, product and status, for orders with a delivery time
+CREATE TABLE agg_daily_delivery (
+    date_key INT NOT NULL,
+    location_key INT NOT NULL,
+    product_key INT NOT NULL,
+    order_status VARCHAR(20) NOT NULL,
+    delivery_count INT NOT NULL DEFAULT 0,
+    delivery_hours_sum BIGINT NOT NULL DEFAULT 0,
+    min_delivery_hours INT NOT NULL,
+    max_delivery_hours INT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (date_key, location_key, product_key, order_status),
+    FOREIGN KEY (date_key) REFERENCES dim_date(date_key),
+    FOREIGN KEY (location_key) REFERENCES dim_location(location_key),
+    FOREIGN KEY (product_key) REFERENCES dim_product(product_key)
+);
+
+-- Lifetime order totals per customer, incremented with each loaded order batch
+CREATE TABLE customer_lifetime (
+    customer_key INT PRIMARY KEY,
+    total_orders INT NOT NULL DEFAULT 0,
+    total_spent DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    first_order_date DATETIME NOT NULL,
+    last_order_date DATETIME NOT NULL,
+    current_location_key INT NOT NULL, -- location of the latest order
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (customer_key) REFERENCES dim_customer(customer_key),
+    FOREIGN KEY (current_location_key) REFERENCES dim_location(location_key)
+);
+
+-- ============================================
+-- ETL CONTROL TABLES
+-- ============================================
+
+-- Per-source extraction high-water marks, committed with each loaded batch
+CREATE TABLE etl_checkpoints (
+    source_name VARCHAR(100) PRIMARY KEY,
+    last_created_at DATETIME,
+    last_id VARCHAR(50),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Open carts of the click sessionizer, committed with each loaded click batch
+CREATE TABLE etl_cart_sessions (
+    session_id VARCHAR(50) PRIMARY KEY,
+    customer_id VARCHAR(50),
+    device_type VARCHAR(20),
+    browser VARCHAR(50),
+    items TEXT NOT NULL, -- JSON: product_id -> {quantity, added_at}
+    last_event_at DATETIME NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_last_event_at (last_event_at)
+);
+
+-- Partition leases of the pipeline workers (ETL_PARTITIONS > 1). The fencing
+-- token increases on every claim and is checked when each batch commits
+CREATE TABLE etl_leases (
+    lease_name VARCHAR(100) PRIMARY KEY, -- e.g. 'staging_orders#3/8'
+    owner VARCHAR(100),
+    fencing_token BIGINT NOT NULL DEFAULT 0,
+    expires_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Worker heartbeats, used to split partitions evenly across live workers
+CREATE TABLE etl_workers (
+    worker_id VARCHAR(100) PRIMARY KEY,
+    heartbeat_at TIMESTAMP NOT NULL
+);
+
+-- Date partitions of scripts/backfill.py runs, so a crashed backfill resumes
+-- where it stopped. The watermark bounds the run to rows the pipeline had passed
+CREATE TABLE etl_backfill_progress (
+    backfill_id VARCHAR(100) NOT NULL,
+    source VARCHAR(50) NOT NULL, -- 'orders', 'events'
+    partition_start DATE NOT NULL,
+    partition_end DATE NOT NULL, -- exclusive
+    status VARCHAR(20) NOT NULL, -- 'pending', 'running', 'done', 'failed'
+    rows_loaded INT NOT NULL DEFAULT 0,
+    last_created_at TIMESTAMP NULL,
+    last_id VARCHAR(50),
+    resume_at DATETIME NULL, -- date column and key of the last committed staging row
+    resume_key VARCHAR(50),
+    started_at TIMESTAMP NULL,
+    finished_at TIMESTAMP NULL,
+    PRIMARY KEY (backfill_id, source, partition_start)
+);
+
+-- Staging rows the ETL could not load: rows that failed alone after bisecting their
+-- batch, rows the transform rejected and rows whose dimension keys did not resolve.
+-- scripts/replay_dead_letters.py loads them again
+CREATE TABLE etl_dead_letter (
+    dead_letter_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    source_name VARCHAR(100) NOT NULL, -- staging table, or one hash partition of it
+    source_table VARCHAR(50) NOT NULL,
+    row_id VARCHAR(50), -- staging primary key, NULL for an abandoned cart line
+    stage VARCHAR(20) NOT NULL, -- 'transform', 'resolve' or 'load'
+    error_type VARCHAR(100),
+    error_message TEXT,
+    raw_row JSON NOT NULL, -- the staging row (or cart line), datetimes and decimals tagged so replay restores their types
+    status VARCHAR(20) NOT NULL DEFAULT 'pending', -- 'pending' or 'replayed'
+    attempts INT NOT NULL DEFAULT 0, -- failed replays
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    replayed_at TIMESTAMP NULL,
+    INDEX idx_status_source_table (status, source_table)
+);
+
 -- ============================================
 -- Populate Date Dimension (2020-2030)
 -- Note: Date dimension is populated by Python script in mysql_setup.py
@@ -0,0 +1,132 @@
+"""
+Adaptive batch sizing and poll interval
+Batch sizes follow observed throughput toward a target per-batch latency; the poll interval follows the backlog
+"""
+from utils.metrics import metrics
+from config.config import ETL_CONFIG
+import logging
+import os
+import threading
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Weight of the newest observation in the smoothed throughput
+SMOOTHING = 0.3
+# Largest change of a batch size in one step, either way
+MAX_STEP = 2.0
+
+
+def current_rss_bytes():
+    """Resident memory of this process, or None where it cannot be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        # Peak rather than current, but the best portable figure; kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+    except (ImportError, AttributeError, OSError):
+        return None
+
+
+class AdaptiveBatchController:
+    """Size each source's batches so one batch takes about target_batch_seconds
+
+    Every committed batch reports its row count and processing time. The
+    smoothed rows/second of a source times the target latency becomes its next
+    batch size, moving at most MAX_STEP-fold per batch and kept within bounds.
+    Only full batches move the size, since a short one just drained the source;
+    sizes halve while the process is over its memory limit.
+
+    The poll interval between cycles halves after a cycle that found a backlog
+    (a full batch) and grows by half after an idle one.
+    """
+
+    def __init__(self, initial_batch_size=None, min_batch_size=None, max_batch_size=None,
+                 target_batch_seconds=None, max_memory_mb=None,
+                 poll_interval=None, min_poll_interval=None, max_poll_interval=None):
+        self.initial_batch_size = initial_batch_size or ETL_CONFIG['batch_size']
+        self.min_batch_size = min_batch_size or ETL_CONFIG['min_batch_size']
+        self.max_batch_size = max_batch_size or ETL_CONFIG['max_batch_size']
+        self.target_batch_seconds = target_batch_seconds or ETL_CONFIG['target_batch_seconds']
+        max_memory_mb = ETL_CONFIG['max_memory_mb'] if max_memory_mb is None else max_memory_mb
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+        self.poll_interval = poll_interval or ETL_CONFIG['sleep_interval']
+        self.min_poll_interval = min_poll_interval or ETL_CONFIG['min_sleep_interval']
+        self.max_poll_interval = max_poll_interval or ETL_CONFIG['max_sleep_interval']
+
+        # Extract and load threads of the staged runner report concurrently
+        self.lock = threading.Lock()
+        self.batch_sizes = {}  # source name -> rows per batch
+        self.throughput = {}  # source name -> smoothed rows/second
+        self.cycle_rows = 0
+        self.cycle_backlog = False
+
+    def clamp(self, size):
+        return int(max(self.min_batch_size, min(self.max_batch_size, size)))
+
+    def batch_size(self, source_name):
+        """Rows to extract in a source's next batch"""
+        with self.lock:
+            return self.batch_sizes.setdefault(source_name, self.clamp(self.initial_batch_size))
+
+    def batch_sizer(self, source_name):
+        """Callable giving a source's current batch size, for extractors that ask once per page"""
+        return lambda: self.batch_size(source_name)
+
+    def over_memory_limit(self):
+        if not self.max_memory_bytes:
+            return False
+        rss = current_rss_bytes()
+        return rss is not None and rss > self.max_memory_bytes
+
+    def observe(self, source_name, rows, seconds):
+        """Record one processed batch and resize the source's next batch"""
+        if rows <= 0:
+            return
+        over_memory = self.over_memory_limit()
+        with self.lock:
+            current = self.batch_sizes.setdefault(source_name, self.clamp(self.initial_batch_size))
+            full = rows >= current
+            self.cycle_rows += rows
+            self.cycle_backlog = self.cycle_backlog or full
+
+            if over_memory:
+                target = current / 2
+            elif not full:
+                # A short batch drained the source; fixed per-batch costs dominate
+                # its rate, so it says nothing about full batches
+                target = current
+            else:
+                rate = rows / max(seconds, 1e-3)
+                previous = self.throughput.get(source_name)
+                rate = rate if previous is None else SMOOTHING * rate + (1 - SMOOTHING) * previous
+                self.throughput[source_name] = rate
+                target = rate * self.target_batch_seconds
+            target = max(current / MAX_STEP, min(current * MAX_STEP, target))
+            size = self.clamp(target)
+            self.batch_sizes[source_name] = size
+
+        if size != current:
+            logger.info(f"Batch size of {source_name}: {current} -> {size} rows")
+        metrics.set_gauge('etl_batch_size', size, source=source_name)
+
+    def end_cycle(self):
+        """Close a pipeline cycle; returns the seconds to wait before the next one"""
+        with self.lock:
+            if self.cycle_backlog:
+                interval = self.poll_interval / 2
+            elif self.cycle_rows == 0:
+                interval = self.poll_interval * 1.5
+            else:
+                interval = self.poll_interval
+            self.poll_interval = max(self.min_poll_interval, min(self.max_poll_interval, interval))
+            self.cycle_rows = 0
+            self.cycle_backlog = False
+            interval = self.poll_interval
+        metrics.set_gauge('etl_poll_interval_seconds', interval)
+        return interval
@@ -0,0 +1,143 @@
+"""
+Durable per-source checkpoints (high-water marks) for incremental extraction
+"""
+from etl.coordination import parse_source_name, partition_filter, table_source_names
+from etl.extract import STAGING_TABLES
+from config.config import ETL_CONFIG
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Named lock so only one of several starting workers migrates a table's checkpoints
+MIGRATION_LOCK = 'etl_checkpoint_migration'
+
+
+class CheckpointStore:
+    """Persist extraction watermarks in the etl_checkpoints table"""
+
+    def __init__(self, mysql):
+        # Share the loader's connector so a checkpoint commits in the same
+        # transaction as the batch it describes
+        self.mysql = mysql
+
+    def load_all(self):
+        """Load every stored watermark as {source_name: (created_at, last_id)}
+
+        Errors are raised: reading no checkpoints would restart every source
+        from the beginning and load its rows again.
+        """
+        query = "SELECT source_name, last_created_at, last_id FROM etl_checkpoints"
+        results = self.mysql.execute_query(query)
+
+        return {
+            row['source_name']: (row['last_created_at'], row['last_id'])
+            for row in results
+            if row['last_created_at'] is not None
+        }
+
+    def lowest(self, table, partition_count=None):
+        """Lowest watermark among a staging table's sources, or None while any of them has none
+
+        The sources are the table, or every partition of the configured
+        partition count, whether or not a checkpoint exists for it yet: a
+        partition that never committed a batch has loaded nothing. Every row of
+        the table at or below the result has been loaded, whichever partition
+        it hashes to.
+        """
+        watermarks = self.load_all()
+        source_names = table_source_names(table, partition_count or ETL_CONFIG['partition_count'])
+        if any(source_name not in watermarks for source_name in source_names):
+            return None
+        return min(watermarks[source_name] for source_name in source_names)
+
+    def has_rows_between(self, source_name, low, high):
+        """Whether a source (table or partition) has staged rows after watermark low, up to and including high"""
+        table, partition = parse_source_name(source_name)
+        key_column = STAGING_TABLES[table]
+        partition_condition, partition_params = partition_filter(table, partition)
+        result = self.mysql.execute_query(
+            f"""
+            SELECT 1 AS found FROM {table}
+            WHERE (created_at > %s OR (created_at = %s AND {key_column} > %s))
+              AND (created_at < %s OR (created_at = %s AND {key_column} <= %s))
+              AND {partition_condition}
+            LIMIT 1
+            """,
+            (low[0], low[0], low[1], high[0], high[0], high[1]) + partition_params
+        )
+        return bool(result)
+
+    def migrate(self, table, source_names):
+        """Carry a table's checkpoints over to source_names after the partition count changed
+
+        Partitions are named by their count ('staging_orders#3/8'), so other
+        checkpoints of the table belong to an earlier layout. They pin down
+        which rows are loaded only if no old source has rows left below the
+        highest of them, e.g. after the pipeline drained; then every new source
+        starts there and the old checkpoints are deleted, in one transaction.
+        Otherwise raises RuntimeError rather than load rows twice or skip them.
+        """
+        acquired = self.mysql.execute_query("SELECT GET_LOCK(%s, 30) AS acquired", (MIGRATION_LOCK,))
+        if not acquired or acquired[0]['acquired'] != 1:
+            raise RuntimeError(f"Timed out waiting for another worker to migrate the {table} checkpoints")
+        try:
+            watermarks = {
+                source_name: watermark for source_name, watermark in self.load_all().items()
+                if parse_source_name(source_name)[0] == table
+            }
+            old = {name: watermark for name, watermark in watermarks.items() if name not in source_names}
+            if not old:
+                return False
+
+            position = max(old.values())
+            behind = [
+                name for name, watermark in watermarks.items()
+                if watermark < position and self.has_rows_between(name, watermark, position)
+            ]
+            if behind:
+                raise RuntimeError(
+                    f"Cannot change the partitioning of {table}: rows below {position} are still unloaded in "
+                    f"{', '.join(sorted(behind))}. Stop every worker, drain the table with the previous "
+                    f"ETL_PARTITIONS, then restart with the new value."
+                )
+
+            with self.mysql.transaction():
+                for source_name in source_names:
+                    if source_name not in watermarks or watermarks[source_name] < position:
+                        self.save(source_name, position)
+                for source_name in old:
+                    self.reset(source_name)
+            logger.info(f"Moved {len(old)} {table} checkpoints to {len(source_names)} sources at {position}")
+            return True
+        finally:
+            self.mysql.execute_query("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+
+    def load(self, source_name):
+        """Load the watermark for one source, or None if it has never run"""
+        query = """
+        SELECT last_created_at, last_id FROM etl_checkpoints
+        WHERE source_name = %s
+        """
+        result = self.mysql.execute_query(query, (source_name,))
+        if result and result[0]['last_created_at'] is not None:
+            return (result[0]['last_created_at'], result[0]['last_id'])
+        return None
+
+    def save(self, source_name, watermark):
+        """Store a watermark; call inside the batch's transaction to commit them together"""
+        last_created_at, last_id = watermark
+        query = """
+        INSERT INTO etl_checkpoints (source_name, last_created_at, last_id)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            last_created_at = VALUES(last_created_at),
+            last_id = VALUES(last_id)
+        """
+        self.mysql.execute_query(query, (source_name, last_created_at, last_id))
+
+    def reset(self, source_name):
+        """Forget a source's watermark so the next run starts from the beginning"""
+        self.mysql.execute_query(
+            "DELETE FROM etl_checkpoints WHERE source_name = %s", (source_name,)
+        )
@@ -0,0 +1,201 @@
+"""
+Coordination of several pipeline workers over hash partitions of the staging tables
+Workers claim partitions through leases in MySQL; each partition has its own checkpoint
+"""
+from utils.database_connector import MySQLConnector
+from config.config import ETL_CONFIG
+import logging
+import math
+import os
+import random
+import socket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Staging table -> column hashed into partitions. Clicks go by session so a cart
+# never spans workers; events go by customer so activity counters don't contend.
+PARTITION_COLUMNS = {
+    'staging_orders': 'order_id',
+    'staging_clicks': 'session_id',
+    'staging_customer_events': 'customer_id',
+}
+
+
+def partition_source_name(table, index, count):
+    """Checkpoint and lease name of one partition, e.g. 'staging_orders#3/8'"""
+    return f"{table}#{index}/{count}"
+
+
+def table_source_names(table, count):
+    """Every source of a staging table under a partition count: the table itself, or its partitions"""
+    if count <= 1:
+        return [table]
+    return [partition_source_name(table, index, count) for index in range(count)]
+
+
+def parse_source_name(source_name):
+    """Split a source name into (table, partition) where partition is (index, count) or None"""
+    if '#' not in source_name:
+        return source_name, None
+    table, partition = source_name.split('#', 1)
+    index, count = partition.split('/')
+    return table, (int(index), int(count))
+
+
+def partition_filter(table, partition, column=None):
+    """SQL condition and params selecting one partition's rows (an always-true condition for None)"""
+    if partition is None:
+        return "1 = 1", ()
+    index, count = partition
+    column = column or PARTITION_COLUMNS[table]
+    return f"MOD(CRC32(COALESCE({column}, '')), %s) = %s", (count, index)
+
+
+class LeaseLostError(Exception):
+    """Raised when a worker tries to commit for a partition it no longer holds"""
+
+
+class LeaseManager:
+    """Claim, renew and release partition leases in the etl_leases table
+
+    Every worker heartbeats into etl_workers and aims for an equal share of
+    each table's partitions: it claims free or expired leases up to its share
+    and hands back any surplus, so partitions rebalance as workers come and go.
+    Each claim bumps the lease's fencing token; commits call verify() inside
+    their transaction, so a worker whose lease expired can never commit over
+    the new owner.
+    """
+
+    def __init__(self, worker_id=None, lease_seconds=None):
+        self.mysql = MySQLConnector()
+        self.worker_id = worker_id or ETL_CONFIG['worker_id'] or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds or ETL_CONFIG['lease_seconds']
+        self.owned = {}  # lease name -> fencing token
+
+    def heartbeat(self):
+        """Record that this worker is alive"""
+        self.mysql.execute_query(
+            """
+            INSERT INTO etl_workers (worker_id, heartbeat_at) VALUES (%s, NOW())
+            ON DUPLICATE KEY UPDATE heartbeat_at = NOW()
+            """,
+            (self.worker_id,)
+        )
+
+    def live_workers(self):
+        """Workers that heartbeat within the lease period, this one included"""
+        result = self.mysql.execute_query(
+            "SELECT COUNT(*) AS workers FROM etl_workers WHERE heartbeat_at > NOW() - INTERVAL %s SECOND",
+            (self.lease_seconds,)
+        )
+        return max(1, result[0]['workers'])
+
+    def renew(self, lease_name):
+        """Extend a held lease; forgets it and returns False if it was lost"""
+        renewed = self.mysql.execute_update(
+            """
+            UPDATE etl_leases SET expires_at = NOW() + INTERVAL %s SECOND
+            WHERE lease_name = %s AND owner = %s AND fencing_token = %s AND expires_at > NOW()
+            """,
+            (self.lease_seconds, lease_name, self.worker_id, self.owned[lease_name])
+        )
+        if not renewed:
+            # A same-second renewal changes nothing, so double-check before giving up
+            renewed = self.holds(lease_name, self.mysql)
+        if not renewed:
+            logger.warning(f"Lost lease on {lease_name}")
+            del self.owned[lease_name]
+        return bool(renewed)
+
+    def claim(self, lease_name):
+        """Take a free or expired lease; returns True if this worker now holds it"""
+        self.mysql.execute_query(
+            "INSERT IGNORE INTO etl_leases (lease_name, expires_at) VALUES (%s, NOW())",
+            (lease_name,)
+        )
+        claimed = self.mysql.execute_update(
+            """
+            UPDATE etl_leases
+            SET owner = %s, fencing_token = fencing_token + 1, expires_at = NOW() + INTERVAL %s SECOND
+            WHERE lease_name = %s AND (owner IS NULL OR expires_at <= NOW())
+            """,
+            (self.worker_id, self.lease_seconds, lease_name)
+        )
+        if not claimed:
+            return False
+        result = self.mysql.execute_query(
+            "SELECT fencing_token FROM etl_leases WHERE lease_name = %s AND owner = %s",
+            (lease_name, self.worker_id)
+        )
+        if not result:
+            return False
+        self.owned[lease_name] = result[0]['fencing_token']
+        logger.info(f"Worker {self.worker_id} claimed {lease_name}")
+        return True
+
+    def release(self, lease_name):
+        """Hand a lease back so another worker can claim it straight away"""
+        self.mysql.execute_query(
+            """
+            UPDATE etl_leases SET owner = NULL, expires_at = NOW()
+            WHERE lease_name = %s AND owner = %s AND fencing_token = %s
+            """,
+            (lease_name, self.worker_id, self.owned.pop(lease_name))
+        )
+        logger.info(f"Worker {self.worker_id} released {lease_name}")
+
+    def rebalance(self, lease_names):
+        """Renew, shed surplus and claim leases among one table's partitions; returns the names held"""
+        lease_names = list(lease_names)
+        self.heartbeat()
+        share = math.ceil(len(lease_names) / self.live_workers())
+
+        held = [name for name in lease_names if name in self.owned and self.renew(name)]
+        for name in held[share:]:
+            self.release(name)
+        held = held[:share]
+
+        # Random order so workers starting together don't all race for the same partitions
+        candidates = [name for name in lease_names if name not in self.owned]
+        random.shuffle(candidates)
+        for name in candidates:
+            if len(held) >= share:
+                break
+            if self.claim(name):
+                held.append(name)
+        return held
+
+    def holds(self, lease_name, mysql):
+        """Whether this worker holds an unexpired lease, locking the lease row until mysql's transaction ends"""
+        token = self.owned.get(lease_name)
+        if token is None:
+            return False
+        result = mysql.execute_query(
+            """
+            SELECT 1 FROM etl_leases
+            WHERE lease_name = %s AND owner = %s AND fencing_token = %s AND expires_at > NOW()
+            FOR UPDATE
+            """,
+            (lease_name, self.worker_id, token)
+        )
+        return bool(result)
+
+    def verify(self, lease_name, mysql):
+        """Fence a commit: call inside the batch's transaction; raises LeaseLostError if the lease is gone"""
+        if not self.holds(lease_name, mysql):
+            raise LeaseLostError(f"Worker {self.worker_id} no longer holds {lease_name}")
+        # The row lock taken above keeps the lease ours until the batch commits; extend it meanwhile
+        mysql.execute_query(
+            "UPDATE etl_leases SET expires_at = NOW() + INTERVAL %s SECOND WHERE lease_name = %s",
+            (self.lease_seconds, lease_name)
+        )
+
+    def release_all(self):
+        """Release every held lease, e.g. on shutdown"""
+        for lease_name in list(self.owned):
+            try:
+                self.release(lease_name)
+            except Exception as e:
+                logger.error(f"Failed to release {lease_name}: {e}")
+        self.mysql.close()
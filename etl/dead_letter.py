@@ -0,0 +1,168 @@
+"""
+Dead letters: staging rows the ETL could not load
+Kept in etl_dead_letter with the stage and error that rejected them, or in a local JSONL file if the table is unreachable
+"""
+from etl.coordination import parse_source_name
+from etl.extract import STAGING_TABLES
+from utils.metrics import metrics
+from config.config import ETL_CONFIG
+from datetime import date, datetime
+from decimal import Decimal
+import json
+import logging
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def encode_value(value):
+    """JSON-safe form of a staging value that decode_value turns back into the same type"""
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and len(value) == 1:
+        tag, text = next(iter(value.items()))
+        if tag == '$datetime':
+            return datetime.fromisoformat(text)
+        if tag == '$date':
+            return date.fromisoformat(text)
+        if tag == '$decimal':
+            return Decimal(text)
+    return value
+
+
+def encode_row(row):
+    return json.dumps({column: encode_value(value) for column, value in row.items()})
+
+
+def decode_row(text):
+    return {column: decode_value(value) for column, value in json.loads(text).items()}
+
+
+class RejectedRow(Exception):
+    """Error recorded for a row a stage filtered out as invalid, rather than one that raised"""
+
+
+class DeadLetterStore:
+    """Record and fetch dead-lettered staging rows"""
+
+    INSERT = """
+    INSERT INTO etl_dead_letter
+    (source_name, source_table, row_id, stage, error_type, error_message, raw_row)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """
+
+    def __init__(self, mysql, fallback_file=None):
+        # Share the loader's connector so dead letters commit with the batch that skipped them
+        self.mysql = mysql
+        self.fallback_file = fallback_file or ETL_CONFIG['dead_letter_file']
+
+    @staticmethod
+    def entry(source_name, row, stage, error):
+        """Dead letter of one row as a dict"""
+        table, _ = parse_source_name(source_name)
+        row_id = row.get(STAGING_TABLES.get(table, ''))
+        return {
+            'source_name': source_name,
+            'source_table': table,
+            'row_id': None if row_id is None else str(row_id),
+            'stage': stage,
+            'error_type': type(error).__name__,
+            'error_message': str(error)[:2000],
+            'raw_row': encode_row(row),
+        }
+
+    @staticmethod
+    def params(entry):
+        return (
+            entry['source_name'], entry['source_table'], entry['row_id'], entry['stage'],
+            entry['error_type'], entry['error_message'], entry['raw_row']
+        )
+
+    def record(self, source_name, failures):
+        """Store (row, stage, error) failures of a source; call inside the batch's transaction
+
+        Returns the entries that could not be written to the table; write them
+        with write_fallback() once the transaction has committed, so a rolled
+        back batch leaves nothing behind in the file.
+        """
+        if not failures:
+            return []
+        entries = [self.entry(source_name, row, stage, error) for row, stage, error in failures]
+        for entry in entries:
+            logger.warning(
+                f"Dead-lettered {entry['source_table']} row {entry['row_id']} at {entry['stage']}: {entry['error_message']}"
+            )
+        try:
+            self.mysql.execute_many(self.INSERT, [self.params(entry) for entry in entries])
+        except Exception as e:
+            logger.error(f"Failed to store dead letters, keeping them for {self.fallback_file}: {e}")
+            return entries
+        finally:
+            metrics.inc('etl_dead_letter_rows_total', len(entries), source=parse_source_name(source_name)[0])
+        return []
+
+    def write_fallback(self, entries):
+        """Append dead letters to the local JSONL file"""
+        if not entries:
+            return
+        directory = os.path.dirname(self.fallback_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.fallback_file, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(dict(entry, created_at=datetime.now().isoformat())) + '\n')
+        logger.warning(f"Wrote {len(entries)} dead letters to {self.fallback_file}")
+
+    def pending(self, source_table=None, dead_letter_ids=None, limit=1000):
+        """Dead letters not yet replayed, oldest first"""
+        conditions = ["status = 'pending'"]
+        params = []
+        if source_table:
+            conditions.append("source_table = %s")
+            params.append(source_table)
+        if dead_letter_ids:
+            conditions.append(f"dead_letter_id IN ({', '.join(['%s'] * len(dead_letter_ids))})")
+            params.extend(dead_letter_ids)
+        params.append(limit)
+        return self.mysql.execute_query(
+            f"""
+            SELECT dead_letter_id, source_name, source_table, row_id, stage, raw_row FROM etl_dead_letter
+            WHERE {' AND '.join(conditions)}
+            ORDER BY dead_letter_id
+            LIMIT %s
+            """,
+            tuple(params)
+        )
+
+    def mark_replayed(self, dead_letter_ids):
+        """Flag dead letters whose rows have now loaded"""
+        if dead_letter_ids:
+            self.mysql.execute_query(
+                f"""
+                UPDATE etl_dead_letter SET status = 'replayed', replayed_at = NOW()
+                WHERE dead_letter_id IN ({', '.join(['%s'] * len(dead_letter_ids))})
+                """,
+                tuple(dead_letter_ids)
+            )
+
+    def mark_failed_again(self, dead_letter_id, stage, error):
+        """Record another failed replay of a dead letter"""
+        self.mysql.execute_query(
+            """
+            UPDATE etl_dead_letter
+            SET attempts = attempts + 1, stage = %s, error_type = %s, error_message = %s
+            WHERE dead_letter_id = %s
+            """,
+            (stage, type(error).__name__, str(error)[:2000], dead_letter_id)
+        )
@@ -0,0 +1,98 @@
+"""
+Batch enrichment of dimension rows from staged source attributes
+"""
+from etl.load import DimensionKeyCache
+from config.config import ETL_CONFIG
+import logging
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CustomerEnricher:
+    """Resolve dim_customer attributes from staging_customers, one IN query per batch behind an LRU cache
+
+    Cached attributes expire after ttl_seconds, so updates to staging_customers
+    reach dim_customer the next time the customer is seen after that.
+    """
+
+    def __init__(self, cache_size=None, ttl_seconds=None):
+        self.cache = DimensionKeyCache('staging_customers', cache_size or ETL_CONFIG['customer_attribute_cache_size'])
+        self.ttl = ttl_seconds if ttl_seconds is not None else ETL_CONFIG['customer_attribute_cache_seconds']
+        # Shared by the staged runner's load workers
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def placeholder(customer_id):
+        """dim_customer row for a customer with no staged attributes, only ever inserted (see Loader.upsert_customers)"""
+        return {
+            "placeholder": True,
+            "customer_id": customer_id,
+            "customer_name": f"Customer {customer_id}",
+            "email": f"{customer_id}@example.com",
+            "age": None,
+            "gender": None,
+            "registration_date": None,
+            "customer_segment": "Standard"
+        }
+
+    @staticmethod
+    def customer_row(staged):
+        """dim_customer row built from a staging_customers row"""
+        return {
+            "customer_id": staged['customer_id'],
+            "customer_name": staged['customer_name'] or f"Customer {staged['customer_id']}",
+            "email": staged['email'] or f"{staged['customer_id']}@example.com",
+            "age": staged['age'],
+            "gender": staged['gender'],
+            "registration_date": staged['registration_date'],
+            "customer_segment": "Standard"
+        }
+
+    def enrich(self, customer_ids, loader):
+        """dim_customer rows for a batch of customer ids as {customer_id: row}"""
+        rows = {}
+        missing = []
+        now = time.monotonic()
+        with self.lock:
+            for customer_id in customer_ids:
+                if customer_id in rows:
+                    continue
+                # Entries are (expires_at, row); an expired one is looked up again
+                cached = self.cache.get(customer_id)
+                if cached is not None and cached[0] > now:
+                    rows[customer_id] = cached[1]
+                else:
+                    missing.append(customer_id)
+
+        if missing:
+            try:
+                results = loader.select_in(
+                    """
+                    SELECT customer_id, customer_name, email, age, gender, registration_date
+                    FROM staging_customers WHERE customer_id IN ({placeholders})
+                    """,
+                    missing
+                )
+            except Exception as e:
+                # Placeholders here would stand in for customers that do have attributes; fail the batch instead
+                logger.error(f"Failed to look up staged customers: {e}")
+                raise
+
+            with self.lock:
+                for staged in results:
+                    rows[staged['customer_id']] = self.customer_row(staged)
+                    self.cache.put(staged['customer_id'], (now + self.ttl, rows[staged['customer_id']]))
+
+        # Customers without staged attributes are not cached, so they resolve once they arrive
+        for customer_id in missing:
+            if customer_id not in rows:
+                rows[customer_id] = self.placeholder(customer_id)
+        return rows
+
+    def clear(self):
+        """Drop all cached attributes"""
+        with self.lock:
+            self.cache.clear()
@@ -2,100 +2,212 @@
 Extract data from staging tables
 """
 from utils.database_connector import MySQLConnector
+from utils.metrics import metrics
+from config.config import ETL_CONFIG
+from etl.coordination import partition_filter
 import logging
-from datetime import datetime, timedelta
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Staging table -> primary key used as the keyset tie-breaker
+STAGING_TABLES = {
+    'staging_orders': 'order_id',
+    'staging_clicks': 'click_id',
+    'staging_customer_events': 'event_id',
+}
+
 
 class Extractor:
     """Extract data from staging tables"""
-    
+
     def __init__(self):
         self.mysql = MySQLConnector()
         self.mysql.connect()
-    
-    def extract_orders(self, last_run_time=None, limit=1000):
-        """Extract orders from staging table"""
+
+    @staticmethod
+    def get_watermark(table, rows):
+        """Get the (created_at, primary key) watermark of the last row in a batch"""
+        if not rows:
+            return None
+        last_row = rows[-1]
+        return (last_row['created_at'], last_row[STAGING_TABLES[table]])
+
+    def settled_before(self):
+        """created_at bound below which no more rows can be staged
+
+        created_at has whole seconds and staging ids are random, so a row
+        arriving later in a second already read can sort below the watermark's
+        id and would be skipped for good. Only seconds that ended at least
+        extract_settle_seconds ago (by the database clock) are read.
+        """
+        return self.mysql.execute_query(
+            "SELECT NOW() - INTERVAL %s SECOND AS settled_before", (ETL_CONFIG['extract_settle_seconds'],)
+        )[0]['settled_before']
+
+    def extract_batch(self, table, watermark=None, limit=1000, partition=None, settled_before=None):
+        """Extract one keyset page of settled rows strictly after the watermark (of one hash partition if given)
+
+        Errors are raised: an empty page means the source has caught up.
+        """
+        key_column = STAGING_TABLES[table]
+        partition_condition, partition_params = partition_filter(table, partition)
         try:
-            if last_run_time:
-                query = """
-                SELECT * FROM staging_orders 
-                WHERE created_at > %s 
-                ORDER BY created_at ASC
+            if settled_before is None:
+                settled_before = self.settled_before()
+            if watermark:
+                last_created_at, last_id = watermark
+                # Expanded row comparison so MySQL can range-scan (created_at, key)
+                query = f"""
+                SELECT * FROM {table}
+                WHERE (created_at > %s
+                   OR (created_at = %s AND {key_column} > %s))
+                  AND created_at < %s
+                  AND {partition_condition}
+                ORDER BY created_at ASC, {key_column} ASC
                 LIMIT %s
                 """
-                params = (last_run_time, limit)
+                params = (last_created_at, last_created_at, last_id, settled_before) + partition_params + (limit,)
             else:
-                query = """
-                SELECT * FROM staging_orders 
-                ORDER BY created_at ASC
+                query = f"""
+                SELECT * FROM {table}
+                WHERE created_at < %s
+                  AND {partition_condition}
+                ORDER BY created_at ASC, {key_column} ASC
                 LIMIT %s
                 """
-                params = (limit,)
-            
-            results = self.mysql.execute_query(query, params)
-            logger.info(f"Extracted {len(results)} orders")
-            return results
+                params = (settled_before,) + partition_params + (limit,)
+
+            with metrics.track_stage('extract', table) as tracker:
+                rows = self.mysql.execute_query(query, params)
+                tracker['rows'] = len(rows)
+            return rows
         except Exception as e:
-            logger.error(f"Failed to extract orders: {e}")
-            return []
-    
-    def extract_clicks(self, last_run_time=None, limit=1000):
+            logger.error(f"Failed to extract from {table}: {e}")
+            metrics.inc('etl_errors_total', stage='extract', table=table)
+            raise
+
+    def drop_duplicate_ids(self, table, rows):
+        """Drop rows whose id was staged before under an earlier created_at
+
+        Partitioned staging tables can only enforce (id, created_at) as unique,
+        so an id the generator reuses is staged again instead of being rejected.
+        The first row with an id wins, as it did when the id alone was the key.
+        """
+        if not rows:
+            return rows
+        key_column = STAGING_TABLES[table]
+        ids = list({row[key_column] for row in rows})
+        results = self.mysql.execute_query(
+            f"""
+            SELECT {key_column} AS id, MIN(created_at) AS first_created_at FROM {table}
+            WHERE {key_column} IN ({', '.join(['%s'] * len(ids))})
+            GROUP BY {key_column}
+            """,
+            tuple(ids)
+        )
+        first_created_at = {row['id']: row['first_created_at'] for row in results}
+        kept = [row for row in rows if row['created_at'] <= first_created_at.get(row[key_column], row['created_at'])]
+        if len(kept) < len(rows):
+            logger.warning(f"Skipped {len(rows) - len(kept)} {table} rows with an already staged id")
+            metrics.inc('etl_rows_rejected_total', len(rows) - len(kept), stage='extract', table=table)
+        return kept
+
+    def iter_batches(self, table, watermark=None, batch_size=1000, partition=None):
+        """Walk a staging table in keyset pages until caught up, yielding (rows, watermark)
+
+        batch_size may be a callable, asked again before every page so an
+        adaptive controller can resize the pages of a long drain.
+        """
+        # One bound for the whole drain; rows after it are read by the next run
+        settled_before = self.settled_before()
+        while True:
+            limit = batch_size() if callable(batch_size) else batch_size
+            rows = self.extract_batch(table, watermark, limit=limit, partition=partition, settled_before=settled_before)
+            if not rows:
+                return
+
+            watermark = self.get_watermark(table, rows)
+            logger.info(f"Extracted {len(rows)} rows from {table}")
+            # The watermark still covers dropped duplicates, so they are not extracted again
+            yield self.drop_duplicate_ids(table, rows), watermark
+
+            # A short page means we have reached the end of the table
+            if len(rows) < limit:
+                return
+
+    def stream_batches(self, table, watermark=None, batch_size=1000, partition=None):
+        """Stream everything after the watermark with one server-side cursor query, yielding (rows, watermark)
+
+        Same contract as iter_batches, but without a query per page; meant for
+        large backfills where the backlog is far bigger than one batch.
+        """
+        key_column = STAGING_TABLES[table]
+        partition_condition, partition_params = partition_filter(table, partition)
+        # One cursor, so one chunk size for the whole stream
+        batch_size = batch_size() if callable(batch_size) else batch_size
+        settled_before = self.settled_before()
+        if watermark:
+            last_created_at, last_id = watermark
+            query = f"""
+            SELECT * FROM {table}
+            WHERE (created_at > %s
+               OR (created_at = %s AND {key_column} > %s))
+              AND created_at < %s
+              AND {partition_condition}
+            ORDER BY created_at ASC, {key_column} ASC
+            """
+            params = (last_created_at, last_created_at, last_id, settled_before) + partition_params
+        else:
+            query = f"""
+            SELECT * FROM {table}
+            WHERE created_at < %s
+              AND {partition_condition}
+            ORDER BY created_at ASC, {key_column} ASC
+            """
+            params = (settled_before,) + partition_params
+
+        for rows in self.mysql.stream_query(query, params, chunk_size=batch_size):
+            metrics.inc('etl_rows_total', len(rows), stage='extract', table=table)
+            logger.info(f"Streamed {len(rows)} rows from {table}")
+            yield self.drop_duplicate_ids(table, rows), self.get_watermark(table, rows)
+
+    def batches(self, table, watermark=None, batch_size=1000, partition=None):
+        """Batches after the watermark, via keyset pages or one streamed query per ETL_CONFIG"""
+        if ETL_CONFIG['streaming_extract']:
+            return self.stream_batches(table, watermark, batch_size, partition)
+        return self.iter_batches(table, watermark, batch_size, partition)
+
+    def extract_orders(self, watermark=None, limit=1000):
+        """Extract orders from staging table"""
+        results = self.extract_batch('staging_orders', watermark, limit)
+        logger.info(f"Extracted {len(results)} orders")
+        return results
+
+    def extract_clicks(self, watermark=None, limit=1000):
         """Extract clicks from staging table"""
-        try:
-            if last_run_time:
-                query = """
-                SELECT * FROM staging_clicks 
-                WHERE created_at > %s 
-                ORDER BY created_at ASC
-                LIMIT %s
-                """
-                params = (last_run_time, limit)
-            else:
-                query = """
-                SELECT * FROM staging_clicks 
-                ORDER BY created_at ASC
-                LIMIT %s
-                """
-                params = (limit,)
-            
-            results = self.mysql.execute_query(query, params)
-            logger.info(f"Extracted {len(results)} clicks")
-            return results
-        except Exception as e:
-            logger.error(f"Failed to extract clicks: {e}")
-            return []
-    
-    def extract_customer_events(self, last_run_time=None, limit=1000):
+        results = self.extract_batch('staging_clicks', watermark, limit)
+        logger.info(f"Extracted {len(results)} clicks")
+        return results
+
+    def extract_customer_events(self, watermark=None, limit=1000):
         """Extract customer events from staging table"""
-        try:
-            if last_run_time:
-                query = """
-                SELECT * FROM staging_customer_events 
-                WHERE created_at > %s 
-                ORDER BY created_at ASC
-                LIMIT %s
-                """
-                params = (last_run_time, limit)
-            else:
-                query = """
-                SELECT * FROM staging_customer_events 
-                ORDER BY created_at ASC
-                LIMIT %s
-                """
-                params = (limit,)
-            
-            results = self.mysql.execute_query(query, params)
-            logger.info(f"Extracted {len(results)} customer events")
-            return results
-        except Exception as e:
-            logger.error(f"Failed to extract customer events: {e}")
-            return []
-    
+        results = self.extract_batch('staging_customer_events', watermark, limit)
+        logger.info(f"Extracted {len(results)} customer events")
+        return results
+
+    def iter_orders(self, watermark=None, batch_size=1000):
+        """Stream order batches until the staging table is drained"""
+        return self.iter_batches('staging_orders', watermark, batch_size)
+
+    def iter_clicks(self, watermark=None, batch_size=1000):
+        """Stream click batches until the staging table is drained"""
+        return self.iter_batches('staging_clicks', watermark, batch_size)
+
+    def iter_customer_events(self, watermark=None, batch_size=1000):
+        """Stream customer event batches until the staging table is drained"""
+        return self.iter_batches('staging_customer_events', watermark, batch_size)
+
     def close(self):
         """Close database connection"""
         self.mysql.close()
-
-
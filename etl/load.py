@@ -2,113 +2,267 @@
 Load transformed data into data warehouse (star schema)
 """
 from utils.database_connector import MySQLConnector
+from config.config import ETL_CONFIG
+from utils.date_dimension import resolve_date_key
+from utils.hll import HyperLogLog
+from utils.metrics import metrics, statement_label
+import hashlib
 import logging
-from datetime import datetime
+from collections import OrderedDict
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def content_hash(values):
+    """Stable hash of a dimension row's attributes, used to skip writes that change nothing"""
+    canonical = '\x1f'.join('\\N' if value is None else str(value) for value in values)
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
+
+
+class DimensionKeyCache:
+    """Bounded LRU cache mapping a dimension's natural key to its surrogate key
+
+    Versioned dimensions cache (surrogate key, row hash) pairs instead.
+    """
+    
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, natural_key):
+        """Return the cached surrogate key, or None on a miss"""
+        surrogate_key = self.entries.get(natural_key)
+        if surrogate_key is None:
+            self.misses += 1
+            metrics.inc('etl_dimension_cache_lookups_total', cache=self.name, result='miss')
+            return None
+        self.entries.move_to_end(natural_key)
+        self.hits += 1
+        metrics.inc('etl_dimension_cache_lookups_total', cache=self.name, result='hit')
+        return surrogate_key
+    
+    def put(self, natural_key, surrogate_key):
+        """Cache a surrogate key, evicting the least recently used entry when full"""
+        if surrogate_key is None or self.max_size <= 0:
+            return
+        self.entries[natural_key] = surrogate_key
+        self.entries.move_to_end(natural_key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def clear(self):
+        """Drop all cached keys"""
+        self.entries.clear()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def hit_rate(self):
+        """Fraction of lookups served from the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+    
+    def stats(self):
+        """Cache counters as a dict"""
+        return {
+            'name': self.name,
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate()
+        }
+
+
 class Loader:
     """Load data into data warehouse"""
     
     def __init__(self):
         self.mysql = MySQLConnector()
         self.mysql.connect()
+        
+        self.customer_cache = DimensionKeyCache('dim_customer', ETL_CONFIG['customer_cache_size'])
+        self.product_cache = DimensionKeyCache('dim_product', ETL_CONFIG['product_cache_size'])
+        self.location_cache = DimensionKeyCache('dim_location', ETL_CONFIG['location_cache_size'])
+        if ETL_CONFIG['warm_dimension_caches']:
+            self.warm_caches()
     
-    def upsert_customer(self, customer_data):
-        """Insert or update customer dimension"""
+    @staticmethod
+    def location_natural_key(location_data):
+        """Natural key of a location row (NULL and empty postal codes are the same place)"""
+        return (
+            location_data['city'],
+            location_data['state'],
+            location_data['country'],
+            location_data.get('postal_code') or ''
+        )
+    
+    def warm_caches(self):
+        """Preload the most recently touched dimension keys into the caches"""
         try:
-            query = """
-            INSERT INTO dim_customer 
-            (customer_id, customer_name, email, age, gender, registration_date, customer_segment, is_active)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                customer_name = VALUES(customer_name),
-                email = VALUES(email),
-                age = VALUES(age),
-                gender = VALUES(gender),
-                customer_segment = VALUES(customer_segment),
-                updated_at = CURRENT_TIMESTAMP
-            """
-            params = (
-                customer_data['customer_id'],
-                customer_data['customer_name'],
-                customer_data['email'],
-                customer_data.get('age'),
-                customer_data.get('gender'),
-                customer_data.get('registration_date'),
-                customer_data.get('customer_segment', 'Standard'),
-                customer_data.get('is_active', True)
+            customers = self.mysql.execute_query(
+                "SELECT customer_id, customer_key, row_hash FROM dim_customer ORDER BY updated_at DESC LIMIT %s",
+                (self.customer_cache.max_size,)
             )
-            self.mysql.execute_query(query, params)
+            for row in reversed(customers):
+                self.customer_cache.put(row['customer_id'], (row['customer_key'], row['row_hash']))
             
-            # Get customer_key
-            get_key_query = "SELECT customer_key FROM dim_customer WHERE customer_id = %s"
-            result = self.mysql.execute_query(get_key_query, (customer_data['customer_id'],))
-            if result:
-                return result[0]['customer_key']
-            return None
+            products = self.mysql.execute_query(
+                "SELECT product_id, product_key, row_hash FROM dim_product ORDER BY updated_at DESC LIMIT %s",
+                (self.product_cache.max_size,)
+            )
+            for row in reversed(products):
+                self.product_cache.put(row['product_id'], (row['product_key'], row['row_hash']))
+            
+            locations = self.mysql.execute_query(
+                """
+                SELECT location_key, city, state, country, postal_code FROM dim_location
+                ORDER BY location_key DESC LIMIT %s
+                """,
+                (self.location_cache.max_size,)
+            )
+            for row in reversed(locations):
+                self.location_cache.put(self.location_natural_key(row), row['location_key'])
+            
+            logger.info(
+                f"Warmed dimension caches: {len(self.customer_cache)} customers, "
+                f"{len(self.product_cache)} products, {len(self.location_cache)} locations"
+            )
+        except Exception as e:
+            logger.error(f"Failed to warm dimension caches: {e}")
+    
+    def clear_caches(self):
+        """Forget all cached keys, e.g. after a rollback undid rows they point to"""
+        self.customer_cache.clear()
+        self.product_cache.clear()
+        self.location_cache.clear()
+    
+    def cache_stats(self):
+        """Hit/miss counters for every dimension cache"""
+        stats = [cache.stats() for cache in (self.customer_cache, self.product_cache, self.location_cache)]
+        for cache_stats in stats:
+            metrics.set_gauge('etl_dimension_cache_size', cache_stats['size'], cache=cache_stats['name'])
+        return stats
+    
+    CUSTOMER_UPSERT = """
+    INSERT INTO dim_customer 
+    (customer_id, customer_name, email, age, gender, registration_date, customer_segment, is_active, row_hash)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        customer_name = VALUES(customer_name),
+        email = VALUES(email),
+        age = VALUES(age),
+        gender = VALUES(gender),
+        registration_date = VALUES(registration_date),
+        customer_segment = VALUES(customer_segment),
+        row_hash = VALUES(row_hash),
+        updated_at = CURRENT_TIMESTAMP
+    """
+    
+    # Archive the current versions of customers about to change (history mode)
+    CUSTOMER_HISTORY_INSERT = """
+    INSERT INTO dim_customer_history
+    (customer_key, customer_id, customer_name, email, age, gender, registration_date,
+     customer_segment, row_hash, valid_from, valid_to)
+    SELECT customer_key, customer_id, customer_name, email, age, gender, registration_date,
+           customer_segment, row_hash, updated_at, CURRENT_TIMESTAMP
+    FROM dim_customer
+    WHERE customer_id IN ({placeholders})
+    """
+    
+    PRODUCT_UPSERT = """
+    INSERT INTO dim_product 
+    (product_id, product_name, category, subcategory, brand, price, stock_quantity, is_active, row_hash)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        product_name = VALUES(product_name),
+        category = VALUES(category),
+        subcategory = VALUES(subcategory),
+        brand = VALUES(brand),
+        price = VALUES(price),
+        stock_quantity = VALUES(stock_quantity),
+        row_hash = VALUES(row_hash),
+        updated_at = CURRENT_TIMESTAMP
+    """
+    
+    LOCATION_UPSERT = """
+    INSERT INTO dim_location 
+    (city, state, country, postal_code, region)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        region = VALUES(region)
+    """
+    
+    @staticmethod
+    def customer_params(customer_data):
+        """Build the dim_customer upsert parameters for one row, ending with its row hash"""
+        params = (
+            customer_data['customer_id'],
+            customer_data['customer_name'],
+            customer_data['email'],
+            customer_data.get('age'),
+            customer_data.get('gender'),
+            customer_data.get('registration_date'),
+            customer_data.get('customer_segment', 'Standard'),
+            customer_data.get('is_active', True)
+        )
+        return params + (content_hash(params[1:]),)
+    
+    @staticmethod
+    def product_params(product_data):
+        """Build the dim_product upsert parameters for one row, ending with its row hash"""
+        params = (
+            product_data['product_id'],
+            product_data['product_name'],
+            product_data.get('category', 'Uncategorized'),
+            product_data.get('subcategory', ''),
+            product_data.get('brand', 'Unknown'),
+            product_data.get('price', 0),
+            product_data.get('stock_quantity', 0),
+            product_data.get('is_active', True)
+        )
+        return params + (content_hash(params[1:]),)
+    
+    @staticmethod
+    def location_params(location_data):
+        """Build the dim_location upsert parameters for one row"""
+        return (
+            location_data['city'],
+            location_data['state'],
+            location_data['country'],
+            location_data.get('postal_code', ''),
+            location_data.get('region', '')
+        )
+    
+    def upsert_customer(self, customer_data):
+        """Insert or update customer dimension (unchanged cached rows skip the database)"""
+        try:
+            return self.upsert_customers([customer_data]).get(customer_data['customer_id'])
         except Exception as e:
             logger.error(f"Failed to upsert customer: {e}")
             return None
     
     def upsert_product(self, product_data):
-        """Insert or update product dimension"""
+        """Insert or update product dimension (unchanged cached rows skip the database)"""
         try:
-            query = """
-            INSERT INTO dim_product 
-            (product_id, product_name, category, subcategory, brand, price, stock_quantity, is_active)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                product_name = VALUES(product_name),
-                category = VALUES(category),
-                subcategory = VALUES(subcategory),
-                brand = VALUES(brand),
-                price = VALUES(price),
-                stock_quantity = VALUES(stock_quantity),
-                updated_at = CURRENT_TIMESTAMP
-            """
-            params = (
-                product_data['product_id'],
-                product_data['product_name'],
-                product_data.get('category', 'Uncategorized'),
-                product_data.get('subcategory', ''),
-                product_data.get('brand', 'Unknown'),
-                product_data.get('price', 0),
-                product_data.get('stock_quantity', 0),
-                product_data.get('is_active', True)
-            )
-            self.mysql.execute_query(query, params)
-            
-            # Get product_key
-            get_key_query = "SELECT product_key FROM dim_product WHERE product_id = %s"
-            result = self.mysql.execute_query(get_key_query, (product_data['product_id'],))
-            if result:
-                return result[0]['product_key']
-            return None
+            return self.upsert_products([product_data]).get(product_data['product_id'])
         except Exception as e:
             logger.error(f"Failed to upsert product: {e}")
             return None
     
     def upsert_location(self, location_data):
-        """Insert or update location dimension"""
+        """Insert or update location dimension (cached natural keys skip the database)"""
+        natural_key = self.location_natural_key(location_data)
+        cached_key = self.location_cache.get(natural_key)
+        if cached_key is not None:
+            return cached_key
+        
         try:
-            query = """
-            INSERT INTO dim_location 
-            (city, state, country, postal_code, region)
-            VALUES (%s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                region = VALUES(region)
-            """
-            params = (
-                location_data['city'],
-                location_data['state'],
-                location_data['country'],
-                location_data.get('postal_code', ''),
-                location_data.get('region', '')
-            )
-            self.mysql.execute_query(query, params)
+            self.mysql.execute_query(self.LOCATION_UPSERT, self.location_params(location_data))
             
             # Get location_key
             get_key_query = """
@@ -122,57 +276,408 @@ class Loader:
                  location_data.get('postal_code', ''), location_data.get('postal_code', ''))
             )
             if result:
+                self.location_cache.put(natural_key, result[0]['location_key'])
                 return result[0]['location_key']
             return None
         except Exception as e:
             logger.error(f"Failed to upsert location: {e}")
             return None
     
-    def get_date_key(self, date):
-        """Get date key for a given date"""
+    def split_cached(self, cache, rows, natural_key):
+        """Split a batch into cached {natural key: surrogate key} and deduped uncached rows"""
+        keys = {}
+        pending = {}
+        for row in rows:
+            key = natural_key(row)
+            if key in keys or key in pending:
+                continue
+            cached_key = cache.get(key)
+            if cached_key is not None:
+                keys[key] = cached_key
+            else:
+                pending[key] = row
+        return keys, pending
+    
+    def select_in(self, query_template, values, chunk_size=None):
+        """Run a SELECT ... IN ({placeholders}) over the values in chunks"""
+        chunk_size = chunk_size or ETL_CONFIG['load_chunk_size']
+        results = []
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            results.extend(self.mysql.execute_query(query_template.format(placeholders=placeholders), tuple(chunk)))
+        return results
+    
+    def upsert_versioned(self, table, cache, rows, id_column, key_column, upsert_query, params, history_query=None,
+                         insert_only=()):
+        """Upsert a batch of a hashed dimension, writing only new or changed rows; returns {id: key}
+        
+        Rows whose hash matches the cache cost nothing; the rest are checked
+        against the stored hashes with one IN query before anything is written.
+        Rows whose id is in insert_only (placeholders) are written only when no
+        row is stored yet, never over one.
+        """
+        keys = {}
+        pending = {}  # id -> upsert parameters
+        for row in rows:
+            row_params = params(row)
+            natural_key, row_hash = row_params[0], row_params[-1]
+            if natural_key in keys or natural_key in pending:
+                continue
+            cached = cache.get(natural_key)
+            if cached is not None and cached[1] == row_hash:
+                keys[natural_key] = cached[0]
+            else:
+                pending[natural_key] = row_params
+        if not pending:
+            return keys
+        
         try:
-            if isinstance(date, str):
-                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
-            date_key = int(date.strftime('%Y%m%d'))
+            stored = {
+                row[id_column]: row
+                for row in self.select_in(
+                    f"SELECT {id_column}, {key_column}, row_hash FROM {table} WHERE {id_column} IN ({{placeholders}})",
+                    list(pending)
+                )
+            }
+            changed = [
+                natural_key for natural_key in pending
+                if natural_key in stored and natural_key not in insert_only
+                and stored[natural_key]['row_hash'] != pending[natural_key][-1]
+            ]
+            new = [natural_key for natural_key in pending if natural_key not in stored]
             
-            # Verify date exists in dim_date
-            query = "SELECT date_key FROM dim_date WHERE date_key = %s"
-            result = self.mysql.execute_query(query, (date_key,))
-            if result:
-                return date_key
-            return None
+            if changed or new:
+                with self.mysql.transaction():
+                    if history_query and changed:
+                        # INSERT ... SELECT, chunked over the ids like a lookup
+                        self.select_in(history_query, changed)
+                    self.insert_many(upsert_query, [pending[natural_key] for natural_key in changed + new])
+                if new:
+                    stored.update(
+                        (row[id_column], row)
+                        for row in self.select_in(
+                            f"SELECT {id_column}, {key_column} FROM {table} WHERE {id_column} IN ({{placeholders}})",
+                            new
+                        )
+                    )
+        except Exception as e:
+            logger.error(f"Failed to upsert {table} batch of {len(pending)} rows: {e}")
+            raise
+        
+        metrics.inc('etl_dimension_rows_written_total', len(changed) + len(new), table=table)
+        metrics.inc('etl_dimension_rows_unchanged_total', len(pending) - len(changed) - len(new), table=table)
+        for natural_key, row_params in pending.items():
+            if natural_key in stored:
+                keys[natural_key] = stored[natural_key][key_column]
+                # A placeholder kept off a stored row leaves that row's hash in place
+                row_hash = stored[natural_key].get('row_hash') if natural_key in insert_only else None
+                cache.put(natural_key, (stored[natural_key][key_column], row_hash or row_params[-1]))
+        return keys
+    
+    def upsert_customers(self, customers):
+        """Upsert a batch of customers set-based; returns {customer_id: customer_key}
+        
+        Placeholder rows (customers with no staged attributes) only create
+        missing customers and never overwrite stored attributes.
+        """
+        history_query = self.CUSTOMER_HISTORY_INSERT if ETL_CONFIG['customer_history'] else None
+        placeholders = {customer['customer_id'] for customer in customers if customer.get('placeholder')}
+        return self.upsert_versioned(
+            'dim_customer', self.customer_cache, customers, 'customer_id', 'customer_key',
+            self.CUSTOMER_UPSERT, self.customer_params, history_query, insert_only=placeholders
+        )
+    
+    def upsert_products(self, products):
+        """Upsert a batch of products set-based; returns {product_id: product_key}"""
+        return self.upsert_versioned(
+            'dim_product', self.product_cache, products, 'product_id', 'product_key',
+            self.PRODUCT_UPSERT, self.product_params
+        )
+    
+    def upsert_locations(self, locations):
+        """Upsert a batch of locations set-based; returns {(city, state, country, postal_code): location_key}"""
+        keys, pending = self.split_cached(self.location_cache, locations, self.location_natural_key)
+        if not pending:
+            return keys
+        
+        try:
+            self.insert_many(self.LOCATION_UPSERT, [self.location_params(row) for row in pending.values()])
+            # Tuple IN on the (city, state, country) index prefix; postal codes are
+            # matched here so NULL and '' resolve to the same place
+            triples = list({natural_key[:3] for natural_key in pending})
+            chunk_size = ETL_CONFIG['load_chunk_size']
+            results = []
+            for start in range(0, len(triples), chunk_size):
+                chunk = triples[start:start + chunk_size]
+                placeholders = ', '.join(['(%s, %s, %s)'] * len(chunk))
+                query = f"""
+                SELECT location_key, city, state, country, postal_code FROM dim_location
+                WHERE (city, state, country) IN ({placeholders})
+                """
+                results.extend(self.mysql.execute_query(query, tuple(value for triple in chunk for value in triple)))
+        except Exception as e:
+            logger.error(f"Failed to upsert location batch of {len(pending)} rows: {e}")
+            raise
+        
+        for row in results:
+            natural_key = self.location_natural_key(row)
+            if natural_key in pending:
+                keys[natural_key] = row['location_key']
+                self.location_cache.put(natural_key, row['location_key'])
+        return keys
+    
+    def get_date_key(self, date):
+        """Get date key for a given date (resolved from the shared calendar, no query)"""
+        try:
+            return resolve_date_key(date)
         except Exception as e:
             logger.error(f"Failed to get date key: {e}")
             return None
     
+    FACT_SALES_INSERT = """
+    INSERT INTO fact_sales 
+    (date_key, customer_key, product_key, location_key, order_id, order_date,
+     quantity, unit_price, total_amount, discount_amount, shipping_cost,
+     payment_method, delivery_date, delivery_time_hours, order_status)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    
+    FACT_CART_ABANDONMENT_INSERT = """
+    INSERT INTO fact_cart_abandonment 
+    (date_key, customer_key, product_key, session_id, add_to_cart_time,
+     abandonment_time, time_to_abandonment_minutes, cart_value, items_count,
+     device_type, browser)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    
+    FACT_CUSTOMER_EVENTS_INSERT = """
+    INSERT INTO fact_customer_events
+    (date_key, customer_key, event_id, event_type, event_timestamp,
+     session_id, event_source, field_updated)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    
+    # Counters are additive, so each batch only sends its own deltas
+    CUSTOMER_ACTIVITY_UPSERT = """
+    INSERT INTO agg_customer_activity
+    (customer_key, login_count, signup_count, last_login_at, last_event_at)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        login_count = login_count + VALUES(login_count),
+        signup_count = signup_count + VALUES(signup_count),
+        last_login_at = GREATEST(COALESCE(last_login_at, VALUES(last_login_at)), COALESCE(VALUES(last_login_at), last_login_at)),
+        last_event_at = GREATEST(last_event_at, VALUES(last_event_at))
+    """
+    
+    # The location is assigned before last_order_date, since MySQL evaluates
+    # the assignments in order and later ones see the updated columns
+    CUSTOMER_LIFETIME_UPSERT = """
+    INSERT INTO customer_lifetime
+    (customer_key, total_orders, total_spent, first_order_date, last_order_date, current_location_key)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        total_orders = total_orders + VALUES(total_orders),
+        total_spent = total_spent + VALUES(total_spent),
+        first_order_date = LEAST(first_order_date, VALUES(first_order_date)),
+        current_location_key = IF(VALUES(last_order_date) >= last_order_date,
+                                  VALUES(current_location_key), current_location_key),
+        last_order_date = GREATEST(last_order_date, VALUES(last_order_date))
+    """
+    
+    # Daily rollups, additive like agg_customer_activity; min/max merge with LEAST/GREATEST
+    DAILY_SALES_UPSERT = """
+    INSERT INTO agg_daily_sales
+    (date_key, product_key, order_count, total_quantity, total_sales)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        order_count = order_count + VALUES(order_count),
+        total_quantity = total_quantity + VALUES(total_quantity),
+        total_sales = total_sales + VALUES(total_sales)
+    """
+    
+    DAILY_SALES_SKETCH_UPDATE = """
+    INSERT INTO agg_daily_sales (date_key, product_key, customers_sketch, orders_sketch, unique_customers)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        customers_sketch = VALUES(customers_sketch),
+        orders_sketch = VALUES(orders_sketch),
+        unique_customers = VALUES(unique_customers)
+    """
+    
+    DAILY_ABANDONMENT_UPSERT = """
+    INSERT INTO agg_daily_abandonment
+    (date_key, product_key, device_type, browser, abandonment_count, total_abandoned_value,
+     abandonment_minutes_sum, abandonment_minutes_count, items_count_sum, items_count_count)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        abandonment_count = abandonment_count + VALUES(abandonment_count),
+        total_abandoned_value = total_abandoned_value + VALUES(total_abandoned_value),
+        abandonment_minutes_sum = abandonment_minutes_sum + VALUES(abandonment_minutes_sum),
+        abandonment_minutes_count = abandonment_minutes_count + VALUES(abandonment_minutes_count),
+        items_count_sum = items_count_sum + VALUES(items_count_sum),
+        items_count_count = items_count_count + VALUES(items_count_count)
+    """
+    
+    DAILY_DELIVERY_UPSERT = """
+    INSERT INTO agg_daily_delivery
+    (date_key, location_key, product_key, order_status, delivery_count, delivery_hours_sum,
+     min_delivery_hours, max_delivery_hours)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        delivery_count = delivery_count + VALUES(delivery_count),
+        delivery_hours_sum = delivery_hours_sum + VALUES(delivery_hours_sum),
+        min_delivery_hours = LEAST(min_delivery_hours, VALUES(min_delivery_hours)),
+        max_delivery_hours = GREATEST(max_delivery_hours, VALUES(max_delivery_hours))
+    """
+    
+    @staticmethod
+    def fact_sales_params(sales_data):
+        """Build the fact_sales INSERT parameters for one row"""
+        return (
+            sales_data['date_key'],
+            sales_data['customer_key'],
+            sales_data['product_key'],
+            sales_data['location_key'],
+            sales_data['order_id'],
+            sales_data['order_date'],
+            sales_data['quantity'],
+            sales_data['unit_price'],
+            sales_data['total_amount'],
+            sales_data.get('discount_amount', 0),
+            sales_data.get('shipping_cost', 0),
+            sales_data.get('payment_method', 'unknown'),
+            sales_data.get('delivery_date'),
+            sales_data.get('delivery_time_hours'),
+            sales_data.get('order_status', 'pending')
+        )
+    
+    @staticmethod
+    def fact_cart_abandonment_params(abandonment_data):
+        """Build the fact_cart_abandonment INSERT parameters for one row"""
+        return (
+            abandonment_data['date_key'],
+            abandonment_data.get('customer_key'),
+            abandonment_data['product_key'],
+            abandonment_data.get('session_id'),
+            abandonment_data['add_to_cart_time'],
+            abandonment_data.get('abandonment_time'),
+            abandonment_data.get('time_to_abandonment_minutes', 0),
+            abandonment_data.get('cart_value', 0),
+            abandonment_data.get('items_count', 0),
+            abandonment_data.get('device_type', 'unknown'),
+            abandonment_data.get('browser', 'unknown')
+        )
+    
+    @staticmethod
+    def fact_customer_events_params(event_data):
+        """Build the fact_customer_events INSERT parameters for one row"""
+        return (
+            event_data['date_key'],
+            event_data['customer_key'],
+            event_data['event_id'],
+            event_data['event_type'],
+            event_data['event_timestamp'],
+            event_data.get('session_id'),
+            event_data.get('event_source'),
+            event_data.get('field_updated')
+        )
+    
+    @staticmethod
+    def customer_activity_params(activity):
+        """Build the agg_customer_activity upsert parameters for one customer's batch deltas"""
+        return (
+            activity['customer_key'],
+            activity['login_count'],
+            activity['signup_count'],
+            activity.get('last_login_at'),
+            activity['last_event_at']
+        )
+    
+    @staticmethod
+    def rollup_params(columns, delta):
+        """Build rollup upsert parameters from one cell's deltas"""
+        return tuple(delta[column] for column in columns)
+    
+    def upsert_rollup(self, table, query, columns, deltas, chunk_size=None):
+        """Add a batch's deltas to a rollup table; raises so the batch rolls back"""
+        if not deltas:
+            return 0
+        try:
+            # Deltas arrive sorted by key, so concurrent batches lock rollup rows in the same order
+            return self.insert_many(query, [self.rollup_params(columns, delta) for delta in deltas], chunk_size)
+        except Exception as e:
+            logger.error(f"Failed to upsert {table} batch of {len(deltas)} rows: {e}")
+            raise
+    
+    def upsert_daily_sales_batch(self, deltas, chunk_size=None):
+        """Add a batch's per-day, per-product sales deltas to agg_daily_sales"""
+        columns = ['date_key', 'product_key', 'order_count', 'total_quantity', 'total_sales']
+        return self.upsert_rollup('agg_daily_sales', self.DAILY_SALES_UPSERT, columns, deltas, chunk_size)
+    
+    def merge_daily_sales_sketches(self, sketches, chunk_size=None):
+        """Merge a batch's HyperLogLog sketches into agg_daily_sales; raises so the batch rolls back
+        
+        Sketches can't be merged in SQL, so each cell is read FOR UPDATE,
+        merged in Python and written back, all in the batch's transaction.
+        unique_customers is the merged customer sketch's estimate. Unlike a
+        count of customers not seen before, it can't be inflated by two
+        workers loading the same customer at once, since merging is idempotent.
+        """
+        if not sketches:
+            return 0
+        chunk_size = chunk_size or ETL_CONFIG['load_chunk_size']
+        params_list = []
+        try:
+            for start in range(0, len(sketches), chunk_size):
+                chunk = sketches[start:start + chunk_size]
+                placeholders = ', '.join(['(%s, %s)'] * len(chunk))
+                results = self.mysql.execute_query(
+                    f"""
+                    SELECT date_key, product_key, customers_sketch, orders_sketch FROM agg_daily_sales
+                    WHERE (date_key, product_key) IN ({placeholders})
+                    FOR UPDATE
+                    """,
+                    tuple(value for cell in chunk for value in (cell['date_key'], cell['product_key']))
+                )
+                stored = {(row['date_key'], row['product_key']): row for row in results}
+                for cell in chunk:
+                    row = stored.get((cell['date_key'], cell['product_key']), {})
+                    customers = HyperLogLog.from_bytes(row.get('customers_sketch')).merge(cell['customers_sketch'])
+                    orders = HyperLogLog.from_bytes(row.get('orders_sketch')).merge(cell['orders_sketch'])
+                    params_list.append((
+                        cell['date_key'], cell['product_key'], customers.to_bytes(), orders.to_bytes(), customers.count()
+                    ))
+            return self.insert_many(self.DAILY_SALES_SKETCH_UPDATE, params_list, chunk_size)
+        except Exception as e:
+            logger.error(f"Failed to merge agg_daily_sales sketches for {len(sketches)} cells: {e}")
+            raise
+    
+    def upsert_customer_lifetime_batch(self, deltas, chunk_size=None):
+        """Add a batch's per-customer order totals to customer_lifetime"""
+        columns = ['customer_key', 'total_orders', 'total_spent', 'first_order_date', 'last_order_date', 'current_location_key']
+        return self.upsert_rollup('customer_lifetime', self.CUSTOMER_LIFETIME_UPSERT, columns, deltas, chunk_size)
+    
+    def upsert_daily_abandonment_batch(self, deltas, chunk_size=None):
+        """Add a batch's abandonment deltas to agg_daily_abandonment"""
+        columns = [
+            'date_key', 'product_key', 'device_type', 'browser', 'abandonment_count', 'total_abandoned_value',
+            'abandonment_minutes_sum', 'abandonment_minutes_count', 'items_count_sum', 'items_count_count'
+        ]
+        return self.upsert_rollup('agg_daily_abandonment', self.DAILY_ABANDONMENT_UPSERT, columns, deltas, chunk_size)
+    
+    def upsert_daily_delivery_batch(self, deltas, chunk_size=None):
+        """Add a batch's delivery-time deltas to agg_daily_delivery"""
+        columns = [
+            'date_key', 'location_key', 'product_key', 'order_status', 'delivery_count', 'delivery_hours_sum',
+            'min_delivery_hours', 'max_delivery_hours'
+        ]
+        return self.upsert_rollup('agg_daily_delivery', self.DAILY_DELIVERY_UPSERT, columns, deltas, chunk_size)
+    
     def insert_fact_sales(self, sales_data):
         """Insert into fact_sales table"""
         try:
-            query = """
-            INSERT INTO fact_sales 
-            (date_key, customer_key, product_key, location_key, order_id, order_date,
-             quantity, unit_price, total_amount, discount_amount, shipping_cost,
-             payment_method, delivery_date, delivery_time_hours, order_status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            params = (
-                sales_data['date_key'],
-                sales_data['customer_key'],
-                sales_data['product_key'],
-                sales_data['location_key'],
-                sales_data['order_id'],
-                sales_data['order_date'],
-                sales_data['quantity'],
-                sales_data['unit_price'],
-                sales_data['total_amount'],
-                sales_data.get('discount_amount', 0),
-                sales_data.get('shipping_cost', 0),
-                sales_data.get('payment_method', 'unknown'),
-                sales_data.get('delivery_date'),
-                sales_data.get('delivery_time_hours'),
-                sales_data.get('order_status', 'pending')
-            )
-            self.mysql.execute_query(query, params)
+            self.mysql.execute_query(self.FACT_SALES_INSERT, self.fact_sales_params(sales_data))
             return True
         except Exception as e:
             logger.error(f"Failed to insert fact_sales: {e}")
@@ -181,32 +686,74 @@ class Loader:
     def insert_fact_cart_abandonment(self, abandonment_data):
         """Insert into fact_cart_abandonment table"""
         try:
-            query = """
-            INSERT INTO fact_cart_abandonment 
-            (date_key, customer_key, product_key, session_id, add_to_cart_time,
-             abandonment_time, time_to_abandonment_minutes, cart_value, items_count,
-             device_type, browser)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            params = (
-                abandonment_data['date_key'],
-                abandonment_data.get('customer_key'),
-                abandonment_data['product_key'],
-                abandonment_data.get('session_id'),
-                abandonment_data['add_to_cart_time'],
-                abandonment_data.get('abandonment_time'),
-                abandonment_data.get('time_to_abandonment_minutes', 0),
-                abandonment_data.get('cart_value', 0),
-                abandonment_data.get('items_count', 0),
-                abandonment_data.get('device_type', 'unknown'),
-                abandonment_data.get('browser', 'unknown')
+            self.mysql.execute_query(
+                self.FACT_CART_ABANDONMENT_INSERT,
+                self.fact_cart_abandonment_params(abandonment_data)
             )
-            self.mysql.execute_query(query, params)
             return True
         except Exception as e:
             logger.error(f"Failed to insert fact_cart_abandonment: {e}")
             return False
     
+    def insert_many(self, query, params_list, chunk_size=None):
+        """Write rows with multi-row INSERTs in chunks, all inside one transaction"""
+        chunk_size = chunk_size or ETL_CONFIG['load_chunk_size']
+        inserted = 0
+        
+        # pymysql rewrites executemany on INSERT ... VALUES into multi-row statements
+        with metrics.track_stage('load', statement_label(query).split()[-1]) as tracker:
+            with self.mysql.transaction():
+                for start in range(0, len(params_list), chunk_size):
+                    chunk = params_list[start:start + chunk_size]
+                    self.mysql.execute_many(query, chunk)
+                    inserted += len(chunk)
+            tracker['rows'] = inserted
+        return inserted
+    
+    def insert_fact_sales_batch(self, sales_rows, chunk_size=None):
+        """Insert a batch of transformed rows into fact_sales; raises so the batch rolls back"""
+        if not sales_rows:
+            return 0
+        try:
+            params_list = [self.fact_sales_params(row) for row in sales_rows]
+            return self.insert_many(self.FACT_SALES_INSERT, params_list, chunk_size)
+        except Exception as e:
+            logger.error(f"Failed to insert fact_sales batch of {len(sales_rows)} rows: {e}")
+            raise
+    
+    def insert_fact_cart_abandonment_batch(self, abandonment_rows, chunk_size=None):
+        """Insert a batch of transformed rows into fact_cart_abandonment; raises so the batch rolls back"""
+        if not abandonment_rows:
+            return 0
+        try:
+            params_list = [self.fact_cart_abandonment_params(row) for row in abandonment_rows]
+            return self.insert_many(self.FACT_CART_ABANDONMENT_INSERT, params_list, chunk_size)
+        except Exception as e:
+            logger.error(f"Failed to insert fact_cart_abandonment batch of {len(abandonment_rows)} rows: {e}")
+            raise
+    
+    def insert_fact_customer_events_batch(self, event_rows, chunk_size=None):
+        """Insert a batch of transformed rows into fact_customer_events; raises so the batch rolls back"""
+        if not event_rows:
+            return 0
+        try:
+            params_list = [self.fact_customer_events_params(row) for row in event_rows]
+            return self.insert_many(self.FACT_CUSTOMER_EVENTS_INSERT, params_list, chunk_size)
+        except Exception as e:
+            logger.error(f"Failed to insert fact_customer_events batch of {len(event_rows)} rows: {e}")
+            raise
+    
+    def upsert_customer_activity_batch(self, activity_rows, chunk_size=None):
+        """Add a batch's per-customer counter deltas to agg_customer_activity; raises so the batch rolls back"""
+        if not activity_rows:
+            return 0
+        try:
+            params_list = [self.customer_activity_params(row) for row in activity_rows]
+            return self.insert_many(self.CUSTOMER_ACTIVITY_UPSERT, params_list, chunk_size)
+        except Exception as e:
+            logger.error(f"Failed to upsert agg_customer_activity batch of {len(activity_rows)} rows: {e}")
+            raise
+    
     def close(self):
         """Close database connection"""
         self.mysql.close()
@@ -2,12 +2,28 @@
 Main ETL Pipeline
 Orchestrates Extract, Transform, Load operations
 """
+from etl.adaptive import AdaptiveBatchController
 from etl.extract import Extractor
 from etl.transform import Transformer
 from etl.load import Loader
-from datetime import datetime
+from etl.checkpoint import CheckpointStore
+from etl.coordination import LeaseLostError, LeaseManager, parse_source_name, table_source_names
+from etl.dead_letter import DeadLetterStore, RejectedRow
+from etl.retention import StagingRetention
+from etl.enrich import CustomerEnricher
+from etl.sessionize import CartSessionizer, CartSessionStore
+from etl.stages import StagedRunner
+from etl.scheduler import MicroBatchScheduler
+from utils.product_catalog import get_catalog
+from utils.database_connector import is_transient_error
+from config.config import ETL_CONFIG, METRICS_CONFIG
+from utils.metrics import metrics
+from functools import partial
 import time
 
+# Sources whose transform carries state from batch to batch, so batches must be transformed in order
+STATEFUL_SOURCES = {'staging_clicks'}
+
 
 class ETLPipeline:
     """Main ETL Pipeline"""
@@ -16,158 +32,502 @@ class ETLPipeline:
         self.extractor = Extractor()
         self.transformer = Transformer()
         self.loader = Loader()
-        self.last_run_time = None
+        self.catalog = get_catalog()
+        self.enricher = CustomerEnricher()
+        self.checkpoints = CheckpointStore(self.loader.mysql)
+        self.dead_letters = DeadLetterStore(self.loader.mysql)
+        # source name -> (created_at, primary key) of the last row loaded; a source
+        # name is a staging table, or one hash partition of it ('staging_orders#3/8')
+        self.watermarks = self.checkpoints.load_all()
+        self.migrated_tables = set()  # tables whose checkpoints were checked against the partition count
+        self.staged_runners = {}  # source name -> StagedRunner, built on first use
+        self.sessionizers = {}  # click source name -> CartSessionizer, built on first use
+        # With several partitions, workers share the staging tables through leases
+        self.partition_count = ETL_CONFIG['partition_count']
+        self.leases = LeaseManager() if self.partition_count > 1 else None
+        self.batch_controller = AdaptiveBatchController() if ETL_CONFIG['adaptive_batching'] else None
+        self.retention = StagingRetention()
+        self.retention_due_at = 0.0  # monotonic time of the next staging partition maintenance
     
     def get_product_info(self, product_id):
-        """Get product information - in real scenario, this would come from a product catalog"""
-        # Sample product data - in production, fetch from product database
-        products = {
-            "PROD001": {"product_name": "Wireless Headphones", "category": "Electronics", "subcategory": "Audio", "brand": "TechSound", "price": 99.99},
-            "PROD002": {"product_name": "Smartphone Case", "category": "Electronics", "subcategory": "Accessories", "brand": "ProtectPlus", "price": 24.99},
-            "PROD003": {"product_name": "Laptop Stand", "category": "Electronics", "subcategory": "Accessories", "brand": "ErgoDesk", "price": 49.99},
-            "PROD004": {"product_name": "Running Shoes", "category": "Fashion", "subcategory": "Footwear", "brand": "SportMax", "price": 79.99},
-            "PROD005": {"product_name": "Yoga Mat", "category": "Sports", "subcategory": "Fitness", "brand": "FlexFit", "price": 29.99},
-            "PROD006": {"product_name": "Coffee Maker", "category": "Home", "subcategory": "Appliances", "brand": "BrewMaster", "price": 89.99},
-            "PROD007": {"product_name": "Desk Lamp", "category": "Home", "subcategory": "Furniture", "brand": "BrightLight", "price": 34.99},
-            "PROD008": {"product_name": "Backpack", "category": "Fashion", "subcategory": "Bags", "brand": "TravelPro", "price": 59.99},
-            "PROD009": {"product_name": "Wireless Mouse", "category": "Electronics", "subcategory": "Computer", "brand": "ClickTech", "price": 19.99},
-            "PROD010": {"product_name": "Water Bottle", "category": "Sports", "subcategory": "Accessories", "brand": "Hydrate", "price": 14.99},
+        """Get product information from the shared product catalog"""
+        return self.catalog.get(product_id)
+    
+    def get_product_rows(self, product_ids):
+        """Get dim_product rows for a set of product ids as {product_id: row}"""
+        return {
+            product_id: record._asdict()
+            for product_id, record in self.catalog.get_many(product_ids).items()
         }
-        return products.get(product_id, {"product_name": f"Product {product_id}", "category": "Uncategorized", "subcategory": "", "brand": "Unknown", "price": 0})
     
     def get_customer_info(self, customer_id):
-        """Get customer information - in real scenario, this would come from customer database"""
-        # In production, fetch from customer database
-        # For now, return basic structure
+        """Get customer information for one customer (prefer get_customer_rows for batches)"""
+        return self.get_customer_rows([customer_id], self.loader)[customer_id]
+    
+    def get_customer_rows(self, customer_ids, loader):
+        """Get dim_customer rows for a set of customer ids, enriched from staging_customers"""
+        return self.enricher.enrich(customer_ids, loader)
+    
+    def batch_stages(self, source_name):
+        """(transform, resolve_keys, write_facts) steps that process one staging source's batches"""
+        table, _ = parse_source_name(source_name)
         return {
-            "customer_id": customer_id,
-            "customer_name": f"Customer {customer_id}",
-            "email": f"{customer_id}@example.com",
-            "age": None,
-            "gender": None,
-            "registration_date": None,
-            "customer_segment": "Standard"
-        }
+            'staging_orders': (self.transform_order_batch, self.resolve_order_keys, self.write_order_facts),
+            'staging_clicks': (partial(self.transform_click_batch, source_name=source_name), self.resolve_click_keys, self.write_click_facts),
+            'staging_customer_events': (self.transform_event_batch, self.resolve_event_keys, self.write_event_facts),
+        }[table]
     
-    def process_orders(self):
-        """Process orders through ETL pipeline"""
-        orders = self.extractor.extract_orders(self.last_run_time, limit=1000)
-        if not orders:
-            return
+    def source_names(self, table):
+        """Source names this worker processes for a staging table: the table, or its leased partitions"""
+        names = table_source_names(table, self.partition_count)
+        if table not in self.migrated_tables:
+            # Checkpoints of an earlier ETL_PARTITIONS must move before anything loads
+            if self.checkpoints.migrate(table, names):
+                self.watermarks = self.checkpoints.load_all()
+            self.migrated_tables.add(table)
+        if self.leases is None:
+            return names
+        held = self.leases.rebalance(names)
         
-        processed_count = 0
+        # Partitions may have moved to another worker since we last held them
+        for name in names:
+            if name not in held:
+                self.sessionizers.pop(name, None)
+                runner = self.staged_runners.pop(name, None)
+                if runner is not None:
+                    runner.close()
+        return held
+    
+    def load_watermark(self, source_name):
+        """Committed watermark of a source (partitions are seeded by CheckpointStore.migrate)"""
+        return self.checkpoints.load(source_name)
+    
+    def save_progress(self, source_name, watermark, mysql):
+        """Store a watermark inside the batch's transaction, fenced by the partition lease if any"""
+        if self.leases is not None:
+            self.leases.verify(source_name, mysql)
+        CheckpointStore(mysql).save(source_name, watermark)
+    
+    def source_batches(self, source_name):
+        """Extracted (rows, watermark) batches of a source after its committed watermark"""
+        table, partition = parse_source_name(source_name)
+        if self.leases is not None:
+            # Another worker may have advanced a partition we just claimed
+            self.watermarks[source_name] = self.load_watermark(source_name)
+        if self.batch_controller is not None:
+            batch_size = self.batch_controller.batch_sizer(source_name)
+        else:
+            batch_size = ETL_CONFIG['batch_size']
+        return self.extractor.batches(table, self.watermarks.get(source_name), batch_size=batch_size, partition=partition)
+    
+    def observe_batch(self, source_name, row_count, seconds):
+        """Report a committed batch's size and processing time to the batch controller"""
+        if self.batch_controller is not None:
+            self.batch_controller.observe(source_name, row_count, seconds)
+    
+    def process_batch(self, source_name, rows, loader=None):
+        """Run all steps for one batch"""
+        loader = loader or self.loader
+        transform, resolve_keys, write_facts = self.batch_stages(source_name)
+        write_facts(resolve_keys(transform(rows), loader), loader)
+    
+    def load_isolating(self, source_name, rows, loader, failures, max_failures=None):
+        """Run all steps for a batch under a savepoint, bisecting it on failure to isolate the failing rows
+        
+        Call inside a transaction. Each row that fails on its own is appended to
+        failures as (row, stage, error) and the rest still load in bulk, so k bad
+        rows cost about 2k*log2(n) extra attempts rather than a retry per row.
+        Errors that are not about the data (lost connection, deadlock, lost
+        lease), or more than max_failures failing rows, are raised instead.
+        Rows the stages reject as invalid are appended as well, with a
+        RejectedRow error, but don't count towards max_failures.
+        """
+        transform, resolve_keys, write_facts = self.batch_stages(source_name)
+        stage = 'transform'
+        try:
+            with loader.mysql.savepoint():
+                payload = transform(rows)
+                stage = 'resolve'
+                fact_rows = resolve_keys(payload, loader)
+                stage = 'load'
+                write_facts(fact_rows, loader)
+            failures.extend(fact_rows['rejected'])
+            return
+        except Exception as e:
+            if isinstance(e, LeaseLostError) or is_transient_error(e):
+                raise
+            error = e
         
-        for order in orders:
+        # The savepoint undid the rows, but cached keys and cart state may still reflect them
+        loader.clear_caches()
+        self.reset_state()
+        if len(rows) == 1:
+            failures.append((rows[0], stage, error))
+            failed = sum(1 for _, _, failure in failures if not isinstance(failure, RejectedRow))
+            if max_failures is not None and failed > max_failures:
+                # Too many to be a few bad rows; fail the batch so the cause gets fixed
+                raise error
+            return
+        middle = len(rows) // 2
+        self.load_isolating(source_name, rows[:middle], loader, failures, max_failures)
+        self.load_isolating(source_name, rows[middle:], loader, failures, max_failures)
+    
+    @staticmethod
+    def max_dead_letters(row_count):
+        """Failing rows a batch may dead-letter before it fails as a whole"""
+        return max(1, int(row_count * ETL_CONFIG['dead_letter_max_fraction']))
+    
+    def sessionizer_for(self, source_name):
+        """Cart sessionizer of a click source, restored from its committed state on first use"""
+        if source_name not in self.sessionizers:
+            _, partition = parse_source_name(source_name)
+            sessionizer = CartSessionizer()
+            # Kept only once restored, so a failed load is retried rather than starting from no carts
+            sessionizer.restore(CartSessionStore(self.loader.mysql).load(partition))
+            self.sessionizers[source_name] = sessionizer
+        return self.sessionizers[source_name]
+    
+    def reset_state(self):
+        """Drop cross-batch state so it reloads from its last committed copy"""
+        self.sessionizers.clear()
+    
+    def commit_batch(self, source_name, rows, watermark):
+        """Load a batch and its checkpoint in one transaction, so a restart resumes exactly here"""
+        started = time.monotonic()
+        failures = []
+        try:
+            with self.loader.mysql.transaction():
+                self.load_isolating(source_name, rows, self.loader, failures, self.max_dead_letters(len(rows)))
+                unsaved = self.dead_letters.record(source_name, failures)
+                self.save_progress(source_name, watermark, self.loader.mysql)
+        except Exception:
+            # Keys cached while loading the batch may point at rolled-back rows,
+            # and the sessionizer has already consumed the batch
+            self.loader.clear_caches()
+            self.reset_state()
+            raise
+        self.watermarks[source_name] = watermark
+        self.dead_letters.write_fallback(unsaved)
+        self.observe_batch(source_name, len(rows), time.monotonic() - started)
+    
+    def process_source(self, source_name):
+        """Drain one staging source, sequentially or through the staged runner"""
+        if ETL_CONFIG['pipeline_mode'] == 'staged':
+            if source_name not in self.staged_runners:
+                # One transform worker keeps a stateful transform in batch order
+                transform_workers = 1 if parse_source_name(source_name)[0] in STATEFUL_SOURCES else None
+                self.staged_runners[source_name] = StagedRunner(self, source_name, transform_workers=transform_workers)
             try:
-                # Transform
-                cleaned_order = self.transformer.clean_order(order)
-                if not cleaned_order:
-                    continue
-                
-                # Get dimension keys
-                # Customer dimension
-                customer_info = self.get_customer_info(cleaned_order['customer_id'])
-                customer_key = self.loader.upsert_customer(customer_info)
-                
-                # Product dimension
-                product_info = self.get_product_info(cleaned_order['product_id'])
-                product_info['product_id'] = cleaned_order['product_id']
-                product_key = self.loader.upsert_product(product_info)
-                
-                # Location dimension
-                location_data = self.transformer.transform_for_dim_location(cleaned_order)
-                location_key = self.loader.upsert_location(location_data)
-                
-                # Date dimension
-                date_key = self.loader.get_date_key(cleaned_order['order_date'])
-                
-                if not all([customer_key, product_key, location_key, date_key]):
-                    continue
-                
-                # Transform for fact table
-                sales_data = self.transformer.transform_for_fact_sales(
-                    cleaned_order, customer_key, product_key, location_key, date_key
-                )
-                
-                # Load
-                if sales_data:
-                    self.loader.insert_fact_sales(sales_data)
-                    processed_count += 1
+                self.staged_runners[source_name].run()
+                return
             except Exception as e:
-                print(f"Error processing order {order.get('order_id')}: {e}")
-                continue
+                self.reset_state()
+                if isinstance(e, LeaseLostError) or is_transient_error(e):
+                    raise
+                # Finish sequentially, where a failing batch is bisected into dead letters
+                print(f"Staged run of {source_name} failed ({e}); continuing sequentially")
         
+        for rows, watermark in self.source_batches(source_name):
+            self.commit_batch(source_name, rows, watermark)
+    
+    def process_orders(self):
+        """Process orders through ETL pipeline"""
+        for source_name in self.source_names('staging_orders'):
+            self.process_source(source_name)
+    
+    @staticmethod
+    def rejections(rejected, stage):
+        """(row, reason) pairs from a stage as (row, stage, RejectedRow) dead-letter failures"""
+        return [(row, stage, RejectedRow(reason)) for row, reason in rejected]
+    
+    @staticmethod
+    def unresolved(batch, frame, key_columns):
+        """Dead-letter failures for the rows of a cleaned frame missing any of key_columns"""
+        missing = frame[key_columns].isna()
+        return [
+            (batch['rows'][index], 'resolve', RejectedRow(f"unresolved {', '.join(missing.columns[absent])}"))
+            for index, absent in zip(missing.index, missing.to_numpy())
+            if absent.any()
+        ]
+    
+    def transform_order_batch(self, orders):
+        """Transform a batch of extracted orders column-wise, keeping the orders it rejects"""
+        rejected = []
+        frame = self.transformer.clean_orders_frame(orders, rejected)
+        return {'frame': frame, 'rows': orders, 'rejected': self.rejections(rejected, 'transform')}
+    
+    def resolve_order_keys(self, batch, loader):
+        """Resolve dimension keys for cleaned orders and build fact_sales rows"""
+        frame = batch['frame']
+        if frame.empty:
+            return {'facts': [], 'rejected': batch['rejected']}
+        
+        # Resolve every dimension set-based: one upsert and one key lookup per dimension
+        customer_keys = loader.upsert_customers(
+            list(self.get_customer_rows(frame['customer_id'].unique(), loader).values())
+        )
+        
+        product_keys = loader.upsert_products(
+            list(self.get_product_rows(frame['product_id'].unique()).values())
+        )
+        
+        location_rows = [
+            self.transformer.transform_for_dim_location(order)
+            for order in self.transformer.frame_to_records(
+                frame[['city', 'state', 'country', 'postal_code']].drop_duplicates()
+            )
+        ]
+        location_keys = loader.upsert_locations(location_rows)
+        
+        # Date keys were derived from the calendar during cleaning; rows missing any key are dead-lettered
+        frame['customer_key'] = frame['customer_id'].map(customer_keys)
+        frame['product_key'] = frame['product_id'].map(product_keys)
+        frame['location_key'] = [
+            location_keys.get(natural_key)
+            for natural_key in zip(frame['city'], frame['state'], frame['country'], frame['postal_code'].fillna(''))
+        ]
+        return {
+            'facts': self.transformer.transform_frame_for_fact_sales(frame),
+            'rejected': batch['rejected'] + self.unresolved(
+                batch, frame, ['customer_key', 'product_key', 'location_key', 'date_key']
+            )
+        }
+    
+    def write_order_facts(self, sales, loader):
+        """Load a batch of fact_sales rows set-based and add it to the daily rollups and customer lifetimes"""
+        sales_rows = sales['facts']
+        if not sales_rows:
+            return
+        processed_count = loader.insert_fact_sales_batch(sales_rows)
+        loader.upsert_daily_sales_batch(self.transformer.daily_sales_deltas(sales_rows))
+        # After the upsert, so every cell already exists and is locked by this transaction
+        loader.merge_daily_sales_sketches(self.transformer.daily_sales_sketches(sales_rows))
+        loader.upsert_daily_delivery_batch(self.transformer.daily_delivery_deltas(sales_rows))
+        loader.upsert_customer_lifetime_batch(self.transformer.customer_lifetime_deltas(sales_rows))
         if processed_count > 0:
             print(f"Processed {processed_count} orders")
     
     def process_cart_abandonment(self):
         """Process cart abandonment data"""
-        clicks = self.extractor.extract_clicks(self.last_run_time, limit=1000)
-        if not clicks:
-            return
+        for source_name in self.source_names('staging_clicks'):
+            self.process_source(source_name)
+            self.expire_idle_carts(source_name)
+    
+    def transform_click_batch(self, clicks, source_name='staging_clicks'):
+        """Sessionize a batch of clicks into abandoned cart lines plus the cart state to persist"""
+        sessionizer = self.sessionizer_for(source_name)
+        abandoned = sessionizer.apply(clicks)
+        return {'abandoned': abandoned, 'sessions': sessionizer.take_changes()}
+    
+    def resolve_click_keys(self, carts, loader):
+        """Resolve dimension keys for abandoned cart lines and build abandonment rows"""
+        abandoned = carts['abandoned']
+        if not abandoned:
+            return {'facts': [], 'sessions': carts['sessions'], 'rejected': []}
         
-        processed_count = 0
+        # Resolve dimensions for the whole batch at once
+        customer_ids = {line['customer_id'] for line in abandoned if line.get('customer_id')}
+        customer_keys = loader.upsert_customers(
+            list(self.get_customer_rows(customer_ids, loader).values())
+        )
+        product_rows = self.get_product_rows({line['product_id'] for line in abandoned})
+        product_keys = loader.upsert_products(list(product_rows.values()))
         
-        for click in clicks:
-            try:
-                if click.get('click_type') != 'add_to_cart':
-                    continue
-                
-                # Get dimension keys
-                customer_key = None
-                if click.get('customer_id'):
-                    customer_info = self.get_customer_info(click['customer_id'])
-                    customer_key = self.loader.upsert_customer(customer_info)
-                
-                product_info = self.get_product_info(click['product_id'])
-                product_info['product_id'] = click['product_id']
-                product_key = self.loader.upsert_product(product_info)
-                
-                date_key = self.loader.get_date_key(click['click_timestamp'])
-                
-                if not all([product_key, date_key]):
-                    continue
-                
-                # Transform for fact table
-                abandonment_data = self.transformer.transform_cart_abandonment(
-                    click, customer_key, product_key, date_key
-                )
-                
-                if abandonment_data:
-                    self.loader.insert_fact_cart_abandonment(abandonment_data)
-                    processed_count += 1
-            except Exception as e:
-                print(f"Error processing click {click.get('click_id')}: {e}")
+        abandonment_rows = []
+        # Lines that can't become facts are dead-lettered as cart lines, not as the clicks behind them
+        rejected = []
+        
+        # A line that fails here fails the batch, which is then bisected down to the clicks behind it
+        for line in abandoned:
+            # Get dimension keys
+            customer_key = customer_keys.get(line['customer_id']) if line.get('customer_id') else None
+            product_key = product_keys.get(line['product_id'])
+            date_key = loader.get_date_key(line['abandonment_time'])
+            
+            missing = [column for column, key in (('product_key', product_key), ('date_key', date_key)) if not key]
+            if missing:
+                rejected.append((line, 'resolve', RejectedRow(f"unresolved {', '.join(missing)}")))
                 continue
+            
+            # Transform for fact table
+            abandonment_data = self.transformer.transform_cart_abandonment(
+                line, customer_key, product_key, date_key, product_rows[line['product_id']]['price']
+            )
+            
+            if abandonment_data:
+                abandonment_rows.append(abandonment_data)
+            else:
+                rejected.append((line, 'transform', RejectedRow("cart line could not be transformed")))
         
+        return {'facts': abandonment_rows, 'sessions': carts['sessions'], 'rejected': rejected}
+    
+    def write_click_facts(self, carts, loader):
+        """Load a batch of fact_cart_abandonment rows set-based, with its rollup deltas and the cart state that produced them"""
+        processed_count = loader.insert_fact_cart_abandonment_batch(carts['facts'])
+        loader.upsert_daily_abandonment_batch(self.transformer.daily_abandonment_deltas(carts['facts']))
+        CartSessionStore(loader.mysql).save(carts['sessions'])
         if processed_count > 0:
             print(f"Processed {processed_count} cart abandonment records")
     
+    def expire_idle_carts(self, source_name='staging_clicks'):
+        """Abandon carts that went idle with no later clicks to close them, e.g. when traffic stops
+        
+        Carts are timed by click time, so this only runs once the source has
+        loaded every click staged before the extractor's settled bound, and
+        expires against that bound: while clicks are still waiting in staging,
+        one of them may be the next click of an idle-looking cart.
+        """
+        table, partition = parse_source_name(source_name)
+        settled_before = self.extractor.settled_before()
+        behind = self.extractor.extract_batch(
+            table, self.load_watermark(source_name), limit=1, partition=partition, settled_before=settled_before
+        )
+        if behind:
+            return
+        sessionizer = self.sessionizer_for(source_name)
+        carts = {'abandoned': sessionizer.expire(settled_before)}
+        carts['sessions'] = sessionizer.take_changes()
+        if not carts['sessions']['deletes']:
+            return
+        try:
+            with self.loader.mysql.transaction():
+                if self.leases is not None:
+                    self.leases.verify(source_name, self.loader.mysql)
+                carts = self.resolve_click_keys(carts, self.loader)
+                self.write_click_facts(carts, self.loader)
+                unsaved = self.dead_letters.record(source_name, carts['rejected'])
+        except Exception:
+            self.loader.clear_caches()
+            self.reset_state()
+            raise
+        self.dead_letters.write_fallback(unsaved)
+    
+    def load_cart_lines(self, lines, loader):
+        """Load abandoned cart lines without the sessionizer, e.g. dead-lettered ones being replayed
+        
+        Call inside a transaction; returns the lines rejected again as (line, stage, error).
+        """
+        carts = self.resolve_click_keys({'abandoned': lines, 'sessions': {'upserts': [], 'deletes': []}}, loader)
+        self.write_click_facts(carts, loader)
+        return carts['rejected']
+    
+    def process_customer_events(self):
+        """Process customer events through ETL pipeline"""
+        for source_name in self.source_names('staging_customer_events'):
+            self.process_source(source_name)
+    
+    def transform_event_batch(self, events):
+        """Transform a batch of extracted customer events column-wise, keeping the events it rejects"""
+        rejected = []
+        frame = self.transformer.clean_events_frame(events, rejected)
+        return {'frame': frame, 'rows': events, 'rejected': self.rejections(rejected, 'transform')}
+    
+    def resolve_event_keys(self, batch, loader):
+        """Resolve customer keys for cleaned events; build fact rows and counter deltas"""
+        frame = batch['frame']
+        if frame.empty:
+            return {'facts': [], 'activity': [], 'rejected': batch['rejected']}
+        
+        customer_keys = loader.upsert_customers(
+            list(self.get_customer_rows(frame['customer_id'].unique(), loader).values())
+        )
+        frame['customer_key'] = frame['customer_id'].map(customer_keys)
+        
+        rejected = batch['rejected'] + self.unresolved(batch, frame, ['customer_key', 'date_key'])
+        frame = frame.dropna(subset=['customer_key', 'date_key'])
+        return {
+            'facts': self.transformer.transform_frame_for_fact_customer_events(frame),
+            'activity': self.transformer.customer_activity_deltas(frame),
+            'rejected': rejected
+        }
+    
+    def write_event_facts(self, events, loader):
+        """Load a batch of fact_customer_events rows and add its counters to agg_customer_activity"""
+        processed_count = loader.insert_fact_customer_events_batch(events['facts'])
+        loader.upsert_customer_activity_batch(events['activity'])
+        if processed_count > 0:
+            print(f"Processed {processed_count} customer events")
+    
     def run(self):
         """Run the complete ETL pipeline"""
-        start_time = datetime.now()
-        
         try:
             self.process_orders()
             self.process_cart_abandonment()
-            self.last_run_time = start_time
+            self.process_customer_events()
+            self.maintain_staging()
         except Exception as e:
             print(f"ETL Pipeline failed: {e}")
             raise
+        finally:
+            # Hand connections back to the pool between cycles; the next cycle
+            # checks out health-checked ones
+            self.extractor.close()
+            self.loader.close()
+            for runner in self.staged_runners.values():
+                runner.close()
+            self.publish_metrics()
+    
+    def maintain_staging(self):
+        """Add upcoming staging partitions and retire expired ones, at most once per retention interval"""
+        if time.monotonic() < self.retention_due_at:
+            return
+        self.retention_due_at = time.monotonic() + ETL_CONFIG['staging_retention_interval_seconds']
+        try:
+            retired = self.retention.run()
+            if retired:
+                print(f"Retired {retired} staging partitions")
+        except Exception as e:
+            # Loading doesn't depend on it; try again next interval
+            print(f"Staging retention failed: {e}")
+    
+    def housekeeping(self):
+        """Time-driven work a run also does, for when no rows arrive to start one
+        
+        Renews (or rebalances) the partition leases, expires idle carts and runs
+        staging retention when it is due.
+        """
+        try:
+            for table in ('staging_orders', 'staging_customer_events'):
+                self.source_names(table)
+            for source_name in self.source_names('staging_clicks'):
+                self.expire_idle_carts(source_name)
+            self.maintain_staging()
         finally:
             self.extractor.close()
             self.loader.close()
     
+    def publish_metrics(self):
+        """Refresh gauges and rewrite the Prometheus metrics file"""
+        try:
+            self.loader.cache_stats()
+            for runner in self.staged_runners.values():
+                for loader in runner.loaders:
+                    loader.cache_stats()
+            metrics.write_prometheus()
+        except Exception as e:
+            print(f"Failed to publish metrics: {e}")
+    
     def run_continuous(self, interval_seconds=30):
-        """Run ETL pipeline continuously"""
+        """Run ETL pipeline continuously, in micro-batches or on a fixed interval per ETL_CONFIG['scheduler']"""
+        if ETL_CONFIG['scheduler'] == 'micro_batch':
+            MicroBatchScheduler(self).run_forever()
+            return
+        
         print(f"Starting continuous ETL pipeline (interval: {interval_seconds}s)")
+        if METRICS_CONFIG['http_port']:
+            metrics.serve_http(METRICS_CONFIG['http_port'])
         
         while True:
             try:
                 self.run()
+                if self.batch_controller is not None:
+                    # Poll sooner while data is backing up, back off while idle
+                    interval_seconds = self.batch_controller.end_cycle()
                 time.sleep(interval_seconds)
             except KeyboardInterrupt:
                 print("ETL pipeline stopped")
+                if self.leases is not None:
+                    self.leases.release_all()
                 break
             except Exception as e:
                 print(f"Error: {e}")
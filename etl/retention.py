@@ -0,0 +1,187 @@
+"""
+Staging table retention
+Keeps daily created_at partitions ready ahead of time; archives and drops the ones already loaded and past the retention window
+"""
+from utils.database_connector import MySQLConnector
+from utils.metrics import metrics
+from etl.checkpoint import CheckpointStore
+from etl.extract import STAGING_TABLES
+from config.config import ETL_CONFIG
+from datetime import date, datetime, timedelta
+import csv
+import gzip
+import logging
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Catch-all partition every staging table ends with; new days are split off it while it is empty
+FUTURE_PARTITION = 'p_future'
+# Named lock so only one of several pipeline workers runs retention at a time
+RETENTION_LOCK = 'etl_staging_retention'
+
+
+def partition_name(day):
+    """Name of the partition holding one day's rows, e.g. 'p20240131'"""
+    return f"p{day:%Y%m%d}"
+
+
+def partition_day(name):
+    """Day of a daily partition name, or None for any other partition"""
+    try:
+        return datetime.strptime(name, 'p%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+class StagingRetention:
+    """Manage the daily RANGE (UNIX_TIMESTAMP(created_at)) partitions of the staging tables
+
+    A partition may go once its upper bound is no later than both the lowest
+    committed checkpoint of its table, so every row in it was loaded, and
+    retention_days ago, so backfills and replays can still reach recent rows.
+    In 'archive' mode its rows are first written to a gzipped CSV.
+    """
+
+    def __init__(self, mysql=None, retention_days=None, days_ahead=None, mode=None, archive_dir=None):
+        self.mysql = mysql or MySQLConnector()
+        self.retention_days = ETL_CONFIG['staging_retention_days'] if retention_days is None else retention_days
+        self.days_ahead = ETL_CONFIG['staging_partitions_ahead_days'] if days_ahead is None else days_ahead
+        self.mode = mode or ETL_CONFIG['staging_retention_mode']
+        self.archive_dir = archive_dir or ETL_CONFIG['staging_archive_dir']
+
+    def partitions(self, table):
+        """Partitions of a table in order, as dicts with name, bound (None for MAXVALUE) and estimated rows"""
+        results = self.mysql.execute_query(
+            """
+            SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound, TABLE_ROWS AS estimated_rows
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+            """,
+            (table,)
+        )
+        for row in results:
+            row['bound'] = None if row['bound'] == 'MAXVALUE' else int(row['bound'])
+        return results
+
+    def earliest_day(self, table):
+        """First day whose staged rows are all still in the table, or None if it isn't partitioned by day
+
+        Earlier partitions were retired (archived under archive_dir in
+        'archive' mode), so backfills and replays cannot reach their rows.
+        """
+        days = [partition_day(partition['name']) for partition in self.partitions(table)]
+        days = [day for day in days if day is not None]
+        return min(days) if days else None
+
+    def ensure_partitions(self, table, today=None):
+        """Split daily partitions off p_future up to days_ahead from today; returns how many were added"""
+        today = today or date.today()
+        partitions = self.partitions(table)
+        if not any(partition['name'] == FUTURE_PARTITION for partition in partitions):
+            logger.warning(f"{table} has no {FUTURE_PARTITION} partition; skipping partition maintenance")
+            return 0
+
+        days = [partition_day(partition['name']) for partition in partitions]
+        days = [day for day in days if day is not None]
+        first = max(days) + timedelta(days=1) if days else today
+        new_days = [first + timedelta(days=offset) for offset in range((today + timedelta(days=self.days_ahead) - first).days + 1)]
+        if not new_days:
+            return 0
+
+        # Bounds are computed by MySQL in the session time zone, like UNIX_TIMESTAMP(created_at)
+        definitions = [
+            f"PARTITION {partition_name(day)} VALUES LESS THAN (UNIX_TIMESTAMP('{day + timedelta(days=1)} 00:00:00'))"
+            for day in new_days
+        ]
+        definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+        self.mysql.execute_query(
+            f"ALTER TABLE {table} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({', '.join(definitions)})"
+        )
+        logger.info(f"Added {len(new_days)} daily partitions to {table} ({new_days[0]} to {new_days[-1]})")
+        return len(new_days)
+
+    def cutoff(self, table):
+        """UNIX time before which a table's rows may be retired, or None while any of its sources has loaded nothing"""
+        watermark = CheckpointStore(self.mysql).lowest(table)
+        if watermark is None:
+            return None
+        result = self.mysql.execute_query(
+            "SELECT LEAST(UNIX_TIMESTAMP(%s), UNIX_TIMESTAMP(NOW() - INTERVAL %s DAY)) AS cutoff",
+            (watermark[0], self.retention_days)
+        )
+        return int(result[0]['cutoff'])
+
+    def expired_partitions(self, table):
+        """Daily partitions whose every row is loaded and older than the retention window"""
+        cutoff = self.cutoff(table)
+        if cutoff is None:
+            return []
+        return [
+            partition for partition in self.partitions(table)
+            if partition['bound'] is not None and partition['bound'] <= cutoff
+        ]
+
+    def archive_partition(self, table, name):
+        """Write one partition's rows to a gzipped CSV; returns (path, rows), path None if it was empty"""
+        directory = os.path.join(self.archive_dir, table)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{table}_{name}.csv.gz")
+        temp_path = f"{path}.tmp"
+
+        total = 0
+        with gzip.open(temp_path, 'wt', newline='', encoding='utf-8') as f:
+            writer = None
+            for rows in self.mysql.stream_query(f"SELECT * FROM {table} PARTITION ({name})", chunk_size=10000):
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+                    writer.writeheader()
+                writer.writerows(rows)
+                total += len(rows)
+        if total == 0:
+            os.remove(temp_path)
+            return None, 0
+
+        # The partition is dropped next, so the archive must be on disk first
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        metrics.inc('etl_staging_rows_archived_total', total, table=table)
+        return path, total
+
+    def retire_partition(self, table, name):
+        """Archive (in 'archive' mode) and drop one partition"""
+        if self.mode == 'archive':
+            path, rows = self.archive_partition(table, name)
+            if path:
+                logger.info(f"Archived {rows} rows of {table} partition {name} to {path}")
+        self.mysql.execute_query(f"ALTER TABLE {table} DROP PARTITION {name}")
+        metrics.inc('etl_staging_partitions_dropped_total', table=table)
+        logger.info(f"Dropped {table} partition {name}")
+
+    def prepare(self):
+        """Make sure every staging table has its upcoming daily partitions"""
+        for table in STAGING_TABLES:
+            self.ensure_partitions(table)
+
+    def run(self):
+        """Add upcoming partitions and retire expired ones on every staging table; returns partitions retired"""
+        acquired = self.mysql.execute_query("SELECT GET_LOCK(%s, 0) AS acquired", (RETENTION_LOCK,))
+        if not acquired or acquired[0]['acquired'] != 1:
+            logger.info("Staging retention is running elsewhere; skipping")
+            self.mysql.close()
+            return 0
+
+        retired = 0
+        try:
+            for table in STAGING_TABLES:
+                self.ensure_partitions(table)
+                for partition in self.expired_partitions(table):
+                    self.retire_partition(table, partition['name'])
+                    retired += 1
+        finally:
+            self.mysql.execute_query("SELECT RELEASE_LOCK(%s)", (RETENTION_LOCK,))
+            self.mysql.close()
+        return retired
@@ -0,0 +1,159 @@
+"""
+Micro-batch scheduler
+Starts a pipeline run when enough staged rows are pending or the oldest has waited max_latency_seconds
+"""
+from utils.database_connector import MySQLConnector
+from utils.staging_notify import StagingNotifyListener
+from utils.metrics import metrics
+from etl.checkpoint import CheckpointStore
+from etl.coordination import parse_source_name, partition_filter
+from etl.extract import STAGING_TABLES
+from config.config import ETL_CONFIG, METRICS_CONFIG
+import logging
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MicroBatchScheduler:
+    """Run the pipeline as soon as there is work, instead of on a fixed sleep
+
+    Between runs the scheduler waits on notifications from the generator. It
+    starts the next run once trigger_rows rows have been notified, or
+    max_latency_seconds after the first pending row was notified. Writers that
+    do not notify are caught by a probe: a COUNT capped at trigger_rows over
+    the keyset index past each held source's checkpoint, run once per poll
+    interval (the adaptive controller's interval, which grows while idle).
+    Work that doesn't wait for rows (idle cart expiry, lease renewal, staging retention) runs on
+    its own housekeeping timer while no run is due.
+    """
+
+    def __init__(self, pipeline, trigger_rows=None, max_latency_seconds=None, listener=None):
+        self.pipeline = pipeline
+        self.trigger_rows = trigger_rows or ETL_CONFIG['scheduler_trigger_rows']
+        self.max_latency = max_latency_seconds or ETL_CONFIG['scheduler_max_latency_seconds']
+        self.listener = listener or StagingNotifyListener()
+        self.mysql = MySQLConnector()
+        self.housekeeping_interval = ETL_CONFIG['scheduler_housekeeping_seconds']
+        if pipeline.leases is not None:
+            # Leases are renewed only by runs and housekeeping, so renew well before they lapse
+            self.housekeeping_interval = min(self.housekeeping_interval, pipeline.leases.lease_seconds / 3)
+        self.housekeeping_due_at = time.monotonic() + self.housekeeping_interval
+
+    def housekeeping(self):
+        """Run the pipeline's housekeeping; a failure is retried at the next interval"""
+        try:
+            self.pipeline.housekeeping()
+            metrics.inc('etl_scheduler_housekeeping_total')
+        except Exception as e:
+            print(f"Housekeeping failed: {e}")
+        self.housekeeping_due_at = time.monotonic() + self.housekeeping_interval
+
+    def probe_sources(self):
+        """Sources whose rows this worker loads: every staging table, or only the partitions it holds"""
+        if self.pipeline.leases is None:
+            return list(STAGING_TABLES)
+        return sorted(self.pipeline.leases.owned)
+
+    def probe(self, limit):
+        """Settled rows past the held sources' committed checkpoints, counted up to limit
+
+        The cap keeps each count an index range scan. Partitions are filtered
+        like the extractor does, so rows of other workers' partitions never
+        start a run here.
+        """
+        pending = 0
+        try:
+            watermarks = CheckpointStore(self.mysql).load_all()
+            for source_name in self.probe_sources():
+                table, partition = parse_source_name(source_name)
+                key_column = STAGING_TABLES[table]
+                partition_condition, partition_params = partition_filter(table, partition)
+                watermark = watermarks.get(source_name)
+                if watermark:
+                    keyset_condition = f"(created_at > %s OR (created_at = %s AND {key_column} > %s))"
+                    keyset_params = (watermark[0], watermark[0], watermark[1])
+                else:
+                    keyset_condition, keyset_params = "1 = 1", ()
+                query = f"""
+                SELECT COUNT(*) AS pending FROM (
+                    SELECT 1 FROM {table}
+                    WHERE {keyset_condition}
+                      AND created_at < NOW() - INTERVAL %s SECOND
+                      AND {partition_condition}
+                    LIMIT %s
+                ) AS page
+                """
+                params = keyset_params + (ETL_CONFIG['extract_settle_seconds'],) + partition_params + (limit - pending,)
+                pending += self.mysql.execute_query(query, params)[0]['pending']
+                if pending >= limit:
+                    break
+        except Exception as e:
+            logger.error(f"Pending-row probe failed: {e}")
+            # Run anyway rather than stall on a probe error
+            return limit
+        finally:
+            self.mysql.close()
+        metrics.inc('etl_scheduler_probes_total')
+        return pending
+
+    def wait_for_work(self, poll_interval):
+        """Block until a run is due, doing housekeeping while waiting; returns why"""
+        now = time.monotonic()
+        next_probe = now + poll_interval
+        first_pending_at = None
+
+        while True:
+            notified = self.listener.pending_rows()
+            if notified and first_pending_at is None:
+                first_pending_at = now
+            if notified >= self.trigger_rows:
+                return 'rows'
+            if first_pending_at is not None and now - first_pending_at >= self.max_latency:
+                return 'deadline'
+            if now >= next_probe:
+                # Rows found here may have waited a whole interval already, so run straight away
+                if self.probe(self.trigger_rows) > 0:
+                    return 'probe'
+                next_probe = now + poll_interval
+            if now >= self.housekeeping_due_at:
+                self.housekeeping()
+                now = time.monotonic()
+                continue
+
+            wake_at = min(next_probe, self.housekeeping_due_at)
+            if first_pending_at is not None:
+                wake_at = min(wake_at, first_pending_at + self.max_latency)
+            self.listener.wait(wake_at - now)
+            now = time.monotonic()
+
+    def run_forever(self):
+        """Run the pipeline whenever work is due, until interrupted"""
+        print(f"Starting micro-batch ETL pipeline (trigger: {self.trigger_rows} rows or {self.max_latency}s)")
+        if METRICS_CONFIG['http_port']:
+            metrics.serve_http(METRICS_CONFIG['http_port'])
+        self.listener.start()
+
+        poll_interval = ETL_CONFIG['sleep_interval']
+        try:
+            while True:
+                # Rows notified from here on may miss this run, so they count toward the next
+                self.listener.take()
+                try:
+                    self.pipeline.run()
+                    # A run does the housekeeping itself
+                    self.housekeeping_due_at = time.monotonic() + self.housekeeping_interval
+                except Exception as e:
+                    print(f"Error: {e}")
+                if self.pipeline.batch_controller is not None:
+                    poll_interval = self.pipeline.batch_controller.end_cycle()
+                reason = self.wait_for_work(poll_interval)
+                metrics.inc('etl_scheduler_runs_total', trigger=reason)
+        except KeyboardInterrupt:
+            print("ETL pipeline stopped")
+            if self.pipeline.leases is not None:
+                self.pipeline.leases.release_all()
+        finally:
+            self.listener.close()
+            self.mysql.close()
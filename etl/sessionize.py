@@ -0,0 +1,237 @@
+"""
+Incremental cart sessionization over staging_clicks
+Tracks open carts per session and emits abandoned cart lines once a session goes idle
+"""
+from config.config import ETL_CONFIG
+from etl.coordination import partition_filter
+from utils.date_dimension import DATETIME_FORMAT, to_datetime
+from utils.metrics import metrics
+from collections import OrderedDict
+from datetime import timedelta
+import json
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CartSessionizer:
+    """Match add_to_cart / remove_from_cart / checkout clicks into carts, keyed by session_id
+
+    Time is event time: a cart is abandoned once no click for its session has
+    arrived for timeout_minutes of the click timestamps seen since. Open carts
+    are kept in last-activity order and capped at max_open_carts; the least
+    recently active cart is closed as abandoned when the cap is reached.
+    """
+
+    def __init__(self, timeout_minutes=None, max_open_carts=None):
+        self.timeout = timedelta(minutes=timeout_minutes or ETL_CONFIG['cart_timeout_minutes'])
+        self.max_open_carts = max_open_carts or ETL_CONFIG['max_open_carts']
+        self.sessions = OrderedDict()  # session_id -> cart, least recently active first
+        self.clock = None  # latest click timestamp seen
+        self.dirty = set()  # sessions changed since the last take_changes()
+        self.closed = set()  # sessions closed since the last take_changes()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def restore(self, carts):
+        """Replace the in-memory state with persisted carts"""
+        self.sessions.clear()
+        self.dirty.clear()
+        self.closed.clear()
+        self.clock = None
+        for cart in sorted(carts, key=lambda cart: cart['last_event_at']):
+            self.sessions[cart['session_id']] = cart
+            self.clock = cart['last_event_at']
+        metrics.set_gauge('etl_open_cart_sessions', len(self.sessions))
+
+    def apply(self, clicks):
+        """Feed a batch of clicks; return the cart lines abandoned as a result"""
+        abandoned = []
+        timed = [(to_datetime(click['click_timestamp']), click) for click in clicks if click.get('session_id')]
+        for timestamp, click in sorted(timed, key=lambda item: (item[0], item[1].get('click_id') or '')):
+            # A session idle past the timeout is over, even if it has a new click now
+            cart = self.sessions.get(click['session_id'])
+            if cart and timestamp - cart['last_event_at'] > self.timeout:
+                abandoned.extend(self.close(click['session_id'], 'abandoned'))
+            self.clock = max(self.clock, timestamp) if self.clock else timestamp
+            abandoned.extend(self.apply_click(click, timestamp))
+
+        abandoned.extend(self.expire(self.clock))
+        metrics.set_gauge('etl_open_cart_sessions', len(self.sessions))
+        return abandoned
+
+    def apply_click(self, click, timestamp):
+        """Update one session's cart with a click"""
+        session_id = click['session_id']
+        click_type = click.get('click_type')
+        cart = self.sessions.get(session_id)
+
+        if click_type == 'add_to_cart':
+            abandoned = []
+            if cart is None:
+                if len(self.sessions) >= self.max_open_carts:
+                    abandoned = self.close(next(iter(self.sessions)), 'evicted')
+                cart = self.sessions[session_id] = {
+                    'session_id': session_id,
+                    'customer_id': click.get('customer_id'),
+                    'device_type': click.get('device_type') or 'unknown',
+                    'browser': click.get('browser') or 'unknown',
+                    'items': {},
+                    'last_event_at': timestamp
+                }
+            item = cart['items'].setdefault(click['product_id'], {'quantity': 0, 'added_at': timestamp})
+            item['quantity'] += 1
+            self.touch(cart, click, timestamp)
+            return abandoned
+
+        if cart is None:
+            # Views, removals and checkouts outside an open cart carry no cart state
+            return []
+
+        if click_type == 'checkout':
+            self.close(session_id, 'checkout')
+            return []
+
+        if click_type == 'remove_from_cart':
+            item = cart['items'].get(click['product_id'])
+            if item:
+                item['quantity'] -= 1
+                if item['quantity'] <= 0:
+                    del cart['items'][click['product_id']]
+        self.touch(cart, click, timestamp)
+        return []
+
+    def touch(self, cart, click, timestamp):
+        """Record activity on an open cart"""
+        if not cart['customer_id'] and click.get('customer_id'):
+            cart['customer_id'] = click['customer_id']
+        cart['last_event_at'] = max(cart['last_event_at'], timestamp)
+        self.sessions.move_to_end(cart['session_id'])
+        self.dirty.add(cart['session_id'])
+        self.closed.discard(cart['session_id'])
+
+    def expire(self, now):
+        """Close every cart idle for longer than the timeout at `now`; return the abandoned lines"""
+        abandoned = []
+        if now is None:
+            return abandoned
+        # Carts are in activity order, so stop at the first one still live
+        while self.sessions:
+            session_id, cart = next(iter(self.sessions.items()))
+            if now - cart['last_event_at'] <= self.timeout:
+                break
+            abandoned.extend(self.close(session_id, 'abandoned'))
+        metrics.set_gauge('etl_open_cart_sessions', len(self.sessions))
+        return abandoned
+
+    def close(self, session_id, outcome):
+        """Drop a cart; unless it checked out, return one abandoned line per product still in it"""
+        cart = self.sessions.pop(session_id)
+        self.dirty.discard(session_id)
+        self.closed.add(session_id)
+        metrics.inc('etl_cart_sessions_closed_total', outcome=outcome)
+        if outcome == 'checkout' or not cart['items']:
+            return []
+
+        items_count = sum(item['quantity'] for item in cart['items'].values())
+        return [
+            {
+                'session_id': session_id,
+                'customer_id': cart['customer_id'],
+                'product_id': product_id,
+                'quantity': item['quantity'],
+                'items_count': items_count,
+                'add_to_cart_time': item['added_at'],
+                'abandonment_time': cart['last_event_at'],
+                'device_type': cart['device_type'],
+                'browser': cart['browser']
+            }
+            for product_id, item in cart['items'].items()
+        ]
+
+    def take_changes(self):
+        """Snapshot the sessions changed and closed since the last call, for CartSessionStore.save"""
+        changes = {
+            'upserts': [CartSessionStore.session_params(self.sessions[session_id]) for session_id in sorted(self.dirty)],
+            'deletes': sorted(self.closed)
+        }
+        self.dirty = set()
+        self.closed = set()
+        return changes
+
+
+class CartSessionStore:
+    """Persist open carts in the etl_cart_sessions table"""
+
+    SESSION_UPSERT = """
+    INSERT INTO etl_cart_sessions
+    (session_id, customer_id, device_type, browser, items, last_event_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        customer_id = VALUES(customer_id),
+        items = VALUES(items),
+        last_event_at = VALUES(last_event_at)
+    """
+
+    def __init__(self, mysql):
+        # Share the loader's connector so cart state commits with the batch's facts and checkpoint
+        self.mysql = mysql
+
+    @staticmethod
+    def session_params(cart):
+        """Build the etl_cart_sessions INSERT parameters for one cart"""
+        items = {
+            product_id: {'quantity': item['quantity'], 'added_at': item['added_at'].strftime(DATETIME_FORMAT)}
+            for product_id, item in cart['items'].items()
+        }
+        return (
+            cart['session_id'],
+            cart['customer_id'],
+            cart['device_type'],
+            cart['browser'],
+            json.dumps(items, sort_keys=True),
+            cart['last_event_at']
+        )
+
+    def load(self, partition=None):
+        """Load every open cart (of one click partition if given)
+
+        Errors are raised: starting from no carts would lose the abandonment
+        facts of every cart still open, and the checkpoint would move past them.
+        """
+        partition_condition, partition_params = partition_filter('staging_clicks', partition)
+        query = f"""
+        SELECT session_id, customer_id, device_type, browser, items, last_event_at
+        FROM etl_cart_sessions
+        WHERE {partition_condition}
+        """
+        results = self.mysql.execute_query(query, partition_params or None)
+
+        carts = []
+        for row in results:
+            items = {
+                product_id: {'quantity': item['quantity'], 'added_at': to_datetime(item['added_at'])}
+                for product_id, item in json.loads(row['items']).items()
+            }
+            carts.append({
+                'session_id': row['session_id'],
+                'customer_id': row['customer_id'],
+                'device_type': row['device_type'],
+                'browser': row['browser'],
+                'items': items,
+                'last_event_at': row['last_event_at']
+            })
+        return carts
+
+    def save(self, changes):
+        """Write a take_changes() snapshot; call inside the batch's transaction"""
+        if changes['upserts']:
+            self.mysql.execute_many(self.SESSION_UPSERT, changes['upserts'])
+        if changes['deletes']:
+            placeholders = ', '.join(['%s'] * len(changes['deletes']))
+            self.mysql.execute_query(
+                f"DELETE FROM etl_cart_sessions WHERE session_id IN ({placeholders})",
+                tuple(changes['deletes'])
+            )
@@ -0,0 +1,211 @@
+"""
+Staged ETL execution
+Extract, transform and load run concurrently, connected by bounded queues
+"""
+from etl.dead_letter import DeadLetterStore
+from etl.load import Loader
+from config.config import ETL_CONFIG
+from contextlib import contextmanager
+import logging
+import queue
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's input
+DONE = object()
+
+
+class StageAborted(Exception):
+    """Raised inside a stage when another stage has failed"""
+
+
+class BatchSequencer:
+    """Let workers pass a point strictly in batch sequence order"""
+
+    def __init__(self):
+        self.next_seq = 0
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def wait_turn(self, seq):
+        """Block until every earlier batch has passed"""
+        with self.condition:
+            while self.next_seq != seq and not self.aborted:
+                self.condition.wait()
+            if self.aborted:
+                raise StageAborted()
+
+    def advance(self):
+        """Let the next batch through"""
+        with self.condition:
+            self.next_seq += 1
+            self.condition.notify_all()
+
+    def abort(self):
+        """Wake every waiter so it can give up"""
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+    @contextmanager
+    def turn(self, seq):
+        """Hold this batch's turn for the duration of a with block"""
+        self.wait_turn(seq)
+        try:
+            yield
+        finally:
+            self.advance()
+
+
+class StagedRunner:
+    """Drain one staging source with concurrent extract, transform and load stages"""
+
+    def __init__(self, pipeline, source_name, transform_workers=None, load_workers=None, queue_size=None):
+        self.pipeline = pipeline
+        self.source_name = source_name
+        self.transform_workers = transform_workers or ETL_CONFIG['transform_workers']
+        self.load_workers = load_workers or ETL_CONFIG['load_workers']
+        self.queue_size = queue_size or ETL_CONFIG['stage_queue_size']
+
+        # Each load worker owns its connection and dimension caches across runs
+        self.loaders = [Loader() for _ in range(self.load_workers)]
+
+    def run(self):
+        """Process batches until the source is drained; re-raises the first stage failure"""
+        # Queues hold at most queue_size batches each, which caps memory whatever the backlog
+        self.transform_queue = queue.Queue(maxsize=self.queue_size)
+        self.load_queue = queue.Queue(maxsize=self.queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.lock = threading.Lock()
+        self.transformers_running = self.transform_workers
+
+        # Batches reach the load queue, and commit, in extraction order
+        self.handoff = BatchSequencer()
+        self.commits = BatchSequencer()
+
+        threads = [threading.Thread(target=self.guard, args=(self.extract_stage,), daemon=True)]
+        threads += [
+            threading.Thread(target=self.guard, args=(self.transform_stage,), daemon=True)
+            for _ in range(self.transform_workers)
+        ]
+        threads += [
+            threading.Thread(target=self.guard, args=(self.load_stage, loader), daemon=True)
+            for loader in self.loaders
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def guard(self, stage, *args):
+        """Run a stage, turning its failure into a pipeline-wide abort"""
+        try:
+            stage(*args)
+        except StageAborted:
+            pass
+        except Exception as e:
+            logger.error(f"{stage.__name__} failed for {self.source_name}: {e}")
+            self.errors.append(e)
+            self.stop.set()
+            self.handoff.abort()
+            self.commits.abort()
+
+    def put(self, stage_queue, item):
+        """Put with backpressure, giving up if the run was aborted"""
+        while True:
+            if self.stop.is_set():
+                raise StageAborted()
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, stage_queue):
+        """Get the next item, giving up if the run was aborted"""
+        while True:
+            if self.stop.is_set():
+                raise StageAborted()
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def extract_stage(self):
+        """Page through the staging table and feed the transform stage"""
+        batches = self.pipeline.source_batches(self.source_name)
+        for seq, (rows, watermark) in enumerate(batches):
+            self.put(self.transform_queue, (seq, rows, watermark))
+
+        for _ in range(self.transform_workers):
+            self.put(self.transform_queue, DONE)
+
+    def transform_stage(self):
+        """Transform batches and hand them to the loaders in sequence order"""
+        transform, _, _ = self.pipeline.batch_stages(self.source_name)
+        while True:
+            item = self.get(self.transform_queue)
+            if item is DONE:
+                break
+            seq, rows, watermark = item
+            started = time.monotonic()
+            payload = transform(rows)
+            transform_seconds = time.monotonic() - started
+            with self.handoff.turn(seq):
+                self.put(self.load_queue, (seq, payload, watermark, len(rows), transform_seconds))
+
+        # The last transformer out tells the loaders there is nothing more
+        with self.lock:
+            self.transformers_running -= 1
+            last = self.transformers_running == 0
+        if last:
+            for _ in self.loaders:
+                self.put(self.load_queue, DONE)
+
+    def load_stage(self, loader):
+        """Resolve dimensions concurrently, then write facts and checkpoint in sequence order"""
+        _, resolve_keys, write_facts = self.pipeline.batch_stages(self.source_name)
+        while True:
+            item = self.get(self.load_queue)
+            if item is DONE:
+                break
+            seq, payload, watermark, row_count, transform_seconds = item
+
+            try:
+                started = time.monotonic()
+                # Dimension upserts are idempotent and commit on their own, so they
+                # can overlap across workers without holding locks for the ordered phase
+                fact_rows = resolve_keys(payload, loader)
+                work_seconds = transform_seconds + time.monotonic() - started
+
+                # Facts and checkpoint commit together, one batch at a time in order
+                self.commits.wait_turn(seq)
+                started = time.monotonic()
+                dead_letters = DeadLetterStore(loader.mysql, self.pipeline.dead_letters.fallback_file)
+                with loader.mysql.transaction():
+                    write_facts(fact_rows, loader)
+                    unsaved = dead_letters.record(self.source_name, fact_rows['rejected'])
+                    self.pipeline.save_progress(self.source_name, watermark, loader.mysql)
+                # Time queued or waiting for the commit turn is left out
+                work_seconds += time.monotonic() - started
+            except Exception:
+                # Keys cached while loading the batch may point at rolled-back rows
+                loader.clear_caches()
+                raise
+
+            self.pipeline.watermarks[self.source_name] = watermark
+            self.commits.advance()
+            dead_letters.write_fallback(unsaved)
+            self.pipeline.observe_batch(self.source_name, row_count, work_seconds)
+
+    def close(self):
+        """Return the load workers' connections to the pool"""
+        for loader in self.loaders:
+            loader.close()
@@ -4,6 +4,12 @@ Transform and clean data
 import logging
 from datetime import datetime
 import json
+import math
+import numpy as np
+import pandas as pd
+from utils.date_dimension import DATETIME_FORMAT, date_key_bounds, date_key_for
+from utils.hll import HyperLogLog
+from utils.metrics import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,8 +26,11 @@ class Transformer:
             if not all(key in order for key in ['order_id', 'customer_id', 'product_id', 'order_date']):
                 return None
             
-            # Clean numeric fields
-            order['quantity'] = max(1, int(order.get('quantity', 1)))
+            # Clean numeric fields; a fractional (or NaN) quantity is rejected, not truncated
+            quantity = float(order.get('quantity', 1))
+            if not quantity.is_integer():
+                raise ValueError(f"fractional quantity {order.get('quantity')}")
+            order['quantity'] = max(1, int(quantity))
             order['unit_price'] = max(0, float(order.get('unit_price', 0)))
             order['total_amount'] = max(0, float(order.get('total_amount', 0)))
             
@@ -54,6 +63,204 @@ class Transformer:
             logger.error(f"Failed to clean order {order.get('order_id')}: {e}")
             return None
     
+    @staticmethod
+    def parse_datetime_column(values):
+        """Parse a column of datetimes/strings; returns (parsed, invalid mask)"""
+        parsed = pd.to_datetime(values, format=DATETIME_FORMAT, errors='coerce')
+        invalid = values.notna() & parsed.isna()
+        return parsed, invalid
+    
+    @staticmethod
+    def column_or_default(frame, column, default):
+        """A frame column, or a constant column when the batch lacks that field"""
+        if column in frame.columns:
+            return frame[column]
+        return pd.Series(default, index=frame.index)
+    
+    @staticmethod
+    def field_or_default(frame, rows, column, default):
+        """A frame column where rows lacking the field take the default, as dict.get does (nulls stay null)"""
+        values = Transformer.column_or_default(frame, column, default)
+        if column in frame.columns and values.isna().any():
+            absent = pd.Series([column not in row for row in rows], index=frame.index)
+            values = values.mask(absent, default)
+        return values
+    
+    @staticmethod
+    def parses_as_nan(value):
+        """Whether float() reads a value as NaN (clean_order then clamps it to 0 rather than rejecting it)"""
+        try:
+            return math.isnan(float(value))
+        except (TypeError, ValueError):
+            return False
+    
+    @staticmethod
+    def date_key_column(dates):
+        """Vectorized YYYYMMDD date keys, null outside the dim_date calendar"""
+        keys = (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype('Int64')
+        min_key, max_key = date_key_bounds()
+        return keys.where((keys >= min_key) & (keys <= max_key))
+    
+    @staticmethod
+    def frame_to_records(frame):
+        """Convert a frame back to row dicts holding plain Python values (None for nulls)"""
+        if frame.empty:
+            return []
+        columns = {}
+        for column in frame.columns:
+            values = frame[column]
+            if pd.api.types.is_datetime64_any_dtype(values):
+                # datetime64[us] -> object yields plain datetime.datetime values
+                values = pd.Series(values.to_numpy(dtype='datetime64[us]').astype(object), index=frame.index, dtype=object)
+            else:
+                values = values.astype(object)
+            columns[column] = values.where(frame[column].notna(), None)
+        return pd.DataFrame(columns, index=frame.index).to_dict('records')
+    
+    @staticmethod
+    def reject_rows(reasons, mask, reason):
+        """Give rows in mask a rejection reason unless an earlier check already rejected them"""
+        reasons[mask & reasons.isna()] = reason
+    
+    @staticmethod
+    def collect_rejections(rows, reasons, rejected):
+        """Append (row, reason) for every rejected row of a batch when the caller asked for them"""
+        if rejected is not None:
+            rejected.extend((rows[index], reason) for index, reason in reasons.dropna().items())
+    
+    @staticmethod
+    def clean_orders_frame(orders, rejected=None):
+        """Clean and validate a batch of orders column-wise; keeps the rows clean_order keeps
+        
+        When a rejected list is given, each dropped order is appended to it as (order, reason).
+        """
+        with metrics.track_stage('transform', 'staging_orders') as tracker:
+            frame = Transformer.clean_orders_columns(orders, rejected)
+            tracker['rows'] = len(frame)
+        metrics.inc('etl_rows_rejected_total', len(orders) - len(frame), stage='transform', table='staging_orders')
+        return frame
+    
+    @staticmethod
+    def clean_orders_columns(orders, rejected=None):
+        """Column-wise cleaning behind clean_orders_frame"""
+        frame = pd.DataFrame.from_records(orders)
+        missing = [key for key in ['order_id', 'customer_id', 'product_id', 'order_date'] if key not in frame.columns]
+        if frame.empty or missing:
+            Transformer.collect_rejections(
+                orders, pd.Series(f"missing {', '.join(missing)}", index=frame.index, dtype=object), rejected
+            )
+            return frame.iloc[0:0]
+        
+        # Rows the per-row path rejects: non-numeric amounts, bad dates, missing strings
+        reasons = pd.Series(None, index=frame.index, dtype=object)
+        
+        # Clean numeric fields
+        defaults = {'quantity': 1, 'unit_price': 0, 'total_amount': 0}
+        numeric = {}
+        for column, default in defaults.items():
+            values = pd.to_numeric(Transformer.field_or_default(frame, orders, column, default), errors='coerce')
+            if column != 'quantity':
+                # An actual NaN amount is kept as 0 like max(0, nan) in clean_order; only the few nulls are checked
+                nan = [
+                    index for index in values.index[values.isna()]
+                    if Transformer.parses_as_nan(orders[index].get(column, default))
+                ]
+                values[nan] = 0
+            numeric[column] = values
+            Transformer.reject_rows(reasons, values.isna(), f"non-numeric {column}")
+        quantity = numeric['quantity'].astype('float64')
+        Transformer.reject_rows(
+            reasons, ~np.isfinite(quantity) | (quantity != np.trunc(quantity)), "fractional quantity"
+        )
+        frame['quantity'] = np.maximum(1, quantity.where(np.isfinite(quantity), 1)).astype('int64')
+        frame['unit_price'] = np.maximum(0, numeric['unit_price'].fillna(0)).astype('float64')
+        frame['total_amount'] = np.maximum(0, numeric['total_amount'].fillna(0)).astype('float64')
+        
+        # Parse dates; empty delivery dates become null
+        frame['order_date'], invalid = Transformer.parse_datetime_column(frame['order_date'])
+        Transformer.reject_rows(reasons, invalid, "unparseable order_date")
+        delivery = Transformer.column_or_default(frame, 'delivery_date', None)
+        delivery = delivery.where(delivery.astype(bool) & delivery.notna())
+        frame['delivery_date'], invalid = Transformer.parse_datetime_column(delivery)
+        Transformer.reject_rows(reasons, invalid, "unparseable delivery_date")
+        
+        # Calculate delivery time in hours (truncated like int())
+        hours = (frame['delivery_date'] - frame['order_date']).dt.total_seconds() / 3600
+        frame['delivery_time_hours'] = np.trunc(hours).astype('Int64')
+        
+        # Clean string fields
+        string_defaults = {'order_status': 'pending', 'city': '', 'state': '', 'country': ''}
+        for column, default in string_defaults.items():
+            values = Transformer.field_or_default(frame, orders, column, default)
+            # .str yields null for non-strings, which the per-row path rejects
+            values = values.str.lower() if column == 'order_status' else values.str.strip()
+            Transformer.reject_rows(reasons, values.isna(), f"{column} is not text")
+            frame[column] = values
+        
+        Transformer.collect_rejections(orders, reasons, rejected)
+        frame = frame[reasons.isna()].copy()
+        frame['date_key'] = Transformer.date_key_column(frame['order_date'])
+        return frame
+    
+    @staticmethod
+    def clean_orders(orders):
+        """Clean a batch of orders; same rows as clean_order plus a calendar-resolved date_key"""
+        return Transformer.frame_to_records(Transformer.clean_orders_frame(orders))
+    
+    @staticmethod
+    def parse_json_column(values):
+        """Parse a column of JSON documents (strings, dicts or nulls) into a frame of their top-level fields"""
+        documents = []
+        for value in values:
+            if isinstance(value, (str, bytes)):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    value = None
+            documents.append(value if isinstance(value, dict) else {})
+        return pd.json_normalize(documents, max_level=0).set_axis(values.index)
+    
+    @staticmethod
+    def clean_events_frame(events, rejected=None):
+        """Clean and validate a batch of customer events column-wise
+        
+        When a rejected list is given, each dropped event is appended to it as (event, reason).
+        """
+        with metrics.track_stage('transform', 'staging_customer_events') as tracker:
+            frame = Transformer.clean_events_columns(events, rejected)
+            tracker['rows'] = len(frame)
+        metrics.inc('etl_rows_rejected_total', len(events) - len(frame), stage='transform', table='staging_customer_events')
+        return frame
+    
+    @staticmethod
+    def clean_events_columns(events, rejected=None):
+        """Column-wise cleaning behind clean_events_frame"""
+        frame = pd.DataFrame.from_records(events)
+        missing = [key for key in ['event_id', 'customer_id', 'event_type', 'event_timestamp'] if key not in frame.columns]
+        if frame.empty or missing:
+            Transformer.collect_rejections(
+                events, pd.Series(f"missing {', '.join(missing)}", index=frame.index, dtype=object), rejected
+            )
+            return frame.iloc[0:0]
+        
+        reasons = pd.Series(None, index=frame.index, dtype=object)
+        frame['event_timestamp'], invalid = Transformer.parse_datetime_column(frame['event_timestamp'])
+        Transformer.reject_rows(reasons, invalid, "unparseable event_timestamp")
+        Transformer.reject_rows(reasons, frame['event_timestamp'].isna(), "missing event_timestamp")
+        Transformer.reject_rows(reasons, frame['customer_id'].isna(), "missing customer_id")
+        frame['event_type'] = frame['event_type'].str.strip().str.lower()
+        Transformer.reject_rows(reasons, frame['event_type'].isna(), "event_type is not text")
+        Transformer.collect_rejections(events, reasons, rejected)
+        frame = frame[reasons.isna()].copy()
+        
+        # Parse every event_data document in one pass and keep the fields we report on
+        details = Transformer.parse_json_column(Transformer.column_or_default(frame, 'event_data', None))
+        frame['event_source'] = Transformer.column_or_default(details, 'source', None)
+        frame['field_updated'] = Transformer.column_or_default(details, 'field_updated', None)
+        
+        frame['date_key'] = Transformer.date_key_column(frame['event_timestamp'])
+        return frame
+    
     @staticmethod
     def transform_for_dim_customer(customer_data):
         """Transform data for customer dimension"""
@@ -139,29 +346,192 @@ class Transformer:
             return None
     
     @staticmethod
-    def transform_cart_abandonment(click, customer_key, product_key, date_key):
-        """Transform click data for cart abandonment fact table"""
+    def transform_frame_for_fact_sales(frame):
+        """Build fact_sales rows for a cleaned frame that carries dimension key columns"""
+        key_columns = ['customer_key', 'product_key', 'location_key', 'date_key']
+        frame = frame.dropna(subset=key_columns)
+        if frame.empty:
+            return []
+        
+        facts = pd.DataFrame({
+            'date_key': frame['date_key'].astype('int64'),
+            'customer_key': frame['customer_key'].astype('int64'),
+            'product_key': frame['product_key'].astype('int64'),
+            'location_key': frame['location_key'].astype('int64'),
+            'order_id': frame['order_id'],
+            'order_date': frame['order_date'],
+            'quantity': frame['quantity'].astype('int64'),
+            'unit_price': frame['unit_price'].astype('float64'),
+            'total_amount': frame['total_amount'].astype('float64'),
+            'discount_amount': pd.to_numeric(Transformer.column_or_default(frame, 'discount_amount', 0)).astype('float64'),
+            'shipping_cost': pd.to_numeric(Transformer.column_or_default(frame, 'shipping_cost', 0)).astype('float64'),
+            'payment_method': Transformer.column_or_default(frame, 'payment_method', 'unknown'),
+            'delivery_date': frame['delivery_date'],
+            'delivery_time_hours': frame['delivery_time_hours'],
+            'order_status': Transformer.column_or_default(frame, 'order_status', 'pending')
+        }, index=frame.index)
+        return Transformer.frame_to_records(facts)
+    
+    @staticmethod
+    def transform_frame_for_fact_customer_events(frame):
+        """Build fact_customer_events rows for a cleaned frame that carries customer_key"""
+        frame = frame.dropna(subset=['customer_key', 'date_key'])
+        if frame.empty:
+            return []
+        
+        facts = pd.DataFrame({
+            'date_key': frame['date_key'].astype('int64'),
+            'customer_key': frame['customer_key'].astype('int64'),
+            'event_id': frame['event_id'],
+            'event_type': frame['event_type'],
+            'event_timestamp': frame['event_timestamp'],
+            'session_id': Transformer.column_or_default(frame, 'session_id', None),
+            'event_source': frame['event_source'],
+            'field_updated': frame['field_updated']
+        }, index=frame.index)
+        return Transformer.frame_to_records(facts)
+    
+    @staticmethod
+    def customer_activity_deltas(frame):
+        """Per-customer login/signup counts and latest activity for one batch of cleaned, keyed events"""
+        frame = frame.dropna(subset=['customer_key'])
+        if frame.empty:
+            return []
+        
+        logins = frame['event_type'] == 'login'
+        activity = pd.DataFrame({
+            'customer_key': frame['customer_key'].astype('int64'),
+            'login_count': logins.astype('int64'),
+            'signup_count': (frame['event_type'] == 'signup').astype('int64'),
+            'last_login_at': frame['event_timestamp'].where(logins),
+            'last_event_at': frame['event_timestamp']
+        })
+        deltas = activity.groupby('customer_key', as_index=False).agg({
+            'login_count': 'sum',
+            'signup_count': 'sum',
+            'last_login_at': 'max',
+            'last_event_at': 'max'
+        })
+        return Transformer.frame_to_records(deltas)
+    
+    @staticmethod
+    def customer_lifetime_deltas(sales_rows):
+        """Per-customer order count, spend, order date range and latest location for one batch of fact_sales rows"""
+        if not sales_rows:
+            return []
+        frame = pd.DataFrame(sales_rows)
+        frame['order_date'] = pd.to_datetime(frame['order_date'])
+        frame['total_amount'] = pd.to_numeric(frame['total_amount'])
+        # Stable sort, so 'last' is the location of each customer's latest order
+        frame = frame.sort_values(['customer_key', 'order_date'], kind='stable')
+        deltas = frame.groupby('customer_key', as_index=False).agg(
+            total_orders=('order_id', 'size'),
+            total_spent=('total_amount', 'sum'),
+            first_order_date=('order_date', 'min'),
+            last_order_date=('order_date', 'max'),
+            current_location_key=('location_key', 'last')
+        )
+        deltas['total_spent'] = deltas['total_spent'].round(2)
+        return Transformer.frame_to_records(deltas)
+    
+    @staticmethod
+    def daily_sales_deltas(sales_rows):
+        """agg_daily_sales deltas of one batch of fact_sales rows, per (date_key, product_key)
+        
+        Distinct customers don't add up across batches, so they come from the
+        cell's customer sketch instead (see daily_sales_sketches).
+        """
+        if not sales_rows:
+            return []
+        frame = pd.DataFrame(sales_rows)
+        deltas = frame.assign(total_amount=pd.to_numeric(frame['total_amount'])).groupby(['date_key', 'product_key']).agg(
+            order_count=('order_id', 'size'),
+            total_quantity=('quantity', 'sum'),
+            total_sales=('total_amount', 'sum')
+        )
+        deltas['total_sales'] = deltas['total_sales'].round(2)
+        return Transformer.frame_to_records(deltas.reset_index())
+    
+    @staticmethod
+    def daily_sales_sketches(sales_rows):
+        """Customer and order HyperLogLog sketches of one batch of fact_sales rows, per (date_key, product_key)"""
+        cells = {}
+        for row in sales_rows:
+            key = (row['date_key'], row['product_key'])
+            cells.setdefault(key, ([], []))
+            cells[key][0].append(row['customer_key'])
+            cells[key][1].append(row['order_id'])
+        return [
+            {
+                'date_key': date_key,
+                'product_key': product_key,
+                'customers_sketch': HyperLogLog().update(customers),
+                'orders_sketch': HyperLogLog().update(orders),
+            }
+            # Sorted like the deltas, so concurrent batches lock rollup rows in the same order
+            for (date_key, product_key), (customers, orders) in sorted(cells.items())
+        ]
+    
+    @staticmethod
+    def daily_delivery_deltas(sales_rows):
+        """agg_daily_delivery deltas of one batch of fact_sales rows with a delivery time"""
+        if not sales_rows:
+            return []
+        frame = pd.DataFrame(sales_rows)
+        frame = frame[frame['delivery_time_hours'].notna()]
+        if frame.empty:
+            return []
+        hours = frame['delivery_time_hours'].astype('int64')
+        deltas = frame.assign(hours=hours).groupby(['date_key', 'location_key', 'product_key', 'order_status']).agg(
+            delivery_count=('hours', 'size'),
+            delivery_hours_sum=('hours', 'sum'),
+            min_delivery_hours=('hours', 'min'),
+            max_delivery_hours=('hours', 'max')
+        )
+        return Transformer.frame_to_records(deltas.reset_index())
+    
+    @staticmethod
+    def daily_abandonment_deltas(abandonment_rows):
+        """agg_daily_abandonment deltas of one batch of fact_cart_abandonment rows"""
+        if not abandonment_rows:
+            return []
+        frame = pd.DataFrame(abandonment_rows)
+        # Key columns can't be NULL; unknown devices and browsers roll up under ''
+        frame['device_type'] = frame['device_type'].fillna('')
+        frame['browser'] = frame['browser'].fillna('')
+        minutes = pd.to_numeric(frame['time_to_abandonment_minutes'])
+        items = pd.to_numeric(frame['items_count'])
+        frame['cart_value'] = pd.to_numeric(frame['cart_value'])
+        deltas = frame.assign(minutes=minutes, items=items).groupby(['date_key', 'product_key', 'device_type', 'browser']).agg(
+            abandonment_count=('session_id', 'size'),
+            total_abandoned_value=('cart_value', 'sum'),
+            abandonment_minutes_sum=('minutes', 'sum'),
+            abandonment_minutes_count=('minutes', 'count'),
+            items_count_sum=('items', 'sum'),
+            items_count_count=('items', 'count')
+        )
+        deltas['total_abandoned_value'] = deltas['total_abandoned_value'].round(2)
+        deltas[['abandonment_minutes_sum', 'items_count_sum']] = deltas[['abandonment_minutes_sum', 'items_count_sum']].astype('int64')
+        return Transformer.frame_to_records(deltas.reset_index())
+    
+    @staticmethod
+    def transform_cart_abandonment(cart_line, customer_key, product_key, date_key, unit_price):
+        """Transform an abandoned cart line from the sessionizer for the cart abandonment fact table"""
         try:
-            if click.get('click_type') != 'add_to_cart':
-                return None
-            
-            # Find related checkout attempts or abandonment
-            add_to_cart_time = click['click_timestamp']
-            if isinstance(add_to_cart_time, str):
-                add_to_cart_time = datetime.strptime(add_to_cart_time, '%Y-%m-%d %H:%M:%S')
+            idle_seconds = (cart_line['abandonment_time'] - cart_line['add_to_cart_time']).total_seconds()
             
             return {
                 'date_key': date_key,
                 'customer_key': customer_key,
                 'product_key': product_key,
-                'session_id': click.get('session_id'),
-                'add_to_cart_time': add_to_cart_time,
-                'abandonment_time': add_to_cart_time,  # Simplified - would need more logic
-                'time_to_abandonment_minutes': 30,  # Default value
-                'cart_value': 0,  # Would need to calculate from session
-                'items_count': 1,
-                'device_type': click.get('device_type', 'unknown'),
-                'browser': click.get('browser', 'unknown')
+                'session_id': cart_line['session_id'],
+                'add_to_cart_time': cart_line['add_to_cart_time'],
+                'abandonment_time': cart_line['abandonment_time'],
+                'time_to_abandonment_minutes': int(max(0, idle_seconds) // 60),
+                'cart_value': round(float(unit_price or 0) * cart_line['quantity'], 2),
+                'items_count': cart_line['items_count'],
+                'device_type': cart_line.get('device_type', 'unknown'),
+                'browser': cart_line.get('browser', 'unknown')
             }
         except Exception as e:
             logger.error(f"Failed to transform cart abandonment: {e}")
@@ -171,16 +541,7 @@ class Transformer:
     def get_date_key(date):
         """Get date key from date (YYYYMMDD format)"""
         try:
-            if isinstance(date, str):
-                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
-            elif isinstance(date, datetime):
-                pass
-            else:
-                return None
-            
-            return int(date.strftime('%Y%m%d'))
+            return date_key_for(date)
         except Exception as e:
             logger.error(f"Failed to get date key: {e}")
             return None
-
-
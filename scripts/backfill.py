@@ -0,0 +1,352 @@
+"""
+Parallel date-range backfill
+Rebuilds facts for a range of business dates, one partition per process, resumable after a crash
+
+    python scripts/backfill.py --source orders --start 2024-01-01 --end 2024-01-31 --replace
+
+Only staging rows the continuous pipeline has already passed (up to its
+checkpoint when the backfill was registered) are backfilled, so the two never
+load the same row. Staging retention drops partitions ETL_STAGING_RETENTION_DAYS
+after they load, so a range starting before the oldest remaining day is refused. Without --replace, only rows missing from the fact table are
+loaded. With --replace, each batch's facts are deleted and reloaded in one
+transaction, and derived tables are rebuilt at the end; run it while the
+continuous pipeline is stopped so its incremental counters are not overwritten.
+Every batch commits with its partition's cursor in etl_backfill_progress, so a
+rerun resumes after the last committed batch.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from utils.database_connector import MySQLConnector
+from utils.date_dimension import date_key_for
+from utils.hll import HyperLogLog
+from etl.checkpoint import CheckpointStore
+from etl.load import Loader
+from etl.retention import StagingRetention
+from config.config import ETL_CONFIG
+
+# Backfillable sources. Clicks are not: carts are sessionized in click order
+# across batches, which independent date partitions cannot reproduce.
+BACKFILL_SOURCES = {
+    'orders': {
+        'table': 'staging_orders',
+        'key_column': 'order_id',
+        'date_column': 'order_date',
+        'fact_table': 'fact_sales',
+        'fact_key': 'order_id',
+    },
+    'events': {
+        'table': 'staging_customer_events',
+        'key_column': 'event_id',
+        'date_column': 'event_timestamp',
+        'fact_table': 'fact_customer_events',
+        'fact_key': 'event_id',
+    },
+}
+
+# Tables derived from each source's facts, recomputed after a --replace backfill
+DERIVED_REBUILDS = {
+    # Daily rollups are rebuilt for the backfilled dates only; a replaced partition's
+    # facts were deleted and reinserted, so incremental upserts counted them twice
+    'orders': [
+        "DELETE FROM agg_daily_sales WHERE date_key BETWEEN %(first_key)s AND %(last_key)s",
+        """
+        INSERT INTO agg_daily_sales (date_key, product_key, order_count, total_quantity, total_sales)
+        SELECT date_key, product_key, COUNT(*), SUM(quantity), SUM(total_amount)
+        FROM fact_sales
+        WHERE date_key BETWEEN %(first_key)s AND %(last_key)s
+        GROUP BY date_key, product_key
+        """,
+        "DELETE FROM agg_daily_delivery WHERE date_key BETWEEN %(first_key)s AND %(last_key)s",
+        """
+        INSERT INTO agg_daily_delivery
+        (date_key, location_key, product_key, order_status, delivery_count, delivery_hours_sum,
+         min_delivery_hours, max_delivery_hours)
+        SELECT date_key, location_key, product_key, order_status, COUNT(*), SUM(delivery_time_hours),
+               MIN(delivery_time_hours), MAX(delivery_time_hours)
+        FROM fact_sales
+        WHERE date_key BETWEEN %(first_key)s AND %(last_key)s AND delivery_time_hours IS NOT NULL
+        GROUP BY date_key, location_key, product_key, order_status
+        """,
+        # Lifetimes span every date, so they are rebuilt whole
+        "DELETE FROM customer_lifetime",
+        """
+        INSERT INTO customer_lifetime
+        (customer_key, total_orders, total_spent, first_order_date, last_order_date, current_location_key)
+        SELECT customer_key, COUNT(*), SUM(total_amount), MIN(order_date), MAX(order_date),
+               SUBSTRING_INDEX(GROUP_CONCAT(location_key ORDER BY order_date DESC), ',', 1)
+        FROM fact_sales
+        GROUP BY customer_key
+        """,
+    ],
+    'events': [
+        """
+        UPDATE agg_customer_activity
+        SET login_count = 0, signup_count = 0, last_login_at = NULL
+        """,
+        """
+        INSERT INTO agg_customer_activity (customer_key, login_count, signup_count, last_login_at, last_event_at)
+        SELECT customer_key,
+               SUM(event_type = 'login'),
+               SUM(event_type = 'signup'),
+               MAX(CASE WHEN event_type = 'login' THEN event_timestamp END),
+               MAX(event_timestamp)
+        FROM fact_customer_events
+        GROUP BY customer_key
+        ON DUPLICATE KEY UPDATE
+            login_count = VALUES(login_count),
+            signup_count = VALUES(signup_count),
+            last_login_at = VALUES(last_login_at),
+            last_event_at = VALUES(last_event_at)
+        """,
+    ],
+}
+
+# Pipeline of the current worker process, reused across its partitions
+_pipeline = None
+
+
+def init_worker():
+    """Give each worker process its own pipeline, connections and dimension caches"""
+    global _pipeline
+    from etl.pipeline import ETLPipeline
+    _pipeline = ETLPipeline()
+
+
+def date_partitions(start_date, end_date, partition_days):
+    """Split an inclusive date range into [start, end) partitions of partition_days"""
+    partitions = []
+    current = start_date
+    while current <= end_date:
+        partition_end = min(current + timedelta(days=partition_days), end_date + timedelta(days=1))
+        partitions.append((current, partition_end))
+        current = partition_end
+    return partitions
+
+
+def register_partitions(mysql, backfill_id, source, partitions, watermark):
+    """Record the partitions of a backfill; rows of an earlier run keep their status, watermark and cursor"""
+    mysql.execute_many(
+        """
+        INSERT IGNORE INTO etl_backfill_progress
+        (backfill_id, source, partition_start, partition_end, status, last_created_at, last_id)
+        VALUES (%s, %s, %s, %s, 'pending', %s, %s)
+        """,
+        [(backfill_id, source, start, end, watermark[0], watermark[1]) for start, end in partitions]
+    )
+    return mysql.execute_query(
+        """
+        SELECT partition_start, partition_end, last_created_at, last_id, rows_loaded, resume_at, resume_key
+        FROM etl_backfill_progress
+        WHERE backfill_id = %s AND source = %s AND status <> 'done'
+        ORDER BY partition_start
+        """,
+        (backfill_id, source)
+    )
+
+
+def set_status(mysql, backfill_id, source, partition_start, status, rows_loaded=None):
+    """Update one partition's progress row"""
+    mysql.execute_query(
+        """
+        UPDATE etl_backfill_progress
+        SET status = %s, rows_loaded = COALESCE(%s, rows_loaded),
+            started_at = IF(%s = 'running', NOW(), started_at),
+            finished_at = IF(%s IN ('done', 'failed'), NOW(), finished_at)
+        WHERE backfill_id = %s AND source = %s AND partition_start = %s
+        """,
+        (status, rows_loaded, status, status, backfill_id, source, partition_start)
+    )
+
+
+def save_cursor(mysql, backfill_id, source, partition_start, resume_at, resume_key, rows_loaded):
+    """Record the last staging row a partition committed; call inside the batch's transaction"""
+    mysql.execute_query(
+        """
+        UPDATE etl_backfill_progress
+        SET resume_at = %s, resume_key = %s, rows_loaded = %s
+        WHERE backfill_id = %s AND source = %s AND partition_start = %s
+        """,
+        (resume_at, resume_key, rows_loaded, backfill_id, source, partition_start)
+    )
+
+
+def run_partition(backfill_id, source, progress, replace, batch_size):
+    """Backfill one date partition a batch per transaction; returns the number of staging rows loaded
+
+    progress is the partition's etl_backfill_progress row. Each batch commits
+    with the partition's cursor, like the pipeline's checkpoints, so a rerun
+    resumes after the last committed batch and no transaction holds dimension
+    or rollup rows for longer than one batch.
+    """
+    spec = BACKFILL_SOURCES[source]
+    table, key, date_column = spec['table'], spec['key_column'], spec['date_column']
+    partition_start = progress['partition_start']
+    pipeline = _pipeline
+    mysql = pipeline.loader.mysql
+    set_status(mysql, backfill_id, source, partition_start, 'running')
+
+    # Rows of the partition the continuous pipeline has already passed
+    conditions = f"""
+        s.{date_column} >= %s AND s.{date_column} < %s
+        AND (s.created_at < %s OR (s.created_at = %s AND s.{key} <= %s))
+    """
+    params = (
+        partition_start, progress['partition_end'],
+        progress['last_created_at'], progress['last_created_at'], progress['last_id']
+    )
+    if progress['resume_at'] is not None:
+        conditions += f" AND (s.{date_column} > %s OR (s.{date_column} = %s AND s.{key} > %s))"
+        params += (progress['resume_at'], progress['resume_at'], progress['resume_key'])
+    if not replace:
+        conditions += f" AND NOT EXISTS (SELECT 1 FROM {spec['fact_table']} f WHERE f.{spec['fact_key']} = s.{key})"
+
+    loaded = progress['rows_loaded']
+    try:
+        # Streamed on a separate connection; batches load through the pipeline's own steps,
+        # with rows that fail on their own dead-lettered as in a live run
+        query = f"SELECT s.* FROM {table} s WHERE {conditions} ORDER BY s.{date_column}, s.{key}"
+        for rows in mysql.stream_query(query, params, chunk_size=batch_size):
+            failures = []
+            # The cursor still moves past skipped duplicates
+            cursor_row = rows[-1]
+            rows = pipeline.extractor.drop_duplicate_ids(table, rows)
+            with mysql.transaction():
+                if replace and rows:
+                    # Only this batch's facts, so a crash never leaves deleted facts unreloaded
+                    mysql.execute_query(
+                        f"DELETE FROM {spec['fact_table']} WHERE {spec['fact_key']} IN ({', '.join(['%s'] * len(rows))})",
+                        tuple(row[key] for row in rows)
+                    )
+                pipeline.load_isolating(table, rows, pipeline.loader, failures, pipeline.max_dead_letters(len(rows)))
+                unsaved = pipeline.dead_letters.record(table, failures)
+                save_cursor(
+                    mysql, backfill_id, source, partition_start,
+                    cursor_row[date_column], cursor_row[key], loaded + len(rows) - len(failures)
+                )
+            loaded += len(rows) - len(failures)
+            pipeline.dead_letters.write_fallback(unsaved)
+        set_status(mysql, backfill_id, source, partition_start, 'done', loaded)
+    except Exception:
+        pipeline.loader.clear_caches()
+        pipeline.reset_state()
+        set_status(mysql, backfill_id, source, partition_start, 'failed')
+        raise
+    return loaded
+
+
+def rebuild_sales_sketches(mysql, first_key, last_key):
+    """Recompute the agg_daily_sales HyperLogLog sketches, and the unique customers estimated from them,
+    of a date-key range from fact_sales, one day at a time"""
+    def write(cells):
+        params_list = []
+        for (date_key, product_key), (customers, orders) in sorted(cells.items()):
+            customers = HyperLogLog().update(customers)
+            params_list.append((
+                date_key, product_key, customers.to_bytes(), HyperLogLog().update(orders).to_bytes(), customers.count()
+            ))
+        mysql.execute_many(Loader.DAILY_SALES_SKETCH_UPDATE, params_list)
+
+    cells, day = {}, None
+    query = """
+    SELECT date_key, product_key, customer_key, order_id FROM fact_sales
+    WHERE date_key BETWEEN %s AND %s
+    ORDER BY date_key
+    """
+    for row in mysql.stream_rows(query, (first_key, last_key), chunk_size=10000):
+        if row['date_key'] != day and cells:
+            write(cells)
+            cells = {}
+        day = row['date_key']
+        customers, orders = cells.setdefault((row['date_key'], row['product_key']), ([], []))
+        customers.append(row['customer_key'])
+        orders.append(row['order_id'])
+    if cells:
+        write(cells)
+
+
+def rebuild_derived(mysql, source, start_date, end_date):
+    """Recompute the tables derived from a source's facts over the backfilled dates"""
+    params = {'first_key': date_key_for(start_date), 'last_key': date_key_for(end_date)}
+    with mysql.transaction():
+        for statement in DERIVED_REBUILDS[source]:
+            mysql.execute_query(statement, params)
+        if source == 'orders':
+            # Sketches can't be built in SQL, so they follow the rows just rebuilt
+            rebuild_sales_sketches(mysql, params['first_key'], params['last_key'])
+
+
+def backfill(sources, start_date, end_date, partition_days=1, workers=None, replace=False, backfill_id=None, batch_size=None):
+    """Backfill every source over the date range; returns True if every partition succeeded"""
+    batch_size = batch_size or ETL_CONFIG['batch_size']
+    workers = workers or os.cpu_count()
+    partitions = date_partitions(start_date, end_date, partition_days)
+    succeeded = True
+
+    with MySQLConnector() as mysql:
+        for source in sources:
+            run_id = backfill_id or f"{source}:{start_date}:{end_date}:{'replace' if replace else 'fill'}"
+            watermark = CheckpointStore(mysql).lowest(BACKFILL_SOURCES[source]['table'])
+            if watermark is None:
+                print(f"{source}: the continuous pipeline has not loaded every partition yet, nothing to backfill")
+                continue
+            earliest = StagingRetention(mysql).earliest_day(BACKFILL_SOURCES[source]['table'])
+            if earliest is not None and start_date < earliest:
+                # Rows of those days were retired from staging; a backfill would silently miss them
+                print(
+                    f"{source}: staging rows before {earliest} were retired (see ETL_STAGING_RETENTION_DAYS "
+                    f"and {ETL_CONFIG['staging_archive_dir']}/); start the backfill on {earliest} or later"
+                )
+                succeeded = False
+                continue
+
+            pending = register_partitions(mysql, run_id, source, partitions, watermark)
+            print(f"{source}: {len(pending)} of {len(partitions)} partitions to run (backfill {run_id})")
+            if not pending:
+                continue
+
+            failed = 0
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+                futures = {
+                    pool.submit(run_partition, run_id, source, row, replace, batch_size): row['partition_start']
+                    for row in pending
+                }
+                for future in as_completed(futures):
+                    try:
+                        print(f"{source} {futures[future]}: loaded {future.result()} rows")
+                    except Exception as e:
+                        failed += 1
+                        print(f"{source} {futures[future]}: failed: {e}")
+
+            if failed:
+                succeeded = False
+                print(f"{source}: {failed} partitions failed; rerun the same command to resume")
+            elif replace:
+                rebuild_derived(mysql, source, start_date, end_date)
+                print(f"{source}: rebuilt derived tables")
+    return succeeded
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill facts for a range of business dates")
+    parser.add_argument('--source', action='append', choices=sorted(BACKFILL_SOURCES), required=True,
+                        help="source to backfill (repeatable)")
+    parser.add_argument('--start', type=parse_date, required=True, help="first date, YYYY-MM-DD")
+    parser.add_argument('--end', type=parse_date, required=True, help="last date (inclusive), YYYY-MM-DD")
+    parser.add_argument('--partition-days', type=int, default=1, help="days per partition")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--replace', action='store_true', help="delete and reload each partition's facts")
+    parser.add_argument('--backfill-id', default=None, help="progress id to resume (default: derived from the arguments)")
+    args = parser.parse_args()
+
+    ok = backfill(args.source, args.start, args.end, args.partition_days, args.workers, args.replace, args.backfill_id)
+    sys.exit(0 if ok else 1)
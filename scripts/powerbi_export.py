@@ -4,14 +4,34 @@ Exports data from data warehouse in Power BI compatible format
 """
 import sys
 import os
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Add project root to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.database_connector import MySQLConnector
+from utils.hll import HyperLogLog
 
+# Period start of a date for each grain of the unique-count export
+UNIQUE_COUNT_PERIODS = {
+    'day': lambda day: day,
+    'week': lambda day: day - timedelta(days=day.weekday()),
+    'month': lambda day: day.replace(day=1),
+}
+
+
+def rfm_scores(recency_days, frequency, monetary, bins=5):
+    """Quantile scores from 1 to bins for recency, frequency and monetary value
+
+    Recent, frequent and high-spending customers score highest.
+    """
+    def score(values):
+        edges = np.quantile(values, np.linspace(0, 1, bins + 1)[1:-1])
+        return np.searchsorted(edges, values, side='right') + 1
+
+    return bins + 1 - score(recency_days), score(frequency), score(monetary)
 
 
 class PowerBIExporter:
@@ -23,8 +43,27 @@ class PowerBIExporter:
         self.export_dir = "powerbi_exports"
         os.makedirs(self.export_dir, exist_ok=True)
     
+    def export_filename(self, name):
+        return f"{self.export_dir}/{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    
+    def export_query(self, query, name, chunk_size=10000):
+        """Stream a query's result into a timestamped CSV, one chunk at a time"""
+        filename = self.export_filename(name)
+        total = 0
+        
+        # Server-side cursor: only chunk_size rows are held in memory at once
+        with open(filename, 'w', newline='') as f:
+            for rows in self.mysql.stream_query(query, chunk_size=chunk_size):
+                pd.DataFrame(rows).to_csv(f, index=False, header=total == 0)
+                total += len(rows)
+            if total == 0:
+                pd.DataFrame().to_csv(f, index=False)
+        
+        print(f"Exported {total} records to {filename}")
+        return filename
+    
     def export_sales_trends(self):
-        """Export sales trends data"""
+        """Export sales trends data, one row per day and product from the agg_daily_sales rollup"""
         print("Exporting sales trends...")
         
         query = """
@@ -38,29 +77,75 @@ class PowerBIExporter:
             p.category,
             p.subcategory,
             p.brand,
-            SUM(fs.quantity) as total_quantity,
-            SUM(fs.total_amount) as total_sales,
-            AVG(fs.total_amount) as avg_order_value,
-            COUNT(DISTINCT fs.order_id) as total_orders,
-            COUNT(DISTINCT fs.customer_key) as unique_customers
-        FROM fact_sales fs
-        JOIN dim_date d ON fs.date_key = d.date_key
-        JOIN dim_product p ON fs.product_key = p.product_key
-        GROUP BY d.full_date, d.year, d.quarter, d.month, d.month_name, d.day_name,
-                 p.category, p.subcategory, p.brand
+            p.product_name,
+            s.total_quantity,
+            s.total_sales,
+            s.total_sales / s.order_count as avg_order_value,
+            s.order_count as total_orders,
+            s.unique_customers
+        FROM agg_daily_sales s
+        JOIN dim_date d ON s.date_key = d.date_key
+        JOIN dim_product p ON s.product_key = p.product_key
         ORDER BY d.full_date DESC, p.category
         """
         
-        results = self.mysql.execute_query(query)
-        df = pd.DataFrame(results)
+        return self.export_query(query, "sales_trends")
+    
+    def export_unique_counts(self):
+        """Export approximate unique customers and orders per day, week and month, overall and per category
+        
+        Merged from the HyperLogLog sketches of agg_daily_sales, so no period
+        needs a COUNT(DISTINCT) over fact_sales. Rows arrive in date order, so a
+        period's sketches are counted and dropped as soon as it ends.
+        """
+        print("Exporting unique counts...")
+        
+        query = """
+        SELECT d.full_date, p.category, s.customers_sketch, s.orders_sketch
+        FROM agg_daily_sales s
+        JOIN dim_date d ON s.date_key = d.date_key
+        JOIN dim_product p ON s.product_key = p.product_key
+        ORDER BY d.full_date
+        """
+        
+        results = []
+        open_periods = {period: (None, {}) for period in UNIQUE_COUNT_PERIODS}
+        
+        def close(period, start, groups):
+            for category, (customers, orders) in groups.items():
+                results.append({
+                    'period': period,
+                    'period_start': start,
+                    'category': category,
+                    'approx_unique_customers': customers.count(),
+                    'approx_unique_orders': orders.count(),
+                    'relative_standard_error': round(customers.relative_error, 4)
+                })
         
-        filename = f"{self.export_dir}/sales_trends_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(filename, index=False)
-        print(f"Exported {len(df)} records to {filename}")
+        for row in self.mysql.stream_rows(query, chunk_size=10000):
+            customers = HyperLogLog.from_bytes(row['customers_sketch'])
+            orders = HyperLogLog.from_bytes(row['orders_sketch'])
+            for period, period_start in UNIQUE_COUNT_PERIODS.items():
+                start, groups = open_periods[period]
+                if start != period_start(row['full_date']):
+                    close(period, start, groups)
+                    start, groups = period_start(row['full_date']), {}
+                    open_periods[period] = (start, groups)
+                for category in ('All', row['category']):
+                    if category not in groups:
+                        groups[category] = (HyperLogLog(), HyperLogLog())
+                    groups[category][0].merge(customers)
+                    groups[category][1].merge(orders)
+        for period, (start, groups) in open_periods.items():
+            close(period, start, groups)
+        
+        filename = self.export_filename("unique_counts")
+        pd.DataFrame(results).to_csv(filename, index=False)
+        print(f"Exported {len(results)} records to {filename}")
         return filename
     
     def export_cart_abandonment(self):
-        """Export cart abandonment data"""
+        """Export cart abandonment data from the agg_daily_abandonment rollup"""
         print("Exporting cart abandonment...")
         
         query = """
@@ -71,30 +156,22 @@ class PowerBIExporter:
             d.month_name,
             p.category,
             p.product_name,
-            AVG(fca.time_to_abandonment_minutes) as avg_abandonment_time,
-            SUM(fca.cart_value) as total_abandoned_value,
-            COUNT(*) as abandonment_count,
-            AVG(fca.items_count) as avg_items_per_abandoned_cart,
-            fca.device_type,
-            fca.browser
-        FROM fact_cart_abandonment fca
-        JOIN dim_date d ON fca.date_key = d.date_key
-        JOIN dim_product p ON fca.product_key = p.product_key
-        GROUP BY d.full_date, d.year, d.month, d.month_name, p.category, p.product_name,
-                 fca.device_type, fca.browser
-        ORDER BY d.full_date DESC, abandonment_count DESC
+            a.abandonment_minutes_sum / NULLIF(a.abandonment_minutes_count, 0) as avg_abandonment_time,
+            a.total_abandoned_value,
+            a.abandonment_count,
+            a.items_count_sum / NULLIF(a.items_count_count, 0) as avg_items_per_abandoned_cart,
+            NULLIF(a.device_type, '') as device_type,
+            NULLIF(a.browser, '') as browser
+        FROM agg_daily_abandonment a
+        JOIN dim_date d ON a.date_key = d.date_key
+        JOIN dim_product p ON a.product_key = p.product_key
+        ORDER BY d.full_date DESC, a.abandonment_count DESC
         """
         
-        results = self.mysql.execute_query(query)
-        df = pd.DataFrame(results)
-        
-        filename = f"{self.export_dir}/cart_abandonment_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(filename, index=False)
-        print(f"Exported {len(df)} records to {filename}")
-        return filename
+        return self.export_query(query, "cart_abandonment")
     
     def export_delivery_times(self):
-        """Export delivery time analytics"""
+        """Export delivery time analytics, merged from the product-level agg_daily_delivery rollup"""
         print("Exporting delivery times...")
         
         query = """
@@ -107,31 +184,24 @@ class PowerBIExporter:
             l.state,
             l.city,
             p.category,
-            AVG(fs.delivery_time_hours) as avg_delivery_time_hours,
-            MIN(fs.delivery_time_hours) as min_delivery_time_hours,
-            MAX(fs.delivery_time_hours) as max_delivery_time_hours,
-            COUNT(*) as delivery_count,
-            fs.order_status
-        FROM fact_sales fs
-        JOIN dim_date d ON fs.date_key = d.date_key
-        JOIN dim_location l ON fs.location_key = l.location_key
-        JOIN dim_product p ON fs.product_key = p.product_key
-        WHERE fs.delivery_time_hours IS NOT NULL
+            SUM(r.delivery_hours_sum) / SUM(r.delivery_count) as avg_delivery_time_hours,
+            MIN(r.min_delivery_hours) as min_delivery_time_hours,
+            MAX(r.max_delivery_hours) as max_delivery_time_hours,
+            SUM(r.delivery_count) as delivery_count,
+            r.order_status
+        FROM agg_daily_delivery r
+        JOIN dim_date d ON r.date_key = d.date_key
+        JOIN dim_location l ON r.location_key = l.location_key
+        JOIN dim_product p ON r.product_key = p.product_key
         GROUP BY d.full_date, d.year, d.month, d.month_name, l.country, l.state, l.city,
-                 p.category, fs.order_status
+                 p.category, r.order_status
         ORDER BY d.full_date DESC, avg_delivery_time_hours DESC
         """
         
-        results = self.mysql.execute_query(query)
-        df = pd.DataFrame(results)
-        
-        filename = f"{self.export_dir}/delivery_times_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(filename, index=False)
-        print(f"Exported {len(df)} records to {filename}")
-        return filename
+        return self.export_query(query, "delivery_times")
     
-    def export_customer_analytics(self):
-        """Export customer analytics"""
+    def export_customer_analytics(self, rfm=True):
+        """Export customer analytics from customer_lifetime, optionally with RFM scores"""
         print("Exporting customer analytics...")
         
         query = """
@@ -144,27 +214,41 @@ class PowerBIExporter:
             c.customer_segment,
             l.country,
             l.state,
-            COUNT(DISTINCT fs.order_id) as total_orders,
-            SUM(fs.total_amount) as total_spent,
-            AVG(fs.total_amount) as avg_order_value,
-            MIN(fs.order_date) as first_order_date,
-            MAX(fs.order_date) as last_order_date,
-            DATEDIFF(MAX(fs.order_date), MIN(fs.order_date)) as customer_lifetime_days
-        FROM dim_customer c
-        LEFT JOIN fact_sales fs ON c.customer_key = fs.customer_key
-        LEFT JOIN dim_location l ON fs.location_key = l.location_key
-        GROUP BY c.customer_key, c.customer_id, c.customer_name, c.email, c.age, c.gender,
-                 c.customer_segment, l.country, l.state
-        HAVING total_orders > 0
-        ORDER BY total_spent DESC
+            cl.total_orders,
+            cl.total_spent,
+            cl.total_spent / cl.total_orders as avg_order_value,
+            cl.first_order_date,
+            cl.last_order_date,
+            DATEDIFF(cl.last_order_date, cl.first_order_date) as customer_lifetime_days
+        FROM customer_lifetime cl
+        JOIN dim_customer c ON cl.customer_key = c.customer_key
+        LEFT JOIN dim_location l ON cl.current_location_key = l.location_key
+        ORDER BY cl.total_spent DESC
         """
         
-        results = self.mysql.execute_query(query)
-        df = pd.DataFrame(results)
+        if not rfm:
+            return self.export_query(query, "customer_analytics")
+        
+        # Scores are quantiles over every customer, so the whole result is needed at once
+        customers = pd.DataFrame(self.mysql.execute_query(query))
+        if not customers.empty:
+            last_order = pd.to_datetime(customers['last_order_date'])
+            recency_days = (last_order.max() - last_order).dt.days.to_numpy()
+            scores = rfm_scores(
+                recency_days,
+                customers['total_orders'].to_numpy(dtype=float),
+                customers['total_spent'].to_numpy(dtype=float)
+            )
+            for column, values in zip(('recency_score', 'frequency_score', 'monetary_score'), scores):
+                customers[column] = values
+            customers['rfm_score'] = (
+                customers['recency_score'].astype(str) + customers['frequency_score'].astype(str)
+                + customers['monetary_score'].astype(str)
+            )
         
-        filename = f"{self.export_dir}/customer_analytics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(filename, index=False)
-        print(f"Exported {len(df)} records to {filename}")
+        filename = self.export_filename("customer_analytics")
+        customers.to_csv(filename, index=False)
+        print(f"Exported {len(customers)} records to {filename}")
         return filename
     
     def export_all(self):
@@ -172,6 +256,7 @@ class PowerBIExporter:
         print("Exporting all datasets...")
         files = []
         files.append(self.export_sales_trends())
+        files.append(self.export_unique_counts())
         files.append(self.export_cart_abandonment())
         files.append(self.export_delivery_times())
         files.append(self.export_customer_analytics())
@@ -192,11 +277,11 @@ let
             d.month_name,
             p.category,
             p.product_name,
-            SUM(fs.total_amount) as total_sales,
-            COUNT(fs.order_id) as order_count
-        FROM fact_sales fs
-        JOIN dim_date d ON fs.date_key = d.date_key
-        JOIN dim_product p ON fs.product_key = p.product_key
+            SUM(s.total_sales) as total_sales,
+            SUM(s.order_count) as order_count
+        FROM agg_daily_sales s
+        JOIN dim_date d ON s.date_key = d.date_key
+        JOIN dim_product p ON s.product_key = p.product_key
         GROUP BY d.full_date, d.year, d.month, d.month_name, p.category, p.product_name
         "
     ])
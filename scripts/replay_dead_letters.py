@@ -0,0 +1,115 @@
+"""
+Replay dead-lettered staging rows
+Loads the rows again through the pipeline, e.g. after fixing the transformation or data that rejected them
+
+    python scripts/replay_dead_letters.py --source staging_orders
+    python scripts/replay_dead_letters.py --file dead_letters/dead_letters.jsonl
+
+Rows that load are marked replayed (or dropped from the file); rows that fail
+again stay pending with the new error. Replayed clicks go through the cart
+sessionizer, so stop the continuous pipeline while replaying them; dead-lettered
+abandoned cart lines load directly, without it.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+from itertools import groupby
+
+from etl.pipeline import ETLPipeline
+from etl.coordination import parse_source_name
+from etl.dead_letter import decode_row
+from etl.extract import STAGING_TABLES
+
+
+def is_cart_line(source_name, row):
+    """Whether a dead-lettered row is an abandoned cart line rather than a staging click"""
+    return parse_source_name(source_name)[0] == 'staging_clicks' and 'click_id' not in row
+
+
+def replay_entries(pipeline, entries):
+    """Load dead letters grouped by source; returns (loaded entries, [(entry, stage, error)] still failing)"""
+    loaded, still_failing = [], []
+    mysql = pipeline.loader.mysql
+    for source_name, group in groupby(entries, key=lambda entry: entry['source_name']):
+        group = list(group)
+        rows = [decode_row(entry['raw_row']) for entry in group]
+        entry_of_row = {id(row): entry for row, entry in zip(rows, group)}
+        failures = []
+        try:
+            with mysql.transaction():
+                lines = [row for row in rows if is_cart_line(source_name, row)]
+                if lines:
+                    failures.extend(pipeline.load_cart_lines(lines, pipeline.loader))
+                staged = [row for row in rows if not is_cart_line(source_name, row)]
+                if staged:
+                    # Bisected like a live batch, so one row that still fails doesn't hold back the others
+                    pipeline.load_isolating(source_name, staged, pipeline.loader, failures)
+                # Replayed clicks can close carts whose lines are rejected; those are new dead letters
+                new_failures = [failure for failure in failures if id(failure[0]) not in entry_of_row]
+                failures = [failure for failure in failures if id(failure[0]) in entry_of_row]
+                unsaved = pipeline.dead_letters.record(source_name, new_failures)
+                failed_ids = {id(row) for row, _, _ in failures}
+                done = [entry for row, entry in zip(rows, group) if id(row) not in failed_ids]
+                if 'dead_letter_id' in group[0]:
+                    pipeline.dead_letters.mark_replayed([entry['dead_letter_id'] for entry in done])
+                    for row, stage, error in failures:
+                        pipeline.dead_letters.mark_failed_again(entry_of_row[id(row)]['dead_letter_id'], stage, error)
+        except Exception as e:
+            pipeline.loader.clear_caches()
+            pipeline.reset_state()
+            print(f"Replay of {source_name} failed: {e}")
+            still_failing.extend((entry, 'replay', e) for entry in group)
+            continue
+        pipeline.dead_letters.write_fallback(unsaved)
+        loaded.extend(done)
+        still_failing.extend((entry_of_row[id(row)], stage, error) for row, stage, error in failures)
+    return loaded, still_failing
+
+
+def replay_table(pipeline, source_table=None, dead_letter_ids=None, limit=1000):
+    """Replay pending dead letters from etl_dead_letter"""
+    entries = pipeline.dead_letters.pending(source_table, dead_letter_ids, limit)
+    loaded, still_failing = replay_entries(pipeline, entries)
+    print(f"Replayed {len(loaded)} of {len(entries)} dead letters; {len(still_failing)} still failing")
+
+
+def replay_file(pipeline, path, source_table=None):
+    """Replay the dead letters of a fallback JSONL file, keeping only the ones that still fail"""
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    selected = [entry for entry in entries if source_table in (None, entry['source_table'])]
+    kept = [entry for entry in entries if entry not in selected]
+
+    loaded, still_failing = replay_entries(pipeline, selected)
+    for entry, stage, error in still_failing:
+        kept.append(dict(entry, stage=stage, error_type=type(error).__name__, error_message=str(error)[:2000]))
+
+    # Rewrite the file in one step so a crash can't lose the entries still pending
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        for entry in kept:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(temp_path, path)
+    print(f"Replayed {len(loaded)} of {len(selected)} dead letters from {path}; {len(still_failing)} still failing")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay dead-lettered staging rows")
+    parser.add_argument('--source', choices=sorted(STAGING_TABLES), default=None, help="only this staging table")
+    parser.add_argument('--id', type=int, action='append', dest='ids', help="only this dead letter (repeatable)")
+    parser.add_argument('--limit', type=int, default=1000, help="dead letters to replay from the table")
+    parser.add_argument('--file', default=None, help="replay a fallback JSONL file instead of etl_dead_letter")
+    args = parser.parse_args()
+
+    pipeline = ETLPipeline()
+    try:
+        if args.file:
+            replay_file(pipeline, args.file, args.source)
+        else:
+            replay_table(pipeline, args.source, args.ids, args.limit)
+    finally:
+        pipeline.extractor.close()
+        pipeline.loader.close()
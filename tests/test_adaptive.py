@@ -0,0 +1,76 @@
+"""
+Adaptive batch sizes and poll interval
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from etl.adaptive import AdaptiveBatchController
+
+
+def controller(**overrides):
+    settings = dict(
+        initial_batch_size=1000, min_batch_size=100, max_batch_size=10000, target_batch_seconds=2.0,
+        max_memory_mb=0, poll_interval=4, min_poll_interval=1, max_poll_interval=60
+    )
+    settings.update(overrides)
+    return AdaptiveBatchController(**settings)
+
+
+def test_fast_full_batches_grow_at_most_two_fold():
+    batches = controller()
+    batches.observe('staging_orders', 1000, 0.1)  # 10,000 rows/s would be 20,000 rows per target
+    assert batches.batch_size('staging_orders') == 2000
+
+
+def test_slow_full_batches_shrink_toward_the_target_latency():
+    batches = controller()
+    batches.observe('staging_orders', 1000, 2.5)  # 400 rows/s
+    assert batches.batch_size('staging_orders') == 800
+
+
+def test_sizes_stay_within_bounds():
+    batches = controller(initial_batch_size=8000)
+    for _ in range(5):
+        batches.observe('staging_orders', batches.batch_size('staging_orders'), 0.01)
+    assert batches.batch_size('staging_orders') == 10000
+
+    batches = controller(initial_batch_size=150)
+    for _ in range(5):
+        batches.observe('staging_orders', batches.batch_size('staging_orders'), 100)
+    assert batches.batch_size('staging_orders') == 100
+
+
+def test_short_batches_keep_the_size():
+    batches = controller()
+    batches.observe('staging_orders', 10, 5.0)
+    assert batches.batch_size('staging_orders') == 1000
+    assert 'staging_orders' not in batches.throughput
+
+
+def test_sources_are_sized_independently():
+    batches = controller()
+    batches.observe('staging_orders#0/2', 1000, 0.1)
+    assert batches.batch_size('staging_orders#0/2') == 2000
+    assert batches.batch_sizer('staging_orders#1/2')() == 1000
+
+
+def test_memory_pressure_halves_the_size(monkeypatch):
+    batches = controller(max_memory_mb=1)
+    monkeypatch.setattr('etl.adaptive.current_rss_bytes', lambda: 2 * 1024 * 1024)
+    batches.observe('staging_orders', 1000, 0.1)
+    assert batches.batch_size('staging_orders') == 500
+
+
+def test_poll_interval_follows_the_backlog():
+    batches = controller()
+    batches.observe('staging_orders', 1000, 1.0)
+    assert batches.end_cycle() == 2  # a full batch: backlog, poll sooner
+
+    batches.observe('staging_orders', 10, 0.1)
+    assert batches.end_cycle() == 2  # some rows but no backlog: unchanged
+
+    assert batches.end_cycle() == 3  # idle: back off
+    for _ in range(20):
+        batches.end_cycle()
+    assert batches.end_cycle() == 60
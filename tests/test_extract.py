@@ -0,0 +1,96 @@
+"""
+Keyset extraction never skips rows staged late within a second
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from etl.extract import Extractor
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class FakeMySQL:
+    """Runs the extractor's queries against an in-memory SQLite staging_orders, with a settable NOW()"""
+
+    def __init__(self, now):
+        self.now = now
+        self.db = sqlite3.connect(':memory:')
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("CREATE TABLE staging_orders (order_id TEXT, created_at TEXT)")
+
+    def stage(self, order_id, created_at):
+        self.db.execute("INSERT INTO staging_orders VALUES (?, ?)", (order_id, created_at.strftime(DATETIME_FORMAT)))
+
+    @staticmethod
+    def param(value):
+        return value.strftime(DATETIME_FORMAT) if isinstance(value, datetime) else value
+
+    def execute_query(self, query, params=None):
+        if 'NOW()' in query:
+            return [{'settled_before': self.now.replace(microsecond=0) - timedelta(seconds=params[0])}]
+        cursor = self.db.execute(query.replace('%s', '?'), [self.param(value) for value in params or ()])
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def extractor_for(mysql):
+    extractor = Extractor.__new__(Extractor)
+    extractor.mysql = mysql
+    return extractor
+
+
+def drain(extractor, watermark):
+    """(order ids, watermark) of one run over staging_orders"""
+    order_ids = []
+    for rows, batch_watermark in extractor.iter_batches('staging_orders', watermark, batch_size=1):
+        order_ids.extend(row['order_id'] for row in rows)
+        watermark = batch_watermark
+    return order_ids, watermark
+
+
+def test_row_staged_late_in_a_second_with_a_smaller_id_is_extracted():
+    second = datetime(2024, 3, 1, 12, 0, 0)
+    mysql = FakeMySQL(now=second + timedelta(milliseconds=300))
+    extractor = extractor_for(mysql)
+    mysql.stage('ORD0500', second - timedelta(seconds=5))
+    mysql.stage('ORD9000', second)
+
+    # The second is still running, so only the earlier row is read
+    order_ids, watermark = drain(extractor, None)
+    assert order_ids == ['ORD0500']
+
+    # A row later in the same second whose random id sorts below the first one
+    mysql.now = second + timedelta(milliseconds=800)
+    mysql.stage('ORD1000', second)
+    mysql.now = second + timedelta(seconds=2)
+    order_ids, watermark = drain(extractor, watermark)
+    assert order_ids == ['ORD1000', 'ORD9000']
+    assert watermark == (second.strftime(DATETIME_FORMAT), 'ORD9000')
+
+
+def test_watermark_stays_below_the_settled_bound():
+    second = datetime(2024, 3, 1, 12, 0, 0)
+    mysql = FakeMySQL(now=second + timedelta(seconds=1, milliseconds=500))
+    mysql.stage('ORD0001', second)
+    mysql.stage('ORD0002', second + timedelta(seconds=1))
+
+    order_ids, watermark = drain(extractor_for(mysql), None)
+    assert order_ids == []
+    assert watermark is None
+
+
+def test_extract_errors_are_raised():
+    class FailingMySQL(FakeMySQL):
+        def execute_query(self, query, params=None):
+            if 'NOW()' not in query:
+                raise RuntimeError("connection lost")
+            return super().execute_query(query, params)
+
+    # An empty page would read as caught up and end the run for the table
+    with pytest.raises(RuntimeError):
+        drain(extractor_for(FailingMySQL(now=datetime(2024, 3, 1))), None)
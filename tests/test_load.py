@@ -0,0 +1,60 @@
+"""
+Bounded LRU cache of dimension surrogate keys
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from etl.load import DimensionKeyCache
+
+
+def test_hits_and_misses_are_counted():
+    cache = DimensionKeyCache('dim_product', 10)
+    assert cache.get('PROD001') is None
+    cache.put('PROD001', 7)
+    assert cache.get('PROD001') == 7
+    assert cache.stats() == {
+        'name': 'dim_product', 'size': 1, 'max_size': 10, 'hits': 1, 'misses': 1, 'hit_rate': 0.5
+    }
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = DimensionKeyCache('dim_product', 2)
+    cache.put('PROD001', 1)
+    cache.put('PROD002', 2)
+    cache.get('PROD001')  # PROD002 is now the least recently used
+    cache.put('PROD003', 3)
+
+    assert len(cache) == 2
+    assert cache.get('PROD002') is None
+    assert cache.get('PROD001') == 1
+    assert cache.get('PROD003') == 3
+
+
+def test_put_refreshes_an_existing_key():
+    cache = DimensionKeyCache('dim_product', 2)
+    cache.put('PROD001', 1)
+    cache.put('PROD002', 2)
+    cache.put('PROD001', 10)
+    cache.put('PROD003', 3)
+
+    assert cache.get('PROD001') == 10
+    assert cache.get('PROD002') is None
+
+
+def test_null_keys_and_zero_size_cache_nothing():
+    cache = DimensionKeyCache('dim_location', 2)
+    cache.put(('Springfield', 'IL', 'USA', ''), None)
+    assert len(cache) == 0
+
+    disabled = DimensionKeyCache('dim_location', 0)
+    disabled.put(('Springfield', 'IL', 'USA', ''), 5)
+    assert len(disabled) == 0
+
+
+def test_clear_invalidates_every_key():
+    cache = DimensionKeyCache('dim_customer', 10)
+    cache.put('CUST1001', (1, 'hash'))
+    cache.clear()
+    assert cache.get('CUST1001') is None
+    assert len(cache) == 0
@@ -0,0 +1,121 @@
+"""
+Savepoint bisection of failing batches into dead letters
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+from etl.dead_letter import RejectedRow
+from etl.pipeline import ETLPipeline
+
+
+class FakeMySQL:
+    """Transactions and savepoints over a list of written facts"""
+
+    def __init__(self):
+        self.pending = []  # written inside the open transaction
+        self.committed = []
+
+    @contextmanager
+    def transaction(self):
+        try:
+            yield
+        except Exception:
+            self.pending = []
+            raise
+        self.committed.extend(self.pending)
+        self.pending = []
+
+    @contextmanager
+    def savepoint(self):
+        mark = len(self.pending)
+        try:
+            yield
+        except Exception:
+            del self.pending[mark:]
+            raise
+
+    def execute_query(self, query, params=None):
+        return []
+
+
+class FakeLoader:
+    def __init__(self):
+        self.mysql = FakeMySQL()
+        self.clear_caches = mock.Mock()
+
+
+def pipeline_with(bad_ids, rejected_ids=()):
+    """A pipeline whose single source fails to write rows in bad_ids and rejects rows in rejected_ids"""
+    pipeline = ETLPipeline.__new__(ETLPipeline)
+    pipeline.loader = FakeLoader()
+    pipeline.dead_letters = mock.Mock()
+    pipeline.dead_letters.record.return_value = []
+    pipeline.leases = None
+    pipeline.batch_controller = None
+    pipeline.sessionizers = {}
+    pipeline.watermarks = {}
+    pipeline.write_attempts = 0
+
+    def transform(rows):
+        return rows
+
+    def resolve_keys(rows, loader):
+        return {
+            'facts': [row for row in rows if row['id'] not in rejected_ids],
+            'rejected': [(row, 'transform', RejectedRow("bad row")) for row in rows if row['id'] in rejected_ids]
+        }
+
+    def write_facts(payload, loader):
+        pipeline.write_attempts += 1
+        for row in payload['facts']:
+            loader.mysql.pending.append(row['id'])
+            if row['id'] in bad_ids:
+                raise ValueError(f"cannot load {row['id']}")
+
+    pipeline.batch_stages = lambda source_name: (transform, resolve_keys, write_facts)
+    return pipeline
+
+
+def rows(count):
+    return [{'id': index} for index in range(count)]
+
+
+def dead_lettered(pipeline):
+    (source_name, failures), _ = pipeline.dead_letters.record.call_args
+    return source_name, [(row['id'], stage, type(error).__name__) for row, stage, error in failures]
+
+
+def test_failing_rows_are_dead_lettered_and_the_rest_commit_once():
+    pipeline = pipeline_with(bad_ids={3, 11})
+    pipeline.commit_batch('staging_orders', rows(16), ('2024-03-01 12:00:00', 15))
+
+    assert sorted(pipeline.loader.mysql.committed) == [index for index in range(16) if index not in (3, 11)]
+    assert dead_lettered(pipeline) == ('staging_orders', [(3, 'load', 'ValueError'), (11, 'load', 'ValueError')])
+    assert pipeline.watermarks['staging_orders'] == ('2024-03-01 12:00:00', 15)
+    # About 2k*log2(n) attempts for k bad rows, not one per row
+    assert pipeline.write_attempts <= 1 + 2 * 2 * 4
+
+
+def test_rejected_rows_are_dead_lettered_without_bisecting():
+    pipeline = pipeline_with(bad_ids=set(), rejected_ids={5})
+    pipeline.commit_batch('staging_orders', rows(8), ('2024-03-01 12:00:00', 7))
+
+    assert sorted(pipeline.loader.mysql.committed) == [0, 1, 2, 3, 4, 6, 7]
+    assert dead_lettered(pipeline) == ('staging_orders', [(5, 'transform', 'RejectedRow')])
+    assert pipeline.write_attempts == 1
+
+
+def test_too_many_failing_rows_fail_the_batch():
+    pipeline = pipeline_with(bad_ids={0, 1, 2, 3})
+    with pytest.raises(ValueError):
+        pipeline.commit_batch('staging_orders', rows(4), ('2024-03-01 12:00:00', 3))
+
+    assert pipeline.loader.mysql.committed == []
+    assert 'staging_orders' not in pipeline.watermarks
+    pipeline.dead_letters.record.assert_not_called()
@@ -0,0 +1,118 @@
+"""
+Cart sessionization of clicks: checkout, idle abandonment and out-of-order clicks
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+from etl.pipeline import ETLPipeline
+from etl.sessionize import CartSessionizer
+
+START = datetime(2024, 3, 1, 10, 0, 0)
+
+
+def click(click_id, session_id, click_type, minutes, product_id='PROD001', customer_id='CUST1001'):
+    return {
+        'click_id': click_id,
+        'session_id': session_id,
+        'customer_id': customer_id,
+        'product_id': product_id,
+        'click_type': click_type,
+        'click_timestamp': START + timedelta(minutes=minutes),
+        'device_type': 'mobile',
+        'browser': 'Firefox',
+    }
+
+
+def sessionizer():
+    return CartSessionizer(timeout_minutes=30, max_open_carts=100)
+
+
+def test_checkout_closes_cart_without_abandonment():
+    carts = sessionizer()
+    assert carts.apply([click('C1', 'S1', 'add_to_cart', 0), click('C2', 'S1', 'add_to_cart', 1, 'PROD002')]) == []
+    assert len(carts) == 1
+
+    assert carts.apply([click('C3', 'S1', 'checkout', 5)]) == []
+    assert len(carts) == 0
+    assert carts.take_changes()['deletes'] == ['S1']
+
+    # Idle time after a checkout abandons nothing
+    assert carts.expire(START + timedelta(hours=2)) == []
+
+
+def test_idle_cart_is_abandoned_once_past_the_timeout():
+    carts = sessionizer()
+    carts.apply([click('C1', 'S1', 'add_to_cart', 0), click('C2', 'S1', 'add_to_cart', 2)])
+
+    assert carts.expire(START + timedelta(minutes=32)) == []
+    lines = carts.expire(START + timedelta(minutes=33))
+    assert [(line['product_id'], line['quantity'], line['items_count']) for line in lines] == [('PROD001', 2, 2)]
+    assert lines[0]['add_to_cart_time'] == START
+    assert lines[0]['abandonment_time'] == START + timedelta(minutes=2)
+    assert len(carts) == 0
+
+
+def test_later_clicks_of_other_sessions_expire_an_idle_cart():
+    carts = sessionizer()
+    carts.apply([click('C1', 'S1', 'add_to_cart', 0)])
+    lines = carts.apply([click('C2', 'S2', 'add_to_cart', 45)])
+    assert [line['session_id'] for line in lines] == ['S1']
+    assert len(carts) == 1
+
+
+def test_out_of_order_clicks_in_a_batch_are_applied_by_timestamp():
+    carts = sessionizer()
+    # The checkout is listed first but happened after the add
+    assert carts.apply([click('C2', 'S1', 'checkout', 3), click('C1', 'S1', 'add_to_cart', 0)]) == []
+    assert len(carts) == 0
+
+
+def test_late_click_does_not_move_a_cart_back_in_time():
+    carts = sessionizer()
+    carts.apply([click('C1', 'S1', 'add_to_cart', 10)])
+    carts.apply([click('C0', 'S1', 'add_to_cart', 5, 'PROD002')])
+
+    assert carts.expire(START + timedelta(minutes=40)) == []
+    lines = carts.expire(START + timedelta(minutes=41))
+    assert sorted(line['product_id'] for line in lines) == ['PROD001', 'PROD002']
+    assert {line['abandonment_time'] for line in lines} == {START + timedelta(minutes=10)}
+
+
+def test_restore_resumes_open_carts():
+    carts = sessionizer()
+    carts.apply([click('C1', 'S1', 'add_to_cart', 0)])
+    restored = sessionizer()
+    restored.restore([dict(cart) for cart in carts.sessions.values()])
+
+    assert restored.apply([click('C2', 'S1', 'checkout', 10)]) == []
+    assert len(restored) == 0
+
+
+def test_idle_carts_wait_while_clicks_are_still_staged():
+    pipeline = ETLPipeline.__new__(ETLPipeline)
+    pipeline.extractor = mock.Mock()
+    pipeline.extractor.settled_before.return_value = START + timedelta(hours=2)
+    pipeline.extractor.extract_batch.return_value = [click('C2', 'S1', 'checkout', 3)]
+    pipeline.checkpoints = mock.Mock()
+    pipeline.sessionizer_for = mock.Mock()
+
+    pipeline.expire_idle_carts('staging_clicks')
+    pipeline.sessionizer_for.assert_not_called()
+
+
+def test_idle_carts_expire_against_the_settled_bound_once_caught_up():
+    pipeline = ETLPipeline.__new__(ETLPipeline)
+    pipeline.extractor = mock.Mock()
+    pipeline.extractor.settled_before.return_value = START + timedelta(hours=2)
+    pipeline.extractor.extract_batch.return_value = []
+    pipeline.checkpoints = mock.Mock()
+    carts = sessionizer()
+    carts.take_changes()
+    pipeline.sessionizer_for = mock.Mock(return_value=carts)
+
+    pipeline.expire_idle_carts('staging_clicks')
+    pipeline.sessionizer_for.assert_called_once_with('staging_clicks')
@@ -0,0 +1,121 @@
+"""
+Parity of the column-wise order transform with the per-row Transformer.clean_order
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import copy
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from etl.transform import Transformer
+from utils.date_dimension import date_key_bounds
+
+CLEANED_FIELDS = [
+    'order_id', 'customer_id', 'product_id', 'order_date', 'order_status', 'quantity', 'unit_price',
+    'total_amount', 'city', 'state', 'country', 'postal_code', 'delivery_date', 'delivery_time_hours',
+    'payment_method'
+]
+
+
+def order(order_id, **fields):
+    """A staging_orders row as pymysql returns it, with fields overridden"""
+    row = {
+        'order_id': order_id,
+        'customer_id': 'CUST1001',
+        'product_id': 'PROD001',
+        'order_date': datetime(2024, 3, 1, 9, 30),
+        'order_status': 'Confirmed',
+        'quantity': 2,
+        'unit_price': Decimal('19.99'),
+        'total_amount': Decimal('39.98'),
+        'city': ' Springfield ',
+        'state': 'IL ',
+        'country': ' USA',
+        'postal_code': '62701',
+        'delivery_date': datetime(2024, 3, 4, 15, 45),
+        'payment_method': 'credit_card',
+    }
+    row.update(fields)
+    return row
+
+
+BATCHES = {
+    'typed rows': [
+        order('ORD1'),
+        order('ORD2', delivery_date=None, order_status='PENDING'),
+        order('ORD3', quantity=0, unit_price=Decimal('-5'), total_amount=Decimal('0')),
+        order('ORD4', delivery_date=datetime(2024, 3, 1, 10, 29)),
+    ],
+    'string rows': [
+        order('ORD5', order_date='2024-03-02 08:00:00', delivery_date='2024-03-05 20:15:00', quantity='3',
+              unit_price='4.50', total_amount='13.50'),
+        order('ORD6', order_date='2024-03-02 08:00:00', delivery_date=''),
+    ],
+    'rejected rows': [
+        order('ORD7'),
+        order('ORD8', order_date='not a date'),
+        order('ORD9', unit_price='abc'),
+        order('ORD10', delivery_date='2024-13-45 00:00:00'),
+        order('ORD11', order_status=None),
+        order('ORD12', city=42),
+        order('ORD13'),
+    ],
+    'numeric edge cases': [
+        order('ORD16', quantity='2.5'),
+        order('ORD17', quantity=2.5),
+        order('ORD18', quantity=Decimal('3.0'), unit_price=float('nan')),
+        order('ORD19', unit_price='nan', total_amount=Decimal('NaN')),
+        order('ORD20', quantity=float('inf')),
+        order('ORD21', quantity='4', unit_price=None),
+        order('ORD22', quantity=float('nan')),
+    ],
+    'missing optional fields': [
+        {key: value for key, value in order('ORD14').items() if key not in ('city', 'delivery_date', 'quantity')},
+        {key: value for key, value in order('ORD15').items() if key not in ('order_status', 'unit_price')},
+    ],
+}
+
+
+def per_row(orders):
+    cleaned = [Transformer.clean_order(copy.deepcopy(row)) for row in orders]
+    return [row for row in cleaned if row is not None]
+
+
+@pytest.mark.parametrize('name', sorted(BATCHES))
+def test_clean_orders_matches_clean_order(name):
+    orders = BATCHES[name]
+    expected = per_row(orders)
+    actual = Transformer.clean_orders(copy.deepcopy(orders))
+
+    assert [row['order_id'] for row in actual] == [row['order_id'] for row in expected]
+    for got, want in zip(actual, expected):
+        for field in CLEANED_FIELDS:
+            if field in want:
+                assert got[field] == want[field], (want['order_id'], field)
+                assert (got[field] is None) == (want[field] is None), (want['order_id'], field)
+
+
+@pytest.mark.parametrize('name', sorted(BATCHES))
+def test_clean_orders_frame_reports_every_dropped_order(name):
+    orders = BATCHES[name]
+    rejected = []
+    frame = Transformer.clean_orders_frame(copy.deepcopy(orders), rejected)
+
+    kept = {row['order_id'] for row in per_row(orders)}
+    assert set(frame['order_id']) == kept
+    assert sorted(row['order_id'] for row, _ in rejected) == sorted(
+        row['order_id'] for row in orders if row['order_id'] not in kept
+    )
+    assert all(reason for _, reason in rejected)
+
+
+def test_clean_orders_date_keys():
+    min_key, max_key = date_key_bounds()
+    cleaned = Transformer.clean_orders(copy.deepcopy(BATCHES['typed rows']))
+    for row in cleaned:
+        key = int(row['order_date'].strftime('%Y%m%d'))
+        assert row['date_key'] == (key if min_key <= key <= max_key else None)
@@ -2,35 +2,207 @@
 Database connector utilities for MySQL
 """
 import pymysql
-from config.config import MYSQL_CONFIG
+from config.config import MYSQL_CONFIG, POOL_CONFIG
+from utils.metrics import metrics, statement_label
+from collections import deque
+from contextlib import contextmanager
 import logging
+import os
+import threading
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection frees up within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of MySQL connections"""
+    
+    def __init__(self, config=None, min_size=1, max_size=10, max_idle_seconds=300, checkout_timeout=30):
+        self.config = config or MYSQL_CONFIG
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.checkout_timeout = checkout_timeout
+        self.pid = os.getpid()
+        
+        self.idle = deque()  # (connection, returned_at), most recently returned on the right
+        self.size = 0  # open connections, idle or checked out
+        self.condition = threading.Condition()
+        
+        for _ in range(min_size):
+            self.idle.append((self.create_connection(), time.monotonic()))
+            self.size += 1
+    
+    def create_connection(self):
+        """Open a new MySQL connection"""
+        return pymysql.connect(
+            host=self.config['host'],
+            port=self.config['port'],
+            user=self.config['user'],
+            password=self.config['password'],
+            database=self.config['database'],
+            charset=self.config['charset'],
+            cursorclass=pymysql.cursors.DictCursor
+        )
+    
+    def recycle_idle(self):
+        """Close connections idle longer than max_idle_seconds, keeping min_size open (lock held)"""
+        now = time.monotonic()
+        while self.idle and self.size > self.min_size and now - self.idle[0][1] > self.max_idle_seconds:
+            connection, _ = self.idle.popleft()
+            self.size -= 1
+            self.close_quietly(connection)
+    
+    def acquire(self):
+        """Check out a live connection, opening one if the pool is below max_size"""
+        deadline = time.monotonic() + self.checkout_timeout
+        connection = None
+        
+        with self.condition:
+            while True:
+                self.recycle_idle()
+                if self.idle:
+                    connection, _ = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(f"No MySQL connection available within {self.checkout_timeout}s")
+                self.condition.wait(remaining)
+        
+        try:
+            if connection is None:
+                return self.create_connection()
+            # Health check; transparently reopens connections the server dropped
+            connection.ping(reconnect=True)
+            return connection
+        except Exception:
+            if connection is not None:
+                self.close_quietly(connection)
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+    
+    def release(self, connection):
+        """Return a connection to the pool, discarding it if it is broken"""
+        try:
+            # Never hand the next borrower someone else's open transaction
+            connection.rollback()
+        except Exception:
+            self.discard(connection)
+            return
+        
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.recycle_idle()
+            self.condition.notify()
+    
+    def discard(self, connection):
+        """Close a checked-out connection instead of returning it"""
+        self.close_quietly(connection)
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+    
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block"""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+    
+    def close_all(self):
+        """Close every idle connection"""
+        with self.condition:
+            while self.idle:
+                connection, _ = self.idle.pop()
+                self.size -= 1
+                self.close_quietly(connection)
+    
+    def stats(self):
+        """Pool occupancy as a dict"""
+        with self.condition:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'in_use': self.size - len(self.idle),
+                'max_size': self.max_size
+            }
+    
+    @staticmethod
+    def close_quietly(connection):
+        """Close a connection, ignoring errors from already-dead sockets"""
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+# MySQL errors about the connection or lock contention rather than the statement's data
+TRANSIENT_ERROR_CODES = {
+    1040,  # too many connections
+    1205,  # lock wait timeout
+    1213,  # deadlock
+    2003,  # can't connect
+    2006,  # server has gone away
+    2013,  # lost connection during query
+}
+
+
+def is_transient_error(error):
+    """Whether an error may go away on retry, so it says nothing about the rows being written"""
+    if isinstance(error, pymysql.err.InterfaceError):
+        return True
+    return isinstance(error, pymysql.err.OperationalError) and bool(error.args) and error.args[0] in TRANSIENT_ERROR_CODES
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Get the process-wide connection pool, creating it on first use"""
+    global _pool
+    with _pool_lock:
+        # A forked child must not share its parent's sockets
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(**POOL_CONFIG)
+        return _pool
+
+
 class MySQLConnector:
-    """MySQL database connector"""
+    """MySQL database connector backed by the shared connection pool"""
     
-    def __init__(self):
+    def __init__(self, pool=None):
         self.config = MYSQL_CONFIG
+        self.pool = pool
         self.connection = None
+        self.in_transaction = False
+        self.savepoint_depth = 0
+    
+    def __enter__(self):
+        self.connect()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
     def connect(self):
-        """Establish MySQL connection"""
-        try:
-            self.connection = pymysql.connect(
-                host=self.config['host'],
-                port=self.config['port'],
-                user=self.config['user'],
-                password=self.config['password'],
-                database=self.config['database'],
-                charset=self.config['charset'],
-                cursorclass=pymysql.cursors.DictCursor
-            )
-            return self.connection
-        except Exception as e:
-            raise
+        """Check out a pooled MySQL connection (kept until close())"""
+        if self.connection is None:
+            with metrics.timer('etl_db_checkout_seconds'):
+                self.connection = (self.pool or get_pool()).acquire()
+        return self.connection
     
     def execute_query(self, query, params=None):
         """Execute a query"""
@@ -38,12 +210,30 @@ class MySQLConnector:
             self.connect()
         
         try:
-            with self.connection.cursor() as cursor:
+            with self.connection.cursor() as cursor, metrics.timer('etl_db_query_seconds', statement=statement_label(query)):
                 cursor.execute(query, params)
-                self.connection.commit()
+                if not self.in_transaction:
+                    self.connection.commit()
                 return cursor.fetchall()
         except Exception as e:
-            self.connection.rollback()
+            if not self.in_transaction:
+                self.connection.rollback()
+            raise
+    
+    def execute_update(self, query, params=None):
+        """Execute a write and return the number of rows it changed"""
+        if not self.connection:
+            self.connect()
+        
+        try:
+            with self.connection.cursor() as cursor, metrics.timer('etl_db_query_seconds', statement=statement_label(query)):
+                affected = cursor.execute(query, params)
+                if not self.in_transaction:
+                    self.connection.commit()
+                return affected
+        except Exception as e:
+            if not self.in_transaction:
+                self.connection.rollback()
             raise
     
     def execute_many(self, query, params_list):
@@ -52,16 +242,84 @@ class MySQLConnector:
             self.connect()
         
         try:
-            with self.connection.cursor() as cursor:
+            with self.connection.cursor() as cursor, metrics.timer('etl_db_query_seconds', statement=statement_label(query)):
                 cursor.executemany(query, params_list)
-                self.connection.commit()
+                if not self.in_transaction:
+                    self.connection.commit()
                 return cursor.rowcount
         except Exception as e:
+            if not self.in_transaction:
+                self.connection.rollback()
+            raise
+    
+    def stream_query(self, query, params=None, chunk_size=1000, as_dict=True):
+        """Yield a large result in chunks through an unbuffered server-side cursor
+        
+        Runs on its own pooled connection, so this connector stays free for
+        other queries while the stream is open.
+        """
+        pool = self.pool or get_pool()
+        connection = pool.acquire()
+        cursor_class = pymysql.cursors.SSDictCursor if as_dict else pymysql.cursors.SSCursor
+        try:
+            with connection.cursor(cursor_class) as cursor:
+                with metrics.timer('etl_db_query_seconds', statement=statement_label(query)):
+                    cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    metrics.inc('etl_db_streamed_rows_total', len(rows), statement=statement_label(query))
+                    yield rows
+        finally:
+            pool.release(connection)
+    
+    def stream_rows(self, query, params=None, chunk_size=1000, as_dict=True):
+        """Yield a large result row by row with flat client memory"""
+        for rows in self.stream_query(query, params, chunk_size, as_dict):
+            for row in rows:
+                yield row
+    
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed queries as one atomic commit (nested blocks join the outer one)"""
+        if not self.connection:
+            self.connect()
+        
+        if self.in_transaction:
+            yield self
+            return
+        
+        self.in_transaction = True
+        try:
+            yield self
+            self.connection.commit()
+        except Exception:
             self.connection.rollback()
             raise
+        finally:
+            self.in_transaction = False
+    
+    @contextmanager
+    def savepoint(self):
+        """Undo only the enclosed queries if the block fails, keeping the rest of the open transaction"""
+        if not self.in_transaction:
+            raise RuntimeError("savepoint() must be used inside transaction()")
+        self.savepoint_depth += 1
+        name = f"sp_{self.savepoint_depth}"
+        try:
+            self.execute_query(f"SAVEPOINT {name}")
+            try:
+                yield self
+            except Exception:
+                self.execute_query(f"ROLLBACK TO SAVEPOINT {name}")
+                raise
+            self.execute_query(f"RELEASE SAVEPOINT {name}")
+        finally:
+            self.savepoint_depth -= 1
     
     def close(self):
-        """Close MySQL connection"""
+        """Return the connection to the pool; the next query checks out a fresh one"""
         if self.connection:
-            self.connection.close()
-
+            (self.pool or get_pool()).release(self.connection)
+            self.connection = None
@@ -0,0 +1,82 @@
+"""
+Shared calendar for the date dimension
+Used by database setup to build dim_date and by the ETL to resolve date keys
+without querying it
+"""
+from datetime import date, datetime, timedelta
+
+# dim_date covers this fixed calendar range (inclusive)
+DATE_DIM_START = date(2020, 1, 1)
+DATE_DIM_END = date(2030, 12, 31)
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+MONTH_NAMES = ['', 'January', 'February', 'March', 'April', 'May', 'June',
+               'July', 'August', 'September', 'October', 'November', 'December']
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def to_date(value):
+    """Coerce a datetime, date or 'YYYY-MM-DD HH:MM:SS' string to a date (None if unsupported)"""
+    if isinstance(value, str):
+        return datetime.strptime(value, DATETIME_FORMAT).date()
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return None
+
+
+def to_datetime(value):
+    """Coerce a datetime or 'YYYY-MM-DD HH:MM:SS' string to a datetime (None if unsupported)"""
+    if isinstance(value, str):
+        return datetime.strptime(value, DATETIME_FORMAT)
+    if isinstance(value, datetime):
+        return value
+    return None
+
+
+def date_key_for(value):
+    """Get date key (YYYYMMDD) for a date-like value"""
+    day = to_date(value)
+    if day is None:
+        return None
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+def resolve_date_key(value):
+    """Get date key only if the date exists in dim_date"""
+    day = to_date(value)
+    if day is None or not DATE_DIM_START <= day <= DATE_DIM_END:
+        return None
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+def date_key_bounds():
+    """Smallest and largest date keys in dim_date"""
+    return date_key_for(DATE_DIM_START), date_key_for(DATE_DIM_END)
+
+
+def iter_date_rows(start_date=DATE_DIM_START, end_date=DATE_DIM_END):
+    """Yield dim_date rows as tuples in column order"""
+    current_date = start_date
+    while current_date <= end_date:
+        # Calculate week number (ISO week)
+        week = current_date.isocalendar()[1]
+        day_of_week = current_date.weekday() + 1  # 1=Monday, 7=Sunday
+
+        yield (
+            date_key_for(current_date),
+            current_date,
+            current_date.year,
+            (current_date.month - 1) // 3 + 1,
+            current_date.month,
+            MONTH_NAMES[current_date.month],
+            week,
+            current_date.day,
+            day_of_week,
+            DAY_NAMES[current_date.weekday()],
+            day_of_week in [6, 7],  # Saturday or Sunday
+            False
+        )
+        current_date += timedelta(days=1)
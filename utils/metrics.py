@@ -0,0 +1,252 @@
+"""
+Lightweight in-process metrics: counters, gauges and latency histograms
+Exposed as a snapshot dict and in Prometheus text format
+"""
+from config.config import METRICS_CONFIG
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import os
+import re
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Rows per batch
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record one observation"""
+        self.sum += value
+        self.count += 1
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+                break
+
+    def cumulative_counts(self):
+        """Bucket counts as Prometheus expects them: observations <= each bound"""
+        running = 0
+        cumulative = []
+        for count in self.counts:
+            running += count
+            cumulative.append(running)
+        return cumulative
+
+
+@lru_cache(maxsize=2048)
+def statement_label(query):
+    """Short label for a SQL statement, e.g. 'SELECT staging_orders' or 'INSERT fact_sales'"""
+    words = query.split()
+    if not words:
+        return 'EMPTY'
+    verb = words[0].upper()
+    match = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+`?(\w+)', query, re.IGNORECASE)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+class MetricsRegistry:
+    """Thread-safe registry of labelled counters, gauges and histograms"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.started_at = time.time()
+
+    @staticmethod
+    def label_key(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter"""
+        if not self.enabled:
+            return
+        key = (name, self.label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge to its current value"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, self.label_key(labels))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Record a histogram observation"""
+        if not self.enabled:
+            return
+        key = (name, self.label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time a with block into a latency histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def track_stage(self, stage, table):
+        """Time one batch through an ETL stage; set tracker['rows'] to the rows it handled"""
+        tracker = {'rows': 0}
+        start = time.perf_counter()
+        try:
+            yield tracker
+        finally:
+            self.observe('etl_stage_seconds', time.perf_counter() - start, stage=stage, table=table)
+            self.inc('etl_rows_total', tracker['rows'], stage=stage, table=table)
+            self.observe('etl_batch_rows', tracker['rows'], buckets=BATCH_SIZE_BUCKETS, stage=stage, table=table)
+
+    def reset(self):
+        """Drop every recorded metric"""
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        """All metrics as plain dicts, plus derived per-stage throughput and cache hit rates"""
+        with self.lock:
+            counters = {key: value for key, value in self.counters.items()}
+            gauges = {key: value for key, value in self.gauges.items()}
+            histograms = {
+                key: {'count': histogram.count, 'sum': histogram.sum,
+                      'avg': histogram.sum / histogram.count if histogram.count else 0.0}
+                for key, histogram in self.histograms.items()
+            }
+
+        def grouped(entries):
+            result = {}
+            for (name, labels), value in entries.items():
+                result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            return result
+
+        # Rows per second of time actually spent inside each stage
+        throughput = {}
+        for (name, labels), rows in counters.items():
+            if name != 'etl_rows_total':
+                continue
+            seconds = histograms.get(('etl_stage_seconds', labels), {}).get('sum', 0.0)
+            label_dict = dict(labels)
+            throughput[f"{label_dict['stage']}/{label_dict['table']}"] = rows / seconds if seconds else 0.0
+
+        lookups = {}
+        for (name, labels), value in counters.items():
+            if name == 'etl_dimension_cache_lookups_total':
+                label_dict = dict(labels)
+                hits_misses = lookups.setdefault(label_dict['cache'], {'hit': 0, 'miss': 0})
+                hits_misses[label_dict['result']] += value
+        cache_hit_rate = {
+            cache: counts['hit'] / (counts['hit'] + counts['miss'])
+            for cache, counts in lookups.items() if counts['hit'] + counts['miss']
+        }
+
+        return {
+            'uptime_seconds': time.time() - self.started_at,
+            'counters': grouped(counters),
+            'gauges': grouped(gauges),
+            'histograms': grouped(histograms),
+            'throughput_rows_per_second': throughput,
+            'cache_hit_rate': cache_hit_rate
+        }
+
+    @staticmethod
+    def format_labels(labels, extra=None):
+        pairs = list(labels) + (list(extra) if extra else [])
+        if not pairs:
+            return ''
+        escaped = [
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        ]
+        return '{' + ','.join(escaped) + '}'
+
+    def to_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for kind, entries in (('counter', self.counters), ('gauge', self.gauges)):
+                names = sorted({name for name, _ in entries})
+                for name in names:
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (entry_name, labels), value in sorted(entries.items()):
+                        if entry_name == name:
+                            lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (entry_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if entry_name != name:
+                        continue
+                    for upper_bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                        lines.append(f"{name}_bucket{self.format_labels(labels, [('le', upper_bound)])} {count}")
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path=None):
+        """Atomically write the Prometheus text file (for node_exporter's textfile collector)"""
+        path = path or METRICS_CONFIG['prometheus_file']
+        if not path:
+            return None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+        return path
+
+    def serve_http(self, port=None, host='0.0.0.0'):
+        """Serve /metrics over HTTP from a daemon thread"""
+        port = port or METRICS_CONFIG['http_port']
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+
+# Process-wide registry used by the ETL modules
+metrics = MetricsRegistry(enabled=METRICS_CONFIG['enabled'])
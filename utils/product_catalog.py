@@ -0,0 +1,116 @@
+"""
+Product catalog shared by the data generator and the ETL
+Loaded from one JSON file, cached as immutable records and reloaded when the file changes
+"""
+from config.config import CATALOG_CONFIG
+from collections import namedtuple
+from types import MappingProxyType
+import json
+import logging
+import os
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ProductRecord = namedtuple(
+    'ProductRecord', ['product_id', 'product_name', 'category', 'subcategory', 'brand', 'price']
+)
+
+
+def unknown_product(product_id):
+    """Placeholder record for a product id missing from the catalog"""
+    return ProductRecord(product_id, f"Product {product_id}", 'Uncategorized', '', 'Unknown', 0)
+
+
+class ProductCatalog:
+    """In-memory product catalog backed by a JSON file"""
+
+    def __init__(self, path=None, refresh_interval_seconds=None):
+        self.path = path or CATALOG_CONFIG['products_file']
+        self.refresh_interval = (
+            CATALOG_CONFIG['refresh_interval_seconds'] if refresh_interval_seconds is None else refresh_interval_seconds
+        )
+        self.lock = threading.Lock()
+        self.products = MappingProxyType({})  # product_id -> ProductRecord, swapped whole on reload
+        self.records = ()
+        self.version = None
+        self.file_signature = None  # (mtime_ns, size) of the loaded file
+        self.checked_at = 0.0
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Reload the catalog if its file changed; checks at most once per refresh interval"""
+        now = time.monotonic()
+        if not force and now - self.checked_at < self.refresh_interval:
+            return False
+
+        with self.lock:
+            self.checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except OSError as e:
+                logger.error(f"Product catalog {self.path} unavailable: {e}")
+                return False
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == self.file_signature:
+                return False
+
+            try:
+                with open(self.path) as f:
+                    document = json.load(f)
+                records = tuple(
+                    ProductRecord(
+                        product_id=product['product_id'],
+                        product_name=product['product_name'],
+                        category=product.get('category', 'Uncategorized'),
+                        subcategory=product.get('subcategory', ''),
+                        brand=product.get('brand', 'Unknown'),
+                        price=float(product.get('price', 0))
+                    )
+                    for product in document['products']
+                )
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # Keep serving the last good snapshot
+                logger.error(f"Failed to load product catalog {self.path}: {e}")
+                return False
+
+            self.products = MappingProxyType({record.product_id: record for record in records})
+            self.records = records
+            self.version = document.get('version', stat.st_mtime_ns)
+            self.file_signature = signature
+            logger.info(f"Loaded product catalog version {self.version} ({len(records)} products)")
+            return True
+
+    def get(self, product_id):
+        """Record for one product id, or a placeholder if it is not in the catalog"""
+        self.refresh()
+        return self.products.get(product_id) or unknown_product(product_id)
+
+    def get_many(self, product_ids):
+        """Records for a set of product ids as {product_id: ProductRecord}"""
+        self.refresh()
+        products = self.products
+        return {
+            product_id: products.get(product_id) or unknown_product(product_id)
+            for product_id in product_ids
+        }
+
+    def all(self):
+        """Every catalog record"""
+        self.refresh()
+        return self.records
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """Get the process-wide product catalog, loading it on first use"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = ProductCatalog()
+        return _catalog
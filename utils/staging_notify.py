@@ -0,0 +1,89 @@
+"""
+Staging write notifications
+The generator sends a UDP datagram per staged write so the ETL scheduler can wake up without polling MySQL
+"""
+from config.config import NOTIFY_CONFIG
+import logging
+import socket
+import threading
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def notify_staged(table, rows=1):
+    """Tell a listening ETL that rows were written to a staging table; best effort, never raises"""
+    global _sender
+    if not NOTIFY_CONFIG['enabled']:
+        return
+    try:
+        with _sender_lock:
+            if _sender is None:
+                _sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Fire and forget: with no listener the datagram is simply dropped
+        _sender.sendto(f"{table} {rows}".encode(), (NOTIFY_CONFIG['host'], NOTIFY_CONFIG['port']))
+    except OSError as e:
+        logger.debug(f"Staging notification for {table} not sent: {e}")
+
+
+class StagingNotifyListener:
+    """Count staged-row notifications per table on a background thread"""
+
+    def __init__(self, host=None, port=None):
+        self.host = host or NOTIFY_CONFIG['host']
+        self.port = port or NOTIFY_CONFIG['port']
+        self.lock = threading.Lock()
+        self.arrived = threading.Event()
+        self.pending = {}  # table -> rows notified since the last take()
+        self.socket = None
+
+    def start(self):
+        """Bind and start listening; returns False if the port is unavailable (e.g. another worker has it)"""
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind((self.host, self.port))
+        except OSError as e:
+            logger.warning(f"Not listening for staging notifications on {self.host}:{self.port}: {e}")
+            self.socket = None
+            return False
+        threading.Thread(target=self.listen, daemon=True).start()
+        logger.info(f"Listening for staging notifications on {self.host}:{self.port}")
+        return True
+
+    def listen(self):
+        while True:
+            try:
+                data, _ = self.socket.recvfrom(512)
+                table, rows = data.decode().split()
+                rows = int(rows)
+            except OSError:
+                return
+            except ValueError:
+                continue
+            with self.lock:
+                self.pending[table] = self.pending.get(table, 0) + rows
+            self.arrived.set()
+
+    def pending_rows(self):
+        """Rows notified since the last take()"""
+        with self.lock:
+            return sum(self.pending.values())
+
+    def take(self):
+        """Forget the notifications so far, e.g. when a run starts that will load their rows"""
+        with self.lock:
+            self.pending.clear()
+            self.arrived.clear()
+
+    def wait(self, timeout):
+        """Block until a notification arrives or the timeout passes"""
+        self.arrived.wait(max(timeout, 0))
+        self.arrived.clear()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None